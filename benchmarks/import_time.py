@@ -0,0 +1,60 @@
+"""
+Measure the start up cost of pyiid, the time to import the scatter module
+and make an `ElasticScatter`, in a fresh interpreter so nothing is already
+imported.  The heavy backends should only be loaded when they are used,
+any which are loaded at start up are reported and make the script fail so
+regressions are caught.
+
+    python benchmarks/import_time.py [repeats]
+"""
+from __future__ import print_function
+import subprocess
+import sys
+import json
+
+__author__ = 'christopher'
+
+# Modules which must not be loaded by importing pyiid or making an
+# ElasticScatter
+lazy_modules = ['accelerate', 'mkl', 'xraylib', 'xraylib_np', 'numba.cuda',
+                'scipy.interpolate', 'mpi4py']
+
+probe = '''
+import json, sys, time
+t0 = time.time()
+import pyiid.experiments.elasticscatter as es
+t1 = time.time()
+s = es.ElasticScatter()
+t2 = time.time()
+print(json.dumps({'import': t1 - t0, 'init': t2 - t1,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+''' % (lazy_modules,)
+
+
+def time_import():
+    """
+    Time the import and construction in a fresh interpreter
+
+    Returns
+    -------
+    dict:
+        The import and construction times in seconds and the lazy modules
+        which were loaded anyway
+    """
+    out = subprocess.check_output([sys.executable, '-c', probe])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    results = [time_import() for i in range(repeats)]
+    # the first run may compile or load the numba cache
+    print('first import: {0:.3f} s'.format(results[0]['import']))
+    print('best import: {0:.3f} s'.format(
+        min(r['import'] for r in results)))
+    print('best ElasticScatter(): {0:.4f} s'.format(
+        min(r['init'] for r in results)))
+    loaded = sorted(set(m for r in results for m in r['loaded']))
+    if loaded:
+        print('loaded at start up:', ', '.join(loaded))
+        sys.exit(1)
@@ -0,0 +1,248 @@
+"""
+Microbenchmarks of the pair traversal of the CPU kernels, for F(Q), the
+gradient and the distance histogram.  Three layouts are timed:
+
+flat
+    The flat-serial kernels, which fill kxQ (and kx3xQ) arrays over the
+    linear pair index k and then sum them.  These are skipped when the
+    arrays would not fit in `flat_bytes`.
+linear
+    The same sums done in place over k, decoding (i, j) from k for every
+    pair and reading the Nx3 positions.
+tiled
+    The threaded kernels, i tile x j tile with 3xN positions and the i
+    gradient row summed locally.
+
+    python benchmarks/pair_traversal.py [n ...]
+"""
+from __future__ import print_function
+import sys
+import time
+import math
+import numpy as np
+from numba import jit, prange
+from pyiid.experiments.elasticscatter.kernels import k_to_ij
+from pyiid.experiments.elasticscatter.kernels.cpu_flat import get_d_array, \
+    get_r_array, get_element_normalization_array, get_omega, \
+    get_fq_inplace, get_grad_omega, get_grad_fq_inplace
+from pyiid.experiments.elasticscatter.kernels.cpu_experimental import \
+    experimental_sum_grad_cpu
+from pyiid.experiments.elasticscatter.kernels.cpu_threaded import \
+    get_fq_blocks, get_grad_fq_blocks, get_histogram_blocks, get_tiles, \
+    get_tile_blocks
+from pyiid.experiments.elasticscatter.cpu_wrappers.flat_threaded_cpu_wrap \
+    import get_tile_size, get_num_threads
+
+__author__ = 'christopher'
+
+# The largest kx3xQ float32 array the flat kernels are timed with
+flat_bytes = 2 ** 30
+
+
+@jit(nopython=True, parallel=True)
+def linear_fq(fq, q, table, index, qbin, starts):
+    n_blocks, qmax_bin = fq.shape
+    for b in prange(n_blocks):
+        for k in range(starts[b], starts[b + 1]):
+            i, j = k_to_ij(k)
+            d0 = q[i, 0] - q[j, 0]
+            d1 = q[i, 1] - q[j, 1]
+            d2 = q[i, 2] - q[j, 2]
+            r = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+            for qx in range(qmax_bin):
+                sv = qbin * np.float32(qx)
+                fq[b, qx] += table[index[i], qx] * table[index[j], qx] * \
+                    math.sin(sv * r) / r
+
+
+@jit(nopython=True, parallel=True)
+def linear_grad(grad, q, table, index, qbin, starts):
+    n_blocks, _, _, qmax_bin = grad.shape
+    for b in prange(n_blocks):
+        for k in range(starts[b], starts[b + 1]):
+            i, j = k_to_ij(k)
+            d0 = q[i, 0] - q[j, 0]
+            d1 = q[i, 1] - q[j, 1]
+            d2 = q[i, 2] - q[j, 2]
+            r = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+            for qx in range(qmax_bin):
+                sv = qbin * np.float32(qx)
+                a = table[index[i], qx] * table[index[j], qx] * \
+                    (sv * math.cos(sv * r) - math.sin(sv * r) / r) / (r * r)
+                grad[b, i, 0, qx] -= a * d0
+                grad[b, i, 1, qx] -= a * d1
+                grad[b, i, 2, qx] -= a * d2
+                grad[b, j, 0, qx] += a * d0
+                grad[b, j, 1, qx] += a * d1
+                grad[b, j, 2, qx] += a * d2
+
+
+@jit(nopython=True, parallel=True)
+def linear_histogram(hist, q, index, rstep, starts):
+    n_blocks, _, _, rmax_bin = hist.shape
+    for b in prange(n_blocks):
+        for k in range(starts[b], starts[b + 1]):
+            i, j = k_to_ij(k)
+            d0 = q[i, 0] - q[j, 0]
+            d1 = q[i, 1] - q[j, 1]
+            d2 = q[i, 2] - q[j, 2]
+            rb = int(math.sqrt(d0 * d0 + d1 * d1 + d2 * d2) / rstep)
+            if rb < rmax_bin:
+                ei = max(index[i], index[j])
+                ej = min(index[i], index[j])
+                hist[b, ei, ej, rb] += 1
+
+
+def flat_fq(q, table, index, qbin):
+    k_max = len(q) * (len(q) - 1) // 2
+    d = np.zeros((k_max, 3), np.float32)
+    get_d_array(d, q, 0)
+    r = np.zeros(k_max, np.float32)
+    get_r_array(r, d)
+    norm = np.zeros((k_max, table.shape[1]), np.float32)
+    get_element_normalization_array(norm, table, index, 0)
+    omega = np.zeros((k_max, table.shape[1]), np.float32)
+    get_omega(omega, r, qbin)
+    get_fq_inplace(omega, norm)
+    return np.sum(omega, axis=0, dtype=np.float64)
+
+
+def flat_grad(q, table, index, qbin):
+    k_max = len(q) * (len(q) - 1) // 2
+    d = np.zeros((k_max, 3), np.float32)
+    get_d_array(d, q, 0)
+    r = np.zeros(k_max, np.float32)
+    get_r_array(r, d)
+    norm = np.zeros((k_max, table.shape[1]), np.float32)
+    get_element_normalization_array(norm, table, index, 0)
+    omega = np.zeros((k_max, table.shape[1]), np.float32)
+    get_omega(omega, r, qbin)
+    grad_omega = np.zeros((k_max, 3, table.shape[1]), np.float32)
+    get_grad_omega(grad_omega, omega, r, d, qbin)
+    get_grad_fq_inplace(grad_omega, norm)
+    grad = np.zeros((len(q), 3, table.shape[1]), np.float32)
+    experimental_sum_grad_cpu(grad, grad_omega, 0)
+    return grad
+
+
+def flat_histogram(q, index, rstep, rmax_bin):
+    k_max = len(q) * (len(q) - 1) // 2
+    d = np.zeros((k_max, 3), np.float32)
+    get_d_array(d, q, 0)
+    r = np.zeros(k_max, np.float32)
+    get_r_array(r, d)
+    i, j = np.tril_indices(len(q), -1)
+    n_elements = index.max() + 1
+    pair = np.maximum(index[i], index[j]) * n_elements + \
+        np.minimum(index[i], index[j])
+    rb = (r / rstep).astype(np.int64)
+    keep = rb < rmax_bin
+    return np.bincount(pair[keep] * rmax_bin + rb[keep],
+                       minlength=n_elements * n_elements * rmax_bin)
+
+
+def best_time(f, repeats=3):
+    f()
+    times = []
+    for r in range(repeats):
+        t0 = time.time()
+        f()
+        times.append(time.time() - t0)
+    return min(times)
+
+
+def run(n, qmax_bin=250, n_elements=2, rstep=.01, repeats=3, seed=0):
+    """
+    Time the flat, linear and tiled traversals
+
+    Parameters
+    ----------
+    n: int
+        The number of atoms
+    qmax_bin: int
+        The number of Q bins
+    n_elements: int
+        The number of elements
+    rstep: float
+        The histogram bin width
+    repeats: int
+        The best of this many runs is reported
+    seed: int
+        The random seed
+
+    Returns
+    -------
+    dict:
+        The 'flat', 'linear' and 'tiled' times, in seconds, of 'fq', 'grad'
+        and 'histogram', the flat times are None if they were skipped
+    """
+    rs = np.random.RandomState(seed)
+    # a box at about the density of a metal
+    q = (rs.random_sample((n, 3)) * (n * 17.) ** (1 / 3.)).astype(np.float32)
+    qt = np.ascontiguousarray(q.T)
+    index = rs.randint(0, n_elements, n).astype(np.int32)
+    table = rs.random_sample((n_elements, qmax_bin)).astype(np.float32)
+    qbin = np.float32(.1)
+    rstep = np.float32(rstep)
+    rmax_bin = int(math.ceil(np.sqrt(3) * q.max() / rstep)) + 1
+    threads = get_num_threads()
+
+    k_max = n * (n - 1) // 2
+    fq_starts = np.linspace(0, k_max, 4 * threads + 1).astype(np.int64)
+    starts = np.linspace(0, k_max, threads + 1).astype(np.int64)
+    tiles = get_tiles(n, get_tile_size(qmax_bin))
+    fq_blocks = get_tile_blocks(tiles, 4 * threads)
+    blocks = get_tile_blocks(tiles, threads)
+    h_tiles = get_tiles(n, get_tile_size(0))
+    h_blocks = get_tile_blocks(h_tiles, threads)
+
+    results = {'flat': {}, 'linear': {}, 'tiled': {}}
+    if k_max * 3 * qmax_bin * 4 <= flat_bytes:
+        results['flat']['fq'] = best_time(
+            lambda: flat_fq(q, table, index, qbin), repeats)
+        results['flat']['grad'] = best_time(
+            lambda: flat_grad(q, table, index, qbin), repeats)
+        results['flat']['histogram'] = best_time(
+            lambda: flat_histogram(q, index, rstep, rmax_bin), repeats)
+    else:
+        results['flat'] = {'fq': None, 'grad': None, 'histogram': None}
+    results['linear']['fq'] = best_time(lambda: linear_fq(
+        np.zeros((len(fq_starts) - 1, qmax_bin)), q, table, index, qbin,
+        fq_starts), repeats)
+    results['tiled']['fq'] = best_time(lambda: get_fq_blocks(
+        np.zeros((len(fq_blocks) - 1, qmax_bin)), qt, table, index, qbin,
+        tiles, fq_blocks), repeats)
+    results['linear']['grad'] = best_time(lambda: linear_grad(
+        np.zeros((len(starts) - 1, n, 3, qmax_bin), np.float32), q, table,
+        index, qbin, starts), repeats)
+    results['tiled']['grad'] = best_time(lambda: get_grad_fq_blocks(
+        np.zeros((len(blocks) - 1, n, 3, qmax_bin), np.float32), qt, table,
+        index, qbin, tiles, blocks), repeats)
+    h_shape = (n_elements, n_elements, rmax_bin)
+    results['linear']['histogram'] = best_time(lambda: linear_histogram(
+        np.zeros((len(starts) - 1,) + h_shape, np.int64), q, index, rstep,
+        starts), repeats)
+    results['tiled']['histogram'] = best_time(lambda: get_histogram_blocks(
+        np.zeros((len(h_blocks) - 1,) + h_shape, np.int64), qt, index, rstep,
+        h_tiles, h_blocks), repeats)
+    return results
+
+
+if __name__ == '__main__':
+    ns = [int(a) for a in sys.argv[1:]] or [500, 1000, 2000]
+    print('{0:>6} {1:>10} {2:>10} {3:>10} {4:>10} {5:>8} {6:>8}'.format(
+        'n', 'kernel', 'flat s', 'linear s', 'tiled s', 'vs flat',
+        'vs lin'))
+    for n in ns:
+        results = run(n)
+        for kernel in ['fq', 'grad', 'histogram']:
+            flat = results['flat'][kernel]
+            lin = results['linear'][kernel]
+            til = results['tiled'][kernel]
+            print('{0:>6} {1:>10} {2:>10} {3:>10.4f} {4:>10.4f} {5:>8} '
+                  '{6:>8.2f}'.format(
+                    n, kernel,
+                    '-' if flat is None else '{0:.4f}'.format(flat),
+                    lin, til,
+                    '-' if flat is None else '{0:.2f}'.format(flat / til),
+                    lin / til))
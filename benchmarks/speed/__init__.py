@@ -1 +0,0 @@
-__author__ = 'christopher'
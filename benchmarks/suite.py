@@ -0,0 +1,381 @@
+"""
+The pyiid benchmark suite.  Times, on generated gold nanoparticles,
+
+scatter
+    `get_fq`, `get_grad_fq`, `get_pdf` and `get_grad_pdf` on every CPU
+    backend, over a sweep of the number of atoms
+calc
+    the energy and forces of the `Spring`, `Calc1D` (PDF Rw) and `MultiCalc`
+    (both) calculators
+sampler
+    one NUTS step and one GCMC step
+
+Each benchmark reports the best of a few runs, a throughput (atom pairs per
+second for the scattering, atoms per second for the calculators and steps
+per second for the samplers) and the peak bytes traced by `tracemalloc`
+during a separate run, the memory of worker processes is not included.  The
+results are written as JSON together with a description of the machine, and
+can be compared against a saved run to catch regressions.
+
+    python benchmarks/suite.py [--sizes 50 100 200] [--suites scatter calc]
+        [--repeats 3] [--output results.json] [--compare baseline.json]
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+from copy import deepcopy as dc
+from multiprocessing import cpu_count
+import numpy as np
+import numba
+from ase.cluster.octahedron import Octahedron
+
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.backends import get_backends
+from pyiid.calc.spring_calc import Spring
+from pyiid.calc.calc_1d import Calc1D
+from pyiid.calc.multi_calc import MultiCalc
+from pyiid.sim.nuts_hmc import NUTSCanonicalEnsemble
+from pyiid.sim.gcmc import GrandCanonicalEnsemble
+
+__author__ = 'christopher'
+
+suites = ['scatter', 'calc', 'sampler']
+scatter_methods = ['get_fq', 'get_grad_fq', 'get_pdf', 'get_grad_pdf']
+# The growth, new / old time or peak memory, reported as a regression by
+# --compare
+regression_threshold = 1.2
+
+
+def make_nanoparticle(n, element='Au', seed=0):
+    """
+    A roughly spherical fcc nanoparticle with n atoms, the n atoms of an
+    octahedron nearest its center, slightly rattled
+
+    Parameters
+    ----------
+    n: int
+        The number of atoms
+    element: str
+        The element
+    seed: int
+        The seed of the rattle
+
+    Returns
+    -------
+    ase.Atoms:
+        The nanoparticle
+    """
+    length = 2
+    while len(Octahedron(element, length)) < n:
+        length += 1
+    atoms = Octahedron(element, length)
+    atoms.center()
+    r = np.linalg.norm(atoms.positions - atoms.get_center_of_mass(), axis=1)
+    del atoms[np.argsort(r, kind='mergesort')[n:]]
+    atoms.rattle(.05, seed=seed)
+    atoms.center(vacuum=5.)
+    return atoms
+
+
+def measure(f, setup=None, repeats=3):
+    """
+    Time a function and trace its peak memory
+
+    Parameters
+    ----------
+    f: callable
+        The function, called with the result of setup
+    setup: callable, optional
+        Makes the argument of each call, not timed
+    repeats: int
+        The best of this many runs is reported
+
+    Returns
+    -------
+    time: float
+        The best time, in seconds
+    peak_bytes: int
+        The peak bytes traced during one more run
+    """
+    def arg():
+        return setup() if setup is not None else None
+
+    # the first call compiles or loads the kernels
+    f(arg())
+    times = []
+    for r in range(repeats):
+        a = arg()
+        t0 = time.time()
+        f(a)
+        times.append(time.time() - t0)
+    a = arg()
+    tracemalloc.start()
+    try:
+        f(a)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def result(suite, name, backend, n, t, peak, work, unit):
+    return {'suite': suite, 'name': name, 'backend': backend, 'n': n,
+            'time': t, 'throughput': work / t if t > 0 else None,
+            'unit': unit, 'peak_bytes': peak}
+
+
+def run_scatter(sizes, repeats=3):
+    """
+    Time the scattering on every CPU backend
+
+    Parameters
+    ----------
+    sizes: list of int
+        The numbers of atoms
+    repeats: int
+        The best of this many runs is reported
+
+    Returns
+    -------
+    list of dict:
+        The results
+    """
+    results = []
+    for backend in get_backends('CPU'):
+        s = ElasticScatter()
+        s.set_processor(backend.processor, backend.kernel_type)
+        for n in sizes:
+            atoms = make_nanoparticle(n)
+            rs = np.random.RandomState(0)
+            qmax_bin = int(s.exp['qmax'] / s.exp['qbin'])
+
+            # move the atoms for each call so the geometry is not served
+            # from the cache
+            def setup():
+                a = atoms.copy()
+                a.positions += rs.normal(0, .01, a.positions.shape)
+                return a
+
+            for method in scatter_methods:
+                kind = 'grad' if 'grad' in method else 'fq'
+                if backend.fits is not None and \
+                        not backend.fits(kind, n, qmax_bin):
+                    continue
+                t, peak = measure(getattr(s, method), setup, repeats)
+                results.append(result('scatter', method, backend.name, n, t,
+                                      peak, n * (n - 1) / 2., 'pairs/s'))
+                print_result(results[-1])
+    return results
+
+
+def get_calculators(atoms):
+    # the calculators, by name, with a PDF target from the unrattled atoms
+    s = ElasticScatter({'rmax': 16.})
+    target = s.get_pdf(atoms)
+    pdf_calc = Calc1D(target_data=target, exp_function=s.get_pdf,
+                      exp_grad_function=s.get_grad_pdf, potential='rw',
+                      conv=30)
+    spring = Spring(k=100, rt=2.5)
+    return [('Spring', spring), ('Calc1D', pdf_calc),
+            ('MultiCalc', MultiCalc(calc_list=[spring, pdf_calc]))]
+
+
+def run_calc(sizes, repeats=3):
+    """
+    Time the energy and forces of the calculators
+
+    Parameters
+    ----------
+    sizes: list of int
+        The numbers of atoms
+    repeats: int
+        The best of this many runs is reported
+
+    Returns
+    -------
+    list of dict:
+        The results
+    """
+    results = []
+    for n in sizes:
+        atoms = make_nanoparticle(n)
+        rs = np.random.RandomState(0)
+        for name, calc in get_calculators(atoms):
+            # move the atoms for each call so nothing is served from cache
+            def setup():
+                a = atoms.copy()
+                a.positions += rs.normal(0, .01, a.positions.shape)
+                a.set_calculator(calc)
+                return a
+
+            def energy_and_forces(a):
+                a.get_potential_energy()
+                a.get_forces()
+
+            t, peak = measure(energy_and_forces, setup, repeats)
+            results.append(result('calc', 'energy_and_forces', name, n, t,
+                                  peak, n, 'atoms/s'))
+            print_result(results[-1])
+    return results
+
+
+def run_sampler(sizes, repeats=3):
+    """
+    Time one step of NUTS and of GCMC with a spring potential
+
+    Parameters
+    ----------
+    sizes: list of int
+        The numbers of atoms
+    repeats: int
+        The best of this many runs is reported
+
+    Returns
+    -------
+    list of dict:
+        The results
+    """
+    results = []
+    for n in sizes:
+        atoms = make_nanoparticle(n)
+        atoms.set_calculator(Spring(k=100, rt=2.5))
+        for name, make in [
+            ('NUTS', lambda: NUTSCanonicalEnsemble(
+                dc(atoms), temperature=300, seed=0)),
+            ('GCMC', lambda: GrandCanonicalEnsemble(
+                dc(atoms), {'Au': 0.}, temperature=300, seed=0,
+                resolution=.5, cavity_radius=2.))]:
+            sampler = make()
+            t, peak = measure(lambda a: sampler.step(), repeats=repeats)
+            results.append(result('sampler', 'step', name, n, t, peak, 1,
+                                  'steps/s'))
+            print_result(results[-1])
+    return results
+
+
+def get_machine():
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': cpu_count(),
+            'numba_threads': numba.config.NUMBA_NUM_THREADS,
+            'numpy': np.__version__,
+            'numba': numba.__version__,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run(sizes, suite_names=None, repeats=3):
+    """
+    Run the suites
+
+    Parameters
+    ----------
+    sizes: list of int
+        The numbers of atoms
+    suite_names: list of str, optional
+        The suites to run, defaults to all of them
+    repeats: int
+        The best of this many runs is reported
+
+    Returns
+    -------
+    dict:
+        The machine and the results
+    """
+    runners = {'scatter': run_scatter, 'calc': run_calc,
+               'sampler': run_sampler}
+    results = []
+    for name in suite_names or suites:
+        results.extend(runners[name](sizes, repeats))
+    return {'machine': get_machine(), 'results': results}
+
+
+def get_key(r):
+    return r['suite'], r['name'], r['backend'], r['n']
+
+
+def compare(new, old, threshold=None):
+    """
+    Compare two runs
+
+    Parameters
+    ----------
+    new, old: dict
+        The runs, as returned by `run`
+    threshold: float, optional
+        The slowdown reported as a regression, defaults to
+        `regression_threshold`
+
+    Returns
+    -------
+    list of (tuple, float, float):
+        The key, time ratio (new / old) and peak memory ratio of the
+        benchmarks whose time or peak memory grew by more than the
+        threshold
+
+    >>> old = {'results': [result('calc', 'f', 'Spring', 10, 1., 10, 1, '')]}
+    >>> new = {'results': [result('calc', 'f', 'Spring', 10, 2., 10, 1, '')]}
+    >>> compare(new, old)
+    [(('calc', 'f', 'Spring', 10), 2.0, 1.0)]
+    >>> new = {'results': [result('calc', 'f', 'Spring', 10, 1., 30, 1, '')]}
+    >>> compare(new, old)
+    [(('calc', 'f', 'Spring', 10), 1.0, 3.0)]
+    """
+    if threshold is None:
+        threshold = regression_threshold
+    old_results = dict((get_key(r), r) for r in old['results'])
+    regressions = []
+    for r in new['results']:
+        o = old_results.get(get_key(r))
+        if o is None or not o['time']:
+            continue
+        time_ratio = r['time'] / o['time']
+        memory_ratio = r['peak_bytes'] / float(o['peak_bytes']) \
+            if o['peak_bytes'] else None
+        if time_ratio > threshold or (memory_ratio is not None and
+                                      memory_ratio > threshold):
+            regressions.append((get_key(r), time_ratio, memory_ratio))
+    return regressions
+
+
+def print_result(r):
+    print('{0:<8} {1:<18} {2:<18} {3:>6} {4:>10.4f} s {5:>12.4g} {6:<8} '
+          '{7:>12} B'.format(r['suite'], r['name'], r['backend'], r['n'],
+                             r['time'], r['throughput'], r['unit'],
+                             r['peak_bytes']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='The pyiid benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[50, 100, 200])
+    parser.add_argument('--suites', nargs='+', choices=suites,
+                        default=suites)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='a previous results file')
+    args = parser.parse_args(argv)
+    results = run(args.sizes, args.suites, args.repeats)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(results, old)
+        for key, time_ratio, memory_ratio in regressions:
+            print('regressed: {0} {1:.2f}x time, {2} memory'.format(
+                '/'.join(str(k) for k in key), time_ratio,
+                '-' if memory_ratio is None else
+                '{0:.2f}x'.format(memory_ratio)))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,28 @@
+from __future__ import print_function
+import sys
+
+__author__ = 'christopher'
+
+commands = ['warmup', 'pdf']
+
+
+def main(argv=None):
+    """
+    The pyiid command line, `pyiid <command> [options]`
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in commands:
+        print('usage: pyiid {{{0}}} [options]'.format(','.join(commands)))
+        return 2
+    if argv[0] == 'warmup':
+        from pyiid.warmup import main as warmup_main
+        return warmup_main(argv[1:])
+    if argv[0] == 'pdf':
+        from pyiid.experiments.elasticscatter.trajectory import \
+            main as pdf_main
+        return pdf_main(argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,11 @@
 import math
+import os
 from builtins import range
 from ase.data import *
 import numpy as np
+from numba import jit, prange
+from pyiid.neighbor_list import get_attached_neighbor_list
+from pyiid.experiments.shared import get_neighbor_geometry
 
 __doc__ = """
 
@@ -12,24 +16,35 @@ relatively uniform density of dots over every atoms and
 eliminates those within the sphere of another atom. The remaining
 dots is used to calculate the area.
 
+Neighbors are found with a cell list (spatial hash) so that both the
+neighbor search and the occlusion tests scale linearly with the number of
+atoms, the occlusion tests are run in parallel over the atoms.  If the atoms
+carry a `NeighborList` which covers the cutoff it is used instead.
+
 Reference: A. Shrake & J. A. Rupley. "Environment and Exposure to
 Solvent of Protein Atoms. Lysozyme and Insulin." J Mol Biol. 79
 (1973) 351- 371. """
 
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
+
+
+def _get_neighbor_arrays(cut, atoms):
+    nl = get_attached_neighbor_list(atoms, cut)
+    if nl is not None:
+        return nl.get_neighbor_arrays(atoms, cut)
+    return get_neighbor_geometry(atoms, cut)
+
+
 def get_neighbor_list(cut, atoms):
-    r = atoms.get_all_distances()
-    n_list = []
-    for i in range(len(atoms)):
-        sub = \
-        np.where((0.0 < r[i, :]).astype(bool) & (r[i, :] < cut).astype(bool))[
-            0]
-        n_list.append(sub)
-    return n_list
+    offsets, indices = _get_neighbor_arrays(cut, atoms)
+    return [indices[offsets[i]:offsets[i + 1]] for i in range(len(atoms))]
+
 
 def get_coordination(cut, atoms):
-    nl = get_neighbor_list(cut, atoms)
-    cl = np.asarray([len(i) for i in nl])
-    return cl
+    offsets, _ = _get_neighbor_arrays(cut, atoms)
+    return np.diff(offsets)
 
 
 def generate_sphere_points(n):
@@ -45,15 +60,61 @@ def generate_sphere_points(n):
     -------
         sphere point coordinates
   """
-    points = np.zeros((n, 3))
     inc = math.pi * (3 - math.sqrt(5))
     offset = 2 / float(n)
-    for k in range(int(n)):
-        y = k * offset - 1 + (offset / 2)
-        r = math.sqrt(1 - y * y)
-        phi = k * inc
-        points[k, :] = [math.cos(phi) * r, y, math.sin(phi) * r]
-    return points
+    k = np.arange(int(n))
+    y = k * offset - 1 + (offset / 2)
+    r = np.sqrt(1 - y * y)
+    phi = k * inc
+    return np.stack([np.cos(phi) * r, y, np.sin(phi) * r], axis=1)
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def _asa_kernel(q, radii, sphere_points, offsets, indices, accessible):
+    """
+    Test every sphere point of every atom for occlusion by its neighbors
+
+    Parameters
+    ----------
+    q: Nx3 array
+        The atomic positions
+    radii: N array
+        The atomic radii plus the probe radius
+    sphere_points: Px3 array
+        The unit sphere points
+    offsets: N + 1 array
+        The neighbor offsets
+    indices: array
+        The neighbor indices
+    accessible: NxP bool array
+        True if the point is accessible
+    """
+    for i in prange(len(q)):
+        start = offsets[i]
+        n_neighbor = offsets[i + 1] - start
+        ri = radii[i]
+        # The neighbor that occluded the last point most likely occludes the
+        # next one, so start looking there
+        j_closest = 0
+        for k in range(len(sphere_points)):
+            px = sphere_points[k, 0] * ri + q[i, 0]
+            py = sphere_points[k, 1] * ri + q[i, 1]
+            pz = sphere_points[k, 2] * ri + q[i, 2]
+            is_accessible = True
+            for m in range(n_neighbor):
+                jj = j_closest + m
+                if jj >= n_neighbor:
+                    jj -= n_neighbor
+                j = indices[start + jj]
+                rj = radii[j]
+                dx = q[j, 0] - px
+                dy = q[j, 1] - py
+                dz = q[j, 2] - pz
+                if dx * dx + dy * dy + dz * dz < rj * rj:
+                    j_closest = jj
+                    is_accessible = False
+                    break
+            accessible[i, k] = is_accessible
 
 
 def calculate_asa(atoms, probe, cutoff=None, tag=1, n_sphere_point=960):
@@ -79,39 +140,21 @@ def calculate_asa(atoms, probe, cutoff=None, tag=1, n_sphere_point=960):
         elements = list(set(atoms.numbers))
         cutoff = np.min(vdw_radii[elements]) * 2
     sphere_points = generate_sphere_points(n_sphere_point)
+    sphere_points /= np.linalg.norm(sphere_points, axis=1)[:, np.newaxis]
 
     const = 4.0 * math.pi / len(sphere_points)
-    areas = []
-    surface = []
-    n_list = list(get_neighbor_list(cutoff, atoms))
-    for i, atom_i in enumerate(atoms):
-        neighbor_indices = n_list[i]
-        n_neighbor = len(neighbor_indices)
-        j_closest_neighbor = 0
-        radius = probe + vdw_radii[atom_i.number]
-
-        n_accessible_point = 0
-        for k in range(n_sphere_point):
-            is_accessible = True
-            test_point = sphere_points[k, :] / np.linalg.norm(
-                sphere_points[k, :]) * radius + atom_i.position
-            cycled_indices = list(range(j_closest_neighbor, n_neighbor))
-            cycled_indices.extend(range(j_closest_neighbor))
-
-            for j in cycled_indices:
-                atom_j = atoms[int(neighbor_indices[j])]
-                r = vdw_radii[atom_j.number] + probe
-                diff = atom_j.position - test_point
-                if np.dot(diff, diff) < r * r:
-                    j_closest_neighbor = j
-                    is_accessible = False
-                    break
-            if is_accessible:
-                n_accessible_point += 1
-                surface.append(test_point)
-
-        area = const * n_accessible_point * radius * radius
-        if area > 0:
-            atoms[i].tag = tag
-        areas.append(area)
-    return areas, surface
+    q = atoms.get_positions()
+    radii = vdw_radii[atoms.numbers] + probe
+    offsets, indices = _get_neighbor_arrays(cutoff, atoms)
+
+    accessible = np.zeros((len(atoms), len(sphere_points)), np.bool_)
+    _asa_kernel(q, radii, sphere_points, offsets, indices, accessible)
+
+    areas = const * np.sum(accessible, axis=1) * radii * radii
+    tags = atoms.get_tags()
+    tags[areas > 0] = tag
+    atoms.set_tags(tags)
+
+    i, k = np.nonzero(accessible)
+    surface = sphere_points[k] * radii[i, np.newaxis] + q[i]
+    return list(areas), surface
@@ -1,8 +1,8 @@
 from __future__ import print_function
 from ase.calculators.calculator import Calculator
 import numpy as np
-from pyiid.experiments.elasticscatter.kernels.cpu_nxn import get_d_array, \
-    get_r_array
+from pyiid.experiments.shared import get_nxn_geometry
+from pyiid.neighbor_list import get_attached_neighbor_list
 from builtins import range
 __author__ = 'christopher'
 
@@ -10,6 +10,9 @@ __author__ = 'christopher'
 class Spring(Calculator):
     """
     Spring Repulsion Potential Energy Surface
+
+    If the atoms carry a `NeighborList` which covers the spring cutoff
+    the repulsive spring only visits the pairs in the list.
     """
     implemented_properties = ['energy', 'forces']
 
@@ -28,16 +31,23 @@ class Spring(Calculator):
         self.f_func = spring_force
         self.v_nrg = voxel_spring_nrg
         self.atomwise_nrg = atomwise_spring_nrg
+        # Only the repulsive spring is short ranged
+        self.nl_nrg_func = nl_spring_nrg
+        self.nl_f_func = nl_spring_force
         if sp_type == 'com':
             self.nrg_func = com_spring_nrg
             self.f_func = com_spring_force
             self.v_nrg = voxel_com_spring_nrg
             self.atomwise_nrg = atomwise_com_spring_nrg
+            self.nl_nrg_func = None
+            self.nl_f_func = None
         if sp_type == 'att':
             self.nrg_func = att_spring_nrg
             self.f_func = att_spring_force
             self.v_nrg = voxel_att_spring_nrg
             self.atomwise_nrg = atomwise_att_spring_nrg
+            self.nl_nrg_func = None
+            self.nl_f_func = None
 
     def calculate(self, atoms=None, properties=['energy'],
                   system_changes=['positions', 'numbers', 'cell',
@@ -79,13 +89,21 @@ class Spring(Calculator):
         :param atoms:
         :return:
         """
-        energy = self.nrg_func(atoms, self.k, self.rt)
+        nl = get_attached_neighbor_list(atoms, self.rt)
+        if nl is not None and self.nl_nrg_func is not None:
+            energy = self.nl_nrg_func(atoms, self.k, self.rt, nl)
+        else:
+            energy = self.nrg_func(atoms, self.k, self.rt)
         self.results['energy'] = energy
 
     def calculate_forces(self, atoms):
         self.results['forces'] = np.zeros((len(atoms), 3))
 
-        forces = self.f_func(atoms, self.k, self.rt)
+        nl = get_attached_neighbor_list(atoms, self.rt)
+        if nl is not None and self.nl_f_func is not None:
+            forces = self.nl_f_func(atoms, self.k, self.rt, nl)
+        else:
+            forces = self.f_func(atoms, self.k, self.rt)
 
         self.results['forces'] = forces
 
@@ -97,12 +115,7 @@ class Spring(Calculator):
 
 
 def spring_nrg(atoms, k, rt):
-    q = atoms.get_positions().astype(np.float32)
-    n = len(atoms)
-    d = np.zeros((n, n, 3), dtype=np.float32)
-    get_d_array(d, q)
-    r = np.zeros((n, n), dtype=np.float32)
-    get_r_array(r, d)
+    d, r = get_nxn_geometry(atoms)
 
     thresh = np.less(r, rt)
     for i in range(len(thresh)):
@@ -116,12 +129,8 @@ def spring_nrg(atoms, k, rt):
 
 
 def spring_force(atoms, k, rt):
-    q = atoms.get_positions().astype(np.float32)
     n = len(atoms)
-    d = np.zeros((n, n, 3), dtype=np.float32)
-    get_d_array(d, q)
-    r = np.zeros((n, n), dtype=np.float32)
-    get_r_array(r, d)
+    d, r = get_nxn_geometry(atoms)
 
     thresh = np.less(r, rt)
 
@@ -141,6 +150,25 @@ def spring_force(atoms, k, rt):
     return direction
 
 
+def nl_spring_nrg(atoms, k, rt, nl):
+    i, j, d, r = nl.get_pairs(atoms, rt)
+    # each unique pair is counted twice in the all pairs version
+    return np.sum(k * (r - rt) ** 2)
+
+
+def nl_spring_force(atoms, k, rt, nl):
+    i, j, d, r = nl.get_pairs(atoms, rt)
+    direction = np.zeros((len(atoms), 3))
+    old_settings = np.seterr(all='ignore')
+    f = d / r[:, np.newaxis] * (k * (r - rt))[:, np.newaxis]
+    np.seterr(**old_settings)
+    f[np.isnan(f)] = 0.0
+    for tz in range(3):
+        direction[:, tz] += np.bincount(i, f[:, tz], len(atoms))
+        direction[:, tz] -= np.bincount(j, f[:, tz], len(atoms))
+    return direction
+
+
 # TODO:Kernelize me Captain
 def voxel_spring_nrg(atoms, k_const, rt, resolution):
     c = np.diagonal(atoms.get_cell())
@@ -167,12 +195,7 @@ def voxel_spring_nrg(atoms, k_const, rt, resolution):
 
 
 def atomwise_spring_nrg(atoms, k, rt):
-    q = atoms.get_positions().astype(np.float32)
-    n = len(atoms)
-    d = np.zeros((n, n, 3), dtype=np.float32)
-    get_d_array(d, q)
-    r = np.zeros((n, n), dtype=np.float32)
-    get_r_array(r, d)
+    d, r = get_nxn_geometry(atoms)
 
     nrg = .5 * k * (r - rt) ** 2
     print(nrg)
@@ -250,12 +273,7 @@ def atomwise_com_spring_nrg(atoms, k, rt):
 
 
 def att_spring_nrg(atoms, k, rt):
-    q = atoms.get_positions().astype(np.float32)
-    n = len(atoms)
-    d = np.zeros((n, n, 3), dtype=np.float32)
-    get_d_array(d, q)
-    r = np.zeros((n, n), dtype=np.float32)
-    get_r_array(r, d)
+    d, r = get_nxn_geometry(atoms)
 
     thresh = np.greater(r, rt)
     for i in range(len(thresh)):
@@ -269,12 +287,8 @@ def att_spring_nrg(atoms, k, rt):
 
 
 def att_spring_force(atoms, k, rt):
-    q = atoms.get_positions().astype(np.float32)
     n = len(atoms)
-    d = np.zeros((n, n, 3), dtype=np.float32)
-    get_d_array(d, q)
-    r = np.zeros((n, n), dtype=np.float32)
-    get_r_array(r, d)
+    d, r = get_nxn_geometry(atoms)
 
     thresh = np.greater(r, rt)
 
@@ -320,12 +334,7 @@ def voxel_att_spring_nrg(atoms, k_const, rt, resolution):
 
 
 def atomwise_att_spring_nrg(atoms, k, rt):
-    q = atoms.get_positions().astype(np.float32)
-    n = len(atoms)
-    d = np.zeros((n, n, 3), dtype=np.float32)
-    get_d_array(d, q)
-    r = np.zeros((n, n), dtype=np.float32)
-    get_r_array(r, d)
+    d, r = get_nxn_geometry(atoms)
 
     nrg = .5 * k * (r - rt) ** 2
     nrg[np.where(r < rt)] = 0.0
@@ -0,0 +1,152 @@
+import numpy as np
+from ase.calculators.calculator import Calculator
+
+from pyiid.calc import wrap_rw, wrap_chi_sq
+from pyiid.experiments.stem import STEM
+
+__author__ = 'christopher'
+
+
+def get_grad_rw_image(gcalc, gobs, rw, scale):
+    """
+    The gradient of the Rw with respect to each pixel of the model image,
+    the scale is the least squares optimum so its gradient does not
+    contribute
+
+    Parameters
+    ----------
+    gcalc: ndarray
+        The model image
+    gobs: ndarray
+        The observed image
+    rw: float
+        The current Rw value
+    scale: float
+        The current scale
+
+    Returns
+    -------
+    ndarray:
+        The gradient
+    """
+    resid = gobs - scale * gcalc
+    top = np.sum(resid ** 2)
+    if top == 0:
+        return np.zeros(gcalc.shape)
+    return -rw * scale * resid / top
+
+
+def get_grad_chi_sq_image(gcalc, gobs, scale):
+    """
+    The gradient of the chi squared with respect to each pixel of the model
+    image
+
+    Parameters
+    ----------
+    gcalc: ndarray
+        The model image
+    gobs: ndarray
+        The observed image
+    scale: float
+        The current scale
+
+    Returns
+    -------
+    ndarray:
+        The gradient
+    """
+    return -2 * scale * (gobs - scale * gcalc)
+
+
+class STEMCalc(Calculator):
+    """
+    Class for doing STEM image based RW/chi**2 calculations.  The image
+    model is the FFT probe convolution of `STEM.get_fft_image` and the
+    forces come from its adjoint, so a refinement against an image costs
+    O(N + P log P) per step and can be combined with PDF data in a
+    `MultiCalc`.
+    """
+    implemented_properties = ['energy', 'forces']
+
+    def __init__(self, restart=None, ignore_bad_restart_file=False, label=None,
+                 atoms=None,
+                 target_data=None, stem=None, axis=2,
+                 conv=1., potential='rw', **kwargs):
+
+        Calculator.__init__(self, restart, ignore_bad_restart_file,
+                            label, atoms, **kwargs)
+        if target_data is None or len(target_data.shape) != 2:
+            raise NotImplementedError('Need a 2d array target image')
+        if stem is None:
+            stem = STEM()
+        self.target_data = target_data
+        self.stem = stem
+        self.axis = axis
+        self.scale = 1
+        self.rw_to_eV = conv
+        if potential not in ['rw', 'chi_sq']:
+            raise NotImplementedError('Potential not implemented')
+        self.potential = potential
+
+    def calculate(self, atoms=None, properties=['energy'],
+                  system_changes=['positions', 'numbers', 'cell',
+                                  'pbc', 'charges', 'magmoms']):
+        """STEM Calculator
+        Parameters
+        ----------
+        atoms: Atoms object
+            Contains positions, unit-cell, ...
+        properties: list of str
+            List of what needs to be calculated.  Can be any combination
+            of 'energy', 'forces'
+        system_changes: list of str
+            List of what has changed since last calculation.  Can be
+            any combination of these five: 'positions', 'numbers', 'cell',
+            'pbc', 'charges' and 'magmoms'.
+        """
+
+        Calculator.calculate(self, atoms, properties, system_changes)
+
+        if len(system_changes) > 0:
+            if 'energy' in properties:
+                self.calculate_energy(self.atoms)
+
+            if 'forces' in properties:
+                self.calculate_forces(self.atoms)
+        for property in properties:
+            if property not in self.results:
+                if property == 'energy':
+                    self.calculate_energy(self.atoms)
+
+                if property == 'forces':
+                    self.calculate_forces(self.atoms)
+
+    def _potential(self, gcalc):
+        if self.potential == 'rw':
+            return wrap_rw(gcalc.ravel(), self.target_data.ravel())
+        return wrap_chi_sq(gcalc.ravel(), self.target_data.ravel())
+
+    def calculate_energy(self, atoms):
+        """
+        Calculate energy
+        :param atoms:
+        :return:
+        """
+        gcalc = self.stem.get_fft_image(atoms, self.axis,
+                                        self.target_data.shape)
+        energy, scale = self._potential(gcalc)
+        self.scale = scale
+        self.results['energy'] = energy * self.rw_to_eV
+
+    def calculate_forces(self, atoms):
+        gcalc = self.stem.get_fft_image(atoms, self.axis,
+                                        self.target_data.shape)
+        energy, scale = self._potential(gcalc)
+        if self.potential == 'rw':
+            image_grad = get_grad_rw_image(gcalc, self.target_data, energy,
+                                           scale)
+        else:
+            image_grad = get_grad_chi_sq_image(gcalc, self.target_data,
+                                               scale)
+        grad = self.stem.get_grad_fft_image(atoms, image_grad, self.axis)
+        self.results['forces'] = -1 * grad * self.rw_to_eV
@@ -0,0 +1,493 @@
+"""
+Cost models, predictions of the seconds and bytes of a calculation fitted
+from quick probes on this machine.
+
+A `CostModel` is linear in a few features of the size of the calculation,
+eg. the number of pairs times the number of Q bins, with non-negative
+coefficients fitted to timed and traced probe runs.  `ScatterCostModel`
+covers the scattering: the pair sums of each backend (seconds in N and Q
+bins) and the Fourier transforms of `get_pdf` and `get_grad_pdf` (in N, the
+FFT length and the number of R points).  The bytes of the pair sums come
+from the byte model each backend plans its memory with, see
+`pyiid.experiments.elasticscatter.memory`, so a prediction and the memory
+plan of the same call agree.  The pair sums are probed with more and more
+atoms until the pair term is well above the constant overhead (eg. starting
+the process pool of the flat backend), so the fits hold for big N.  The fits
+are kept in
+cost_model.json in the pyiid cache directory so each machine is calibrated
+once.  The ensembles fit the cost of their calculator the same way, see
+`Ensemble.calibrate_cost`.
+"""
+from __future__ import print_function
+import os
+import json
+import math
+import time
+from multiprocessing import cpu_count
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from pyiid.experiments.shared.cache_dir import get_cache_root
+
+__author__ = 'christopher'
+
+# Changed with the probes, so fits made by older probes are not used
+probe_version = 2
+
+
+def measure(f, setup=None, repeats=1, trace=True):
+    """
+    Time a function and trace its peak memory, after a warm up call
+
+    Parameters
+    ----------
+    f: callable
+        The function, called with the result of setup
+    setup: callable, optional
+        Makes the argument of each call, not timed
+    repeats: int
+        The best of this many runs is reported
+    trace: bool
+        Trace the peak memory
+
+    Returns
+    -------
+    seconds: float
+        The best time
+    peak_bytes: int
+        The peak bytes traced during one more run, 0 without tracemalloc or
+        if not traced
+    """
+    def arg():
+        return setup() if setup is not None else None
+
+    f(arg())
+    times = []
+    for r in range(repeats):
+        a = arg()
+        t0 = time.time()
+        f(a)
+        times.append(time.time() - t0)
+    peak = 0
+    if trace and tracemalloc is not None and not tracemalloc.is_tracing():
+        a = arg()
+        tracemalloc.start()
+        try:
+            f(a)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(times), peak
+
+
+def fit_nonnegative(x, y):
+    """
+    Least squares with non-negative coefficients, features which would get
+    a negative coefficient are dropped and the rest refitted
+
+    Parameters
+    ----------
+    x: MxF array
+        The features of each sample
+    y: M array
+        The values
+
+    Returns
+    -------
+    F array:
+        The coefficients
+
+    >>> x = np.array([[1., 1.], [1., 2.], [1., 3.]])
+    >>> np.round(fit_nonnegative(x, np.array([3., 5., 7.])), 6).tolist()
+    [1.0, 2.0]
+    >>> fit_nonnegative(x, np.array([3., 2., 1.])).tolist()
+    [2.0, 0.0]
+    """
+    x = np.asarray(x, np.float64)
+    y = np.asarray(y, np.float64)
+    active = list(range(x.shape[1]))
+    coef = np.zeros(x.shape[1])
+    while active:
+        # scale the columns so features of very different size fit together
+        scale = np.abs(x[:, active]).max(axis=0)
+        scale[scale == 0] = 1.
+        c = np.linalg.lstsq(x[:, active] / scale, y, rcond=None)[0] / scale
+        if np.all(c >= 0):
+            coef[active] = c
+            break
+        del active[int(np.argmin(c))]
+    return coef
+
+
+class CostModel(object):
+    """
+    Seconds and bytes as non-negative linear functions of some features
+
+    Parameters
+    ----------
+    features: callable
+        Gives the list of features of a calculation from its size parameters
+    time_coef, byte_coef: array, optional
+        The fitted coefficients
+    """
+
+    def __init__(self, features, time_coef=None, byte_coef=None):
+        self.features = features
+        self.time_coef = None if time_coef is None else np.asarray(time_coef)
+        self.byte_coef = None if byte_coef is None else np.asarray(byte_coef)
+
+    @property
+    def fitted(self):
+        return self.time_coef is not None
+
+    def fit(self, sizes, seconds, nbytes):
+        """
+        Fit the model
+
+        Parameters
+        ----------
+        sizes: list of dict
+            The size parameters of each probe
+        seconds: list of float
+            The time of each probe
+        nbytes: list of int
+            The peak bytes of each probe
+        """
+        x = np.array([self.features(**s) for s in sizes], np.float64)
+        self.time_coef = fit_nonnegative(x, seconds)
+        self.byte_coef = fit_nonnegative(x, nbytes)
+        return self
+
+    def predict(self, **size):
+        """
+        Predict a calculation
+
+        Returns
+        -------
+        seconds: float
+            The predicted time
+        nbytes: int
+            The predicted peak bytes
+        """
+        if not self.fitted:
+            raise RuntimeError('The cost model has not been fitted')
+        x = np.array(self.features(**size), np.float64)
+        return float(x.dot(self.time_coef)), int(x.dot(self.byte_coef))
+
+    def to_dict(self):
+        return {'time': self.time_coef.tolist(),
+                'bytes': self.byte_coef.tolist()}
+
+
+def pair_features(n, qmax_bin):
+    # constant, per atom (the Nx3xQ arrays) and per pair terms
+    return [1., n * qmax_bin, n * (n - 1) / 2. * qmax_bin]
+
+
+def pdf_features(fft_length, r_points):
+    # one transform and re-binning of F(Q)
+    return [1., fft_length * math.log(fft_length, 2), r_points]
+
+
+def calculator_features(n):
+    # the energy or forces of a calculator, at worst a sum over pairs
+    return [1., n, n * (n - 1) / 2.]
+
+
+def grad_pdf_features(n, fft_length, r_points):
+    # 3N transforms and re-binnings of grad F(Q)
+    return [1., n * fft_length * math.log(fft_length, 2), n * r_points]
+
+
+def get_fft_length(qmax_bin, rstep, qstep, qmin):
+    """
+    The length of the FFT `get_pdf_at_qmin` makes
+
+    Parameters
+    ----------
+    qmax_bin: int
+        The number of Q bins
+    rstep: float
+        The r grid spacing
+    qstep: float
+        The Q grid spacing
+    qmin: float
+        The minimum Q
+
+    Returns
+    -------
+    int:
+        The FFT length
+
+    >>> get_fft_length(261, .01, .0734, 0.)
+    65536
+    """
+    length = max(qmax_bin, int(math.ceil(math.pi / rstep / qstep)))
+    npad1 = int(round(qmin / qstep)) + length
+    return 4 * (1 << int(math.ceil(math.log(npad1, 2)))) * 2
+
+
+def _probe_atoms(n, seed=0):
+    # gold atoms in a box at about the density of the metal
+    from ase.atoms import Atoms
+    rs = np.random.RandomState(seed)
+    return Atoms('Au{0}'.format(n),
+                 rs.random_sample((n, 3)) * (n * 17.) ** (1 / 3.))
+
+
+class ScatterCostModel(object):
+    """
+    The cost of the scattering calculations of each backend
+
+    Parameters
+    ----------
+    cache_file: str, optional
+        Where the fits are kept, defaults to cost_model.json in the pyiid
+        cache directory
+    persist: bool
+        Read and write the cache file
+    sizes: list of int, optional
+        The numbers of atoms the pair sums are probed with, by default the
+        number of atoms is doubled until a probe takes `probe_time` and four
+        times as long as the first one
+    probe_time: float
+        The seconds of the longest probe
+    max_n: int
+        The most atoms the pair sums are probed with
+    """
+
+    def __init__(self, cache_file=None, persist=True, sizes=None,
+                 probe_time=.25, max_n=4096):
+        self.cache_file = cache_file
+        self.persist = persist
+        self.sizes = None if sizes is None else list(sizes)
+        self.probe_time = probe_time
+        self.max_n = max_n
+        self.models = {}
+        self._loaded = False
+
+    def get_cache_file(self):
+        if self.cache_file is not None:
+            return self.cache_file
+        return os.path.join(get_cache_root(), 'cost_model.json')
+
+    @staticmethod
+    def get_key(name, kind):
+        # the fits only hold on the same number of cores and probes
+        return '{0}|{1}|{2}|{3}'.format(name, kind, cpu_count(),
+                                        probe_version)
+
+    def _load(self):
+        self._loaded = True
+        f_name = self.get_cache_file()
+        if not self.persist or not os.path.exists(f_name):
+            return
+        try:
+            with open(f_name, 'r') as f:
+                table = json.load(f)
+        except (IOError, ValueError):
+            return
+        for key, value in table.items():
+            self.models[key] = CostModel(
+                self._features(key.split('|')[1]), value['time'],
+                value['bytes'])
+
+    def _save(self):
+        if not self.persist:
+            return
+        f_name = self.get_cache_file()
+        table = dict((k, m.to_dict()) for k, m in self.models.items())
+        try:
+            if not os.path.exists(os.path.dirname(f_name)):
+                os.makedirs(os.path.dirname(f_name))
+            # write then move so readers never see a partial file
+            tmp = f_name + '.{0}.tmp'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(table, f, indent=1, sort_keys=True)
+            os.rename(tmp, f_name)
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def _features(kind):
+        return {'fq': pair_features, 'grad': pair_features,
+                'pdf': pdf_features, 'grad_pdf': grad_pdf_features}[kind]
+
+    def get_model(self, name, kind):
+        """
+        The fitted model of a backend ('CPU/flat' etc.) and kind ('fq' or
+        'grad'), or of a transform (name 'transform', kind 'pdf' or
+        'grad_pdf'), probing this machine if it has not been fitted yet
+        """
+        if not self._loaded:
+            self._load()
+        key = self.get_key(name, kind)
+        if key not in self.models:
+            if name == 'transform':
+                self.models[key] = self.calibrate_transform(kind)
+            else:
+                self.models[key] = self.calibrate_backend(name, kind)
+            self._save()
+        return self.models[key]
+
+    def get_probe_sizes(self, seconds):
+        """
+        The numbers of atoms to probe a pair sum with
+
+        Parameters
+        ----------
+        seconds: list of float
+            The times of the probes so far, filled in by the caller
+
+        Yields
+        ------
+        int:
+            The next number of atoms
+        """
+        if self.sizes is not None:
+            for n in self.sizes:
+                yield n
+            return
+        n = 16
+        while n <= self.max_n:
+            yield n
+            # small probes only see the constant overhead, stop once the
+            # pairs dominate
+            if len(seconds) >= 3 and seconds[-1] >= self.probe_time and \
+                    seconds[-1] >= 4 * seconds[0]:
+                return
+            n *= 2
+
+    def calibrate_backend(self, name, kind, qbin=.1, qmax=25.):
+        """
+        Fit the time of the pair sum of a backend from probes, see
+        `get_probe_sizes`
+
+        Parameters
+        ----------
+        name: str
+            The backend, as processor/kernel_type
+        kind: {'fq', 'grad'}
+            The calculation
+
+        Returns
+        -------
+        CostModel:
+            The fit, its bytes are only used by backends without a byte
+            model
+        """
+        from pyiid.experiments.elasticscatter import ElasticScatter
+        from pyiid.experiments.elasticscatter.backends import get_backend
+        from pyiid.experiments.elasticscatter import memory
+        backend = get_backend(*name.split('/', 1))
+        f = backend.load()[0 if kind == 'fq' else 1]
+        s = ElasticScatter({'qmax': qmax, 'qbin': qbin})
+        qmax_bin = int(math.floor(qmax / qbin))
+        sizes, seconds, nbytes = [], [], []
+        for n in self.get_probe_sizes(seconds):
+            if backend.fits is not None and \
+                    not backend.fits(kind, n, qmax_bin):
+                break
+            atoms = _probe_atoms(n)
+            s._wrap_atoms(atoms)
+            last = memory.get_last_report()
+            t, peak = measure(lambda a: f(atoms, qbin),
+                              trace=backend.nbytes is None)
+            report = memory.get_last_report()
+            if report is not None and report is not last:
+                # the memory of the worker processes is not traced here
+                peak += report.processes * report.observed_worker
+            sizes.append({'n': n, 'qmax_bin': qmax_bin})
+            seconds.append(t)
+            nbytes.append(peak)
+        return CostModel(pair_features).fit(sizes, seconds, nbytes)
+
+    def calibrate_transform(self, kind):
+        """
+        Fit the Fourier transform of `get_pdf` ('pdf') or `get_grad_pdf`
+        ('grad_pdf') from probes over a few FFT lengths and numbers of atoms
+
+        Returns
+        -------
+        CostModel:
+            The fit
+        """
+        from pyiid.experiments.elasticscatter.kernels.master_kernel import \
+            get_pdf_at_qmin, grad_pdf
+        qstep = .1
+        sizes, seconds, nbytes = [], [], []
+        for rstep, rmax in [(.04, 20.), (.02, 30.), (.01, 40.)]:
+            rgrid = np.arange(0., rmax, rstep)
+            qmax_bin = 250
+            fft_length = get_fft_length(qmax_bin, rstep, qstep, 0.)
+            if kind == 'pdf':
+                fq = np.random.random(qmax_bin)
+                t, peak = measure(lambda a: get_pdf_at_qmin(
+                    fq.copy(), rstep, qstep, rgrid, 0.))
+                sizes.append({'fft_length': fft_length,
+                              'r_points': len(rgrid)})
+                seconds.append(t)
+                nbytes.append(peak)
+                continue
+            for n in [2, 8]:
+                grad_fq = np.random.random((n, 3, qmax_bin))
+                t, peak = measure(lambda a: grad_pdf(
+                    grad_fq.copy(), rstep, qstep, rgrid, 0.))
+                sizes.append({'n': n, 'fft_length': fft_length,
+                              'r_points': len(rgrid)})
+                seconds.append(t)
+                nbytes.append(peak)
+        return CostModel(self._features(kind)).fit(sizes, seconds, nbytes)
+
+    def predict(self, name, method, n, qmax_bin, fft_length=None,
+                r_points=None):
+        """
+        Predict a call of an `ElasticScatter` method
+
+        Parameters
+        ----------
+        name: str
+            The backend, as processor/kernel_type
+        method: {'get_fq', 'get_grad_fq', 'get_pdf', 'get_grad_pdf'}
+            The method
+        n: int
+            The number of atoms
+        qmax_bin: int
+            The number of Q bins of the pair sum
+        fft_length: int, optional
+            The FFT length, needed for the PDF methods, see
+            `get_fft_length`
+        r_points: int, optional
+            The number of r points, needed for the PDF methods
+
+        Returns
+        -------
+        seconds: float
+            The predicted time
+        nbytes: int
+            The predicted peak bytes
+        """
+        from pyiid.experiments.elasticscatter.backends import get_backend
+        kind = 'fq' if method in ['get_fq', 'get_pdf'] else 'grad'
+        seconds, nbytes = self.get_model(name, kind).predict(
+            n=n, qmax_bin=qmax_bin)
+        backend = get_backend(*name.split('/', 1))
+        if backend.nbytes is not None:
+            nbytes = backend.nbytes(kind, n, qmax_bin)
+        if method == 'get_pdf':
+            t, b = self.get_model('transform', 'pdf').predict(
+                fft_length=fft_length, r_points=r_points)
+        elif method == 'get_grad_pdf':
+            t, b = self.get_model('transform', 'grad_pdf').predict(
+                n=n, fft_length=fft_length, r_points=r_points)
+        else:
+            t, b = 0., 0
+        # the pair sum result is held during the transform
+        return seconds + t, nbytes + b
+
+
+scatter_cost_model = ScatterCostModel()
@@ -1,11 +1,11 @@
 import math
-from numba import cuda
 import numpy as np
 
 __author__ = 'christopher'
 
 
 def get_gpus_mem():
+    from numba import cuda
     gpus = cuda.gpus.lst
     mem_list = []
     for gpu in gpus:
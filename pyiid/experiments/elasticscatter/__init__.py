@@ -7,12 +7,13 @@ from a collection of atoms.
 """
 import math
 import numpy as np
-from accelerate import cuda
-from pyiid.experiments.elasticscatter.cpu_wrappers.nxn_cpu_wrap import \
-    wrap_fq_grad as cpu_wrap_fq_grad, wrap_fq as cpu_wrap_fq
 from pyiid.experiments.elasticscatter.kernels.master_kernel import \
-    grad_pdf as cpu_grad_pdf, get_pdf_at_qmin, get_scatter_array
-from scipy.interpolate import griddata
+    grad_pdf as cpu_grad_pdf, get_pdf_at_qmin, get_pdf_at_qmin_batch
+from pyiid.experiments.elasticscatter.atomics import get_scatter_factors
+from pyiid.experiments.shared.scatter_factors import get_form_factor_table
+from pyiid.experiments.elasticscatter.backends import check_mpi, check_gpu, \
+    check_cudafft, get_processors, get_backends, AutoBackend
+from pyiid.experiments.elasticscatter.profiling import Stats, profile, stage
 
 __author__ = 'christopher'
 
@@ -20,35 +21,6 @@ all_changes = ['positions', 'numbers', 'cell', 'pbc', 'charges', 'magmoms',
                'exp']
 
 
-def check_mpi():
-    # Test if MPI GPU is viable
-    # Currently no working MPI GPU implementation
-    return False
-
-
-def check_gpu():
-    """
-    Check if GPUs are available on this machine
-    """
-    try:
-        cuda.cuda.gpus.lst
-        tf = True
-    except cuda.cuda.CudaSupportError:
-        tf = False
-    return tf
-
-
-def check_cudafft():
-    try:
-        from accelerate.cuda import fft as cufft
-        tf = True
-    except ImportError:
-        tf = False
-        print('no cudafft')
-        cufft = None
-    return tf
-
-
 class ElasticScatter(object):
     """
     Scatter contains all the methods associated with producing theoretical
@@ -65,6 +37,11 @@ class ElasticScatter(object):
     >>>plt.plot(s.get_r(), fq)
     >>>plt.show()
 
+    The 'flat' CPU backend runs on a process pool.  Once the thread
+    parallel kernels ('flat-threaded', 'stream' or `get_fq_batch`) have run
+    in a process its pools are no longer forked, see
+    `pyiid.experiments.shared.pool`, and a script which mixes the two must
+    keep its top level code under ``if __name__ == '__main__':``.
     """
 
     def __init__(self, exp_dict=None, verbose=False, seed=None):
@@ -79,8 +56,8 @@ class ElasticScatter(object):
         self.rs = np.random.RandomState(self.seed)
 
         # Currently supported processor architectures, in order of most
-        # advanced to least
-        self.avail_pro = ['MPI-GPU', 'Multi-GPU', 'CPU']
+        # advanced to least, see `backends.register_backend`
+        self.avail_pro = get_processors()
 
         # needed parameters to specify an experiment
         self.exp_dict_keys = ['qmin', 'qmax', 'qbin', 'rmin', 'rmax', 'rstep',
@@ -96,61 +73,156 @@ class ElasticScatter(object):
         # set the experimental parameters
         self.update_experiment(exp_dict)
 
-        # Just in case something blows up down the line set to the most base
-        # processor
-        self.fq = cpu_wrap_fq
-        self.grad = cpu_wrap_fq_grad
+        # The fastest processor architecture available is found on first
+        # use, so creating an ElasticScatter does not load any backends
+        self.fq = None
+        self.grad = None
         self.grad_pdf = cpu_grad_pdf
-        self.processor = 'CPU'
-        self.alg = 'nxn'
 
-        # Get the fastest processor architecture available
-        self.set_processor()
+        # The per stage timings, filled in by `profile`
+        self.stats = None
+
+    def profile(self, memory=False):
+        """
+        Record the time (and memory) of each stage of the calculations made
+        inside the with block into `stats`, which keeps adding up over
+        profile blocks until it is set to None
+
+        Parameters
+        ----------
+        memory: bool
+            Also record the bytes allocated by each stage
+
+        Returns
+        -------
+        context manager:
+            Gives the `Stats`
+
+        Examples
+        --------
+        with s.profile() as stats:
+            pdf = s.get_pdf(atoms)
+        print(stats.report())
+        """
+        if self.stats is None or self.stats.memory != memory:
+            self.stats = Stats(memory)
+        return profile(self.stats)
+
+    def estimate_cost(self, method, n, backend=None):
+        """
+        Predict the time and peak memory of a calculation from the cost
+        model of this machine, see `pyiid.cost`.  The first prediction for
+        each backend runs a few quick probes to fit the model.
+
+        Parameters
+        ----------
+        method: {'get_fq', 'get_grad_fq', 'get_pdf', 'get_grad_pdf'}
+            The calculation
+        n: int
+            The number of atoms
+        backend: str, optional
+            The backend, as processor/kernel_type, defaults to the current
+            backend or, if the kernel is picked by the autotuner, the
+            candidate with the fastest prediction
+
+        Returns
+        -------
+        seconds: float
+            The predicted time
+        nbytes: int
+            The predicted peak bytes, the memory of worker processes included
+        """
+        from pyiid.cost import scatter_cost_model, get_fft_length
+        if method not in ['get_fq', 'get_grad_fq', 'get_pdf',
+                          'get_grad_pdf']:
+            raise ValueError('No cost model for {0}'.format(method))
+        pdf = method in ['get_pdf', 'get_grad_pdf']
+        qbin = self.pdf_qbin if pdf else self.exp['qbin']
+        qmax_bin = int(math.floor(self.exp['qmax'] / qbin))
+        size = {'n': n, 'qmax_bin': qmax_bin}
+        if pdf:
+            size['fft_length'] = get_fft_length(
+                qmax_bin, self.exp['rstep'], qbin, self.exp['qmin'])
+            size['r_points'] = len(self.get_r())
+        if backend is not None:
+            return scatter_cost_model.predict(backend, method, **size)
+        self._check_processor()
+        if self.alg != 'auto':
+            return scatter_cost_model.predict(
+                '{0}/{1}'.format(self.processor, self.alg), method, **size)
+        auto = self.fq if method in ['get_fq', 'get_pdf'] else self.grad
+        return min(scatter_cost_model.predict(b.name, method, **size)
+                   for b in auto.get_candidates(n, qmax_bin))
+
+    def _check_processor(self):
+        # Set the processor if it has not been set (successfully) yet
+        if self.fq is None:
+            self.set_processor()
+
+    def _get_scatter_key(self, elements):
+        # The compact scatter storage key, the elements and both Q grids,
+        # the tables themselves live in the form factor cache
+        if 'qbin' not in self.exp.keys():
+            self.exp['qbin'] = .1
+        return (tuple(int(e) for e in elements),
+                self.exp['qbin'],
+                int(math.floor(self.exp['qmax'] / self.exp['qbin'])),
+                self.pdf_qbin,
+                int(math.floor(self.exp['qmax'] / self.pdf_qbin)))
 
     def _wrap_atoms(self, atoms):
         """
-        Call this function before applying calculator, it will generate static
-        arrays for the scattering, preventing recalculation
+        Call this function before applying calculator, it will attach the
+        scatter factor key to the atoms and generate the element-wise scatter
+        factor tables, preventing recalculation
     
         Parameters
         -----------
         atoms: ase.Atoms
             The atoms to which scatter factors are added
         """
-        if 'qbin' not in self.exp.keys():
-            self.exp['qbin'] = .1
-        n = len(atoms)
-        e_num = atoms.get_atomic_numbers()
-        e_set = set(e_num)
-        e_list = list(e_set)
-
-        for qbin, name in zip(
-                [self.exp['qbin'],
-                 self.pdf_qbin],
-                ['F(Q) scatter', 'PDF scatter']
-        ):
-            qmax_bin = int(math.floor(self.exp['qmax'] / qbin))
-            set_scatter_array = np.zeros((len(e_set), qmax_bin),
-                                         dtype=np.float32)
-
-            # Calculate the element-wise scatter factor array
-            get_scatter_array(set_scatter_array, e_num, self.exp['qbin'])
-            scatter_array = np.zeros((n, qmax_bin), dtype=np.float32)
-
-            # Disseminate the element wise scatter factors
-            for i in range(len(e_set)):
-                scatter_array[np.where(atoms.numbers == e_list[i])[0], :] = \
-                    set_scatter_array[i, :]
-
-            # Set the new scatter factor array
+        key = self._get_scatter_key(np.unique(atoms.get_atomic_numbers()))
+        # Warm the form factor cache, so the kernels only look up the tables
+        with stage('get_form_factor_table'):
+            get_form_factor_table(key[0], key[1], key[2])
+            get_form_factor_table(key[0], key[3], key[4])
+
+        # Remove any dense per atom scatter factors from older versions
+        for name in ['F(Q) scatter', 'PDF scatter']:
             if name in atoms.arrays.keys():
                 del atoms.arrays[name]
-            atoms.set_array(name, scatter_array)
+        atoms.info['scatter'] = key
         if self.verbose:
-            print(atoms.arrays.keys())
+            print(key[0])
 
         atoms.info['exp'] = self.exp
-        atoms.info['scatter_atoms'] = n
+
+    def check_wrap_atoms_state(self, atoms):
+        """
+        Check if the scatter factor key on the atoms is still valid, the
+        number of atoms may change as long as no new elements are added
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+
+        Returns
+        -------
+        bool:
+            True if the atoms do not need to be wrapped again
+        """
+        if self.wrap_atoms_state is None:
+            return False
+        if 'scatter' not in atoms.info.keys():
+            return False
+        key = atoms.info['scatter']
+        if atoms.info.get('exp') != self.exp or \
+                key[1:] != self._get_scatter_key(())[1:]:
+            return False
+        if not set(atoms.get_atomic_numbers().tolist()).issubset(key[0]):
+            return False
+        return True
 
     def _check_wrap_atoms_state(self, atoms):
         """
@@ -164,21 +236,7 @@ class ElasticScatter(object):
         -------
 
         """
-        t_value = True
-        if self.wrap_atoms_state is None:
-            if self.verbose:
-                print('wrap atoms state')
-            t_value = False
-        elif 'F(Q) scatter' not in atoms.arrays.keys() or \
-                        'PDF scatter' not in atoms.arrays.keys():
-            if self.verbose:
-                print('no FQ/PDF scatter factors')
-            t_value = False
-        elif atoms.info['exp'] != self.exp or atoms.info[
-            'scatter_atoms'] != len(atoms):
-            if self.verbose:
-                print('experiment does not match or number of atoms changed')
-            t_value = False
+        t_value = self.check_wrap_atoms_state(atoms)
         if not t_value:
             if self.verbose:
                 print('calculating new scatter factors')
@@ -220,10 +278,12 @@ class ElasticScatter(object):
 
         Parameters
         -----------
-        processor: ['MPI-GPU', 'Multi-GPU', 'Serial-CPU']
+        processor: ['MPI-GPU', 'Multi-GPU', 'CPU'] or any registered processor
             The processor to use
-        kernel_type: ['nxn', 'flat-serial', 'flat']
-            The type of algorithm to use
+        kernel_type: ['nxn', 'flat-serial', 'flat', 'flat-threaded',
+            'stream', 'auto'] or any registered kernel
+            The type of algorithm to use, with 'auto' the autotuner picks the
+            fastest kernel of the processor for each size of calculation
 
         Returns
         -------
@@ -236,78 +296,28 @@ class ElasticScatter(object):
         # Changing the processor invalidates the previous results
         if processor is None:
             # Test each processor in order of most advanced to least
-            for pro in self.avail_pro:
-                if self.set_processor(
-                        processor=pro, kernel_type=kernel_type) is not None:
-                    break
-
-        elif processor == self.avail_pro[0] and check_mpi() is True:
-            from pyiid.experiments.elasticscatter.mpi_wrappers.mpi_gpu_wrap \
-                import \
-                wrap_fq as multi_node_gpu_wrap_fq
-            from pyiid.experiments.elasticscatter.mpi_wrappers.mpi_gpu_wrap \
-                import \
-                wrap_fq_grad as multi_node_gpu_wrap_fq_grad
-
-            self.fq = multi_node_gpu_wrap_fq
-            self.grad = multi_node_gpu_wrap_fq_grad
-            self.processor = processor
-            return True
-
-        elif processor == self.avail_pro[1] and check_gpu() is True:
-            from pyiid.experiments.elasticscatter.gpu_wrappers.gpu_wrap import \
-                wrap_fq as flat_fq
-            from pyiid.experiments.elasticscatter.gpu_wrappers.gpu_wrap import \
-                wrap_fq_grad as flat_grad
-
-            self.fq = flat_fq
-            self.grad = flat_grad
-            self.alg = 'flat'
-            if check_cudafft():
-                from pyiid.experiments.elasticscatter.gpu_wrappers.gpu_wrap import \
-                    grad_pdf
-                self.grad_pdf = grad_pdf
-            else:
-                self.grad_pdf = cpu_grad_pdf
-            self.processor = processor
-            return True
-
-        elif processor == self.avail_pro[2]:
-            if kernel_type == 'nxn':
-                self.fq = cpu_wrap_fq
-                self.grad = cpu_wrap_fq_grad
-                self.alg = 'nxn'
-
-            elif kernel_type == 'flat':
-                from pyiid.experiments.elasticscatter.cpu_wrappers \
-                    .flat_multi_cpu_wrap import \
-                    wrap_fq, wrap_fq_grad
-
-                self.fq = wrap_fq
-                self.grad = wrap_fq_grad
-                self.alg = 'flat'
-
-            elif kernel_type == 'flat-serial':
-                from pyiid.experiments.elasticscatter.cpu_wrappers \
-                    .flat_serial_cpu_wrap import \
-                    wrap_fq, wrap_fq_grad
-
-                self.fq = wrap_fq
-                self.grad = wrap_fq_grad
-                self.alg = 'flat-serial'
-
-            self.grad_pdf = cpu_grad_pdf
-            self.processor = processor
-            return True
-
-    def check_wrap_atoms_state(self, atoms):
-        if self.wrap_atoms_state is None:
-            return False
-        if 'F(Q) scatter' not in atoms.arrays.keys():
-            return False
-        if atoms.info['exp'] != self.exp or \
-                        atoms.info['scatter_atoms'] != len(atoms):
-            return False
+            for pro in get_processors():
+                tf = self.set_processor(processor=pro,
+                                        kernel_type=kernel_type)
+                if tf is not None:
+                    return tf
+            return None
+
+        candidates = get_backends(
+            processor, None if kernel_type == 'auto' else kernel_type)
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            self.fq, self.grad, grad_pdf = candidates[0].load()
+            self.alg = candidates[0].kernel_type
+        else:
+            names = [b.name for b in candidates]
+            self.fq = AutoBackend(names, 'fq')
+            self.grad = AutoBackend(names, 'grad')
+            grad_pdf = None
+            self.alg = 'auto'
+        self.grad_pdf = grad_pdf if grad_pdf is not None else cpu_grad_pdf
+        self.processor = processor
         return True
 
     def get_fq(self, atoms, iq_std=None, noise_distribution=None):
@@ -332,6 +342,7 @@ class ElasticScatter(object):
         1darray:
             The reduced structure factor
         """
+        self._check_processor()
         if self.check_wrap_atoms_state(atoms) is False:
             if self.verbose:
                 print('calculating new scatter factors')
@@ -341,7 +352,7 @@ class ElasticScatter(object):
         fq = fq[int(np.floor(self.exp['qmin'] / self.exp['qbin'])):]
         if iq_std is not None:
             fq_std = iq_std * np.abs(self.get_scatter_vector()) / np.abs(
-                np.average(atoms.get_array('F(Q) scatter'), axis=0) ** 2)[int(
+                np.average(get_scatter_factors(atoms), axis=0) ** 2)[int(
                 np.floor(self.exp['qmin'] / self.exp['qbin'])):]
             if fq_std[0] == 0.0:
                 fq_std[0] += 1e-9  # added because we can't have zero noise
@@ -371,6 +382,7 @@ class ElasticScatter(object):
         1darray:
             The PDF
         """
+        self._check_processor()
         if self.check_wrap_atoms_state(atoms) is False:
             if self.verbose:
                 print('calculating new scatter factors')
@@ -379,8 +391,10 @@ class ElasticScatter(object):
         fq = self.fq(atoms, self.pdf_qbin, 'PDF')
         if iq_std is not None:
             a = np.abs(self.get_scatter_vector(pdf=True))
-            b = np.abs(np.average(atoms.get_array('PDF scatter') ** 2, axis=0))
+            b = np.abs(np.average(get_scatter_factors(atoms, 'pdf') ** 2,
+                                  axis=0))
             if hasattr(iq_std, 'shape') and iq_std.shape != a.shape:
+                from scipy.interpolate import griddata
                 iq_std = griddata(np.arange(0, iq_std.shape), iq_std,
                                   np.arange(
                                       a.shape))
@@ -390,15 +404,154 @@ class ElasticScatter(object):
             exp_noise = self.rs.normal(0, fq_noise)
             fq += exp_noise
         r = self.get_r()
-        pdf0 = get_pdf_at_qmin(
-            fq,
-            self.exp['rstep'],
-            self.pdf_qbin,
-            r,
-            self.exp['qmin']
-        )
+        with stage('get_pdf_at_qmin'):
+            pdf0 = get_pdf_at_qmin(
+                fq,
+                self.exp['rstep'],
+                self.pdf_qbin,
+                r,
+                self.exp['qmin']
+            )
         return pdf0
 
+    def _get_batches(self, configurations, numbers=None, frame_bytes=0):
+        """
+        Group configurations of the same atoms into batches which fit in the
+        memory budget
+
+        Parameters
+        ----------
+        configurations: list of ase.Atoms or MxNx3 array
+            The configurations
+        numbers: N array, optional
+            The atomic numbers shared by all the configurations, needed if
+            they are given as an array
+        frame_bytes: int
+            The bytes each configuration needs on top of its positions
+
+        Yields
+        ------
+        indices: list of int
+            The configurations in the batch
+        atoms: ase.Atoms
+            The atoms of the batch, wrapped
+        positions: MxNx3 array
+            The positions of each configuration
+        """
+        from ase.atoms import Atoms
+        from pyiid.experiments.elasticscatter.memory import get_memory_budget
+        if isinstance(configurations, np.ndarray):
+            if numbers is None:
+                raise ValueError('The atomic numbers are needed for an array '
+                                 'of positions')
+            groups = [(np.asarray(numbers), list(range(len(configurations))))]
+        else:
+            group_of = {}
+            groups = []
+            for i, atoms in enumerate(configurations):
+                key = tuple(atoms.numbers)
+                if key not in group_of:
+                    group_of[key] = len(groups)
+                    groups.append((atoms.numbers, []))
+                groups[group_of[key]][1].append(i)
+        budget = get_memory_budget() // 2
+        for group_numbers, indices in groups:
+            per_frame = 24 * len(group_numbers) + frame_bytes
+            size = max(int(budget // max(per_frame, 1)), 1)
+            for start in range(0, len(indices), size):
+                batch = indices[start:start + size]
+                if isinstance(configurations, np.ndarray):
+                    p = configurations[batch]
+                else:
+                    p = np.asarray([configurations[i].positions
+                                    for i in batch])
+                atoms = Atoms(numbers=group_numbers, positions=p[0])
+                self._wrap_atoms(atoms)
+                yield batch, atoms, p
+
+    def _get_fq_batch(self, positions, atoms, qbin, sum_type):
+        # The threaded kernel evaluates the whole batch at once, it is used
+        # when it was chosen or the autotuner picks the CPU kernel, any other
+        # backend gets one configuration at a time
+        if self.processor == 'CPU' and self.alg in ['flat-threaded', 'auto']:
+            from pyiid.experiments.elasticscatter.cpu_wrappers.\
+                flat_threaded_cpu_wrap import wrap_fq_batch
+            return wrap_fq_batch(positions, atoms, qbin, sum_type)
+        fq = []
+        for p in positions:
+            atoms.positions = p
+            fq.append(self.fq(atoms, qbin, sum_type))
+        return np.asarray(fq)
+
+    def get_fq_batch(self, configurations, numbers=None):
+        """
+        Calculate the reduced structure factor F(Q) of many configurations.
+        On the 'flat-threaded' CPU kernel, or if the CPU kernel is left to
+        the autotuner, the pairs of all the configurations are shared out
+        over the cores in one pass, other backends calculate the
+        configurations one at a time
+
+        Parameters
+        ----------
+        configurations: list of ase.Atoms or MxNx3 array
+            The configurations, as atoms or as the positions of atoms with
+            the same atomic numbers
+        numbers: N array, optional
+            The atomic numbers, needed if the configurations are an array
+
+        Returns
+        -------
+        MxQ array:
+            The reduced structure factor of each configuration
+        """
+        self._check_processor()
+        if not isinstance(configurations, np.ndarray):
+            configurations = list(configurations)
+        qbin = self.exp['qbin']
+        qmax_bin = int(math.floor(self.exp['qmax'] / qbin))
+        fq = np.zeros((len(configurations), qmax_bin), np.float32)
+        for batch, atoms, positions in self._get_batches(
+                configurations, numbers, 16 * qmax_bin):
+            fq[batch] = self._get_fq_batch(positions, atoms, qbin, 'fq')
+        return fq[:, int(np.floor(self.exp['qmin'] / qbin)):]
+
+    def get_pdf_batch(self, configurations, numbers=None):
+        """
+        Calculate the PDF, G(r), of many configurations, their transforms
+        are made as one FFT.  The F(Q) are calculated as in `get_fq_batch`
+
+        Parameters
+        ----------
+        configurations: list of ase.Atoms or MxNx3 array
+            The configurations, as atoms or as the positions of atoms with
+            the same atomic numbers
+        numbers: N array, optional
+            The atomic numbers, needed if the configurations are an array
+
+        Returns
+        -------
+        MxR array:
+            The PDF of each configuration
+        """
+        from pyiid.cost import get_fft_length
+        self._check_processor()
+        if not isinstance(configurations, np.ndarray):
+            configurations = list(configurations)
+        qmax_bin = int(math.floor(self.exp['qmax'] / self.pdf_qbin))
+        r = self.get_r()
+        # the padded transform, real and complex, of each configuration
+        fft_length = get_fft_length(qmax_bin, self.exp['rstep'],
+                                    self.pdf_qbin, self.exp['qmin'])
+        pdf = np.zeros((len(configurations), len(r)))
+        for batch, atoms, positions in self._get_batches(
+                configurations, numbers, 16 * qmax_bin + 24 * fft_length):
+            fq = self._get_fq_batch(positions, atoms, self.pdf_qbin, 'PDF')
+            with stage('get_pdf_at_qmin'):
+                p = get_pdf_at_qmin_batch(fq, self.exp['rstep'],
+                                          self.pdf_qbin, r, self.exp['qmin'])
+            pdf[batch] = p
+        return pdf
+
     def get_sq(self, atoms, iq_std=None, noise_distribution=np.random.normal):
         """
         Calculate the structure factor S(Q)
@@ -450,11 +603,11 @@ class ElasticScatter(object):
             The scattering intensity
         """
         sq = self.get_sq(atoms, iq_std, noise_distribution)
-        f2 = np.average(atoms.get_array('F(Q) scatter'), axis=0) ** 2
+        f2 = np.average(get_scatter_factors(atoms), axis=0) ** 2
         iq = sq * f2[int(np.floor(self.exp['qmin'] / self.exp['qbin'])):]
         return iq
 
-    def get_2d_scatter(self, atoms, pixel_array):
+    def get_2d_scatter(self, atoms, pixel_array, interpolate=False):
         """
         Calculate the scattering intensity as projected onto a detector
 
@@ -465,23 +618,24 @@ class ElasticScatter(object):
         pixel_array: 2darray
             A map from Q to the xy coordinates of the detector, each element
             has a Q value
+        interpolate: bool
+            Interpolate I(Q) linearly between the bin centers rather than
+            give each pixel the intensity of the bin it falls in
         Returns
         -------
         2darray:
             The scattering intensity on the detector
         """
-
+        from pyiid.experiments.elasticscatter.detector import \
+            detector_map_cache
         iq = self.get_iq(atoms)
         s = self.get_scatter_vector()
-        qb = self.exp['qbin']
-        final_shape = pixel_array.shape
-        fp = pixel_array.ravel()
-        img = np.zeros(fp.shape)
-        for sub_s, i in zip(s, iq):
-            c = np.intersect1d(np.where(sub_s - qb / 2. < fp)[0],
-                               np.where(sub_s + qb / 2. > fp)[0])
-            img[c] = i
-        return img.reshape(final_shape)
+        s = s[:len(iq)]
+        # the pixel to bin map is kept for the next frame on this detector
+        with stage('get_detector_map'):
+            detector_map = detector_map_cache.get(
+                pixel_array, s, self.exp['qbin'], interpolate)
+        return detector_map.project(iq)
 
     def get_grad_fq(self, atoms):
         """
@@ -496,6 +650,7 @@ class ElasticScatter(object):
         3darray:
             The gradient of the reduced structure factor
         """
+        self._check_processor()
         if self.check_wrap_atoms_state(atoms) is False:
             if self.verbose:
                 print('calculating new scatter factors')
@@ -517,6 +672,7 @@ class ElasticScatter(object):
         3darray:
             The gradient of the PDF
         """
+        self._check_processor()
         if self.check_wrap_atoms_state(atoms) is False:
             if self.verbose:
                 print('calculating new scatter factors')
@@ -527,9 +683,9 @@ class ElasticScatter(object):
         fq_grad[:, :, :qmin_bin] = 0.
         rgrid = self.get_r()
 
-        pdf_grad = self.grad_pdf(fq_grad, self.exp['rstep'], self.pdf_qbin,
-                                 rgrid,
-                                 self.exp['qmin'])
+        with stage('grad_pdf'):
+            pdf_grad = self.grad_pdf(fq_grad, self.exp['rstep'],
+                                     self.pdf_qbin, rgrid, self.exp['qmin'])
         return pdf_grad
 
     def get_scatter_vector(self, pdf=False):
@@ -1,4 +1,5 @@
 import numpy as np
+from pyiid.experiments.shared.scatter_factors import get_form_factor_table
 
 __author__ = 'christopher'
 
@@ -10,3 +11,80 @@ def pad_pdf(pdf, rmin, rmax, rstep):
     padded2 = np.zeros(len(padded) + int(np.ceil(rmax / rstep)))
     padded2[:len(padded)] = padded
     return padded2
+
+
+def get_scatter_tables(atoms, sum_type='fq'):
+    """
+    Get the compact scatter factor storage of the atoms, an element index
+    for each atom and a table of scatter factors for each element
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration, wrapped by `ElasticScatter`
+    sum_type: {'fq', 'pdf'}
+        Which scatter factors to get
+
+    Returns
+    -------
+    index: N int32 array
+        The row of the table for each atom
+    table: ExQ float32 array
+        The scatter factors of each element
+    """
+    elements, qbin, qmax_bin, pdf_qbin, pdf_qmax_bin = atoms.info['scatter']
+    if sum_type == 'fq':
+        table = get_form_factor_table(elements, qbin, qmax_bin)
+    else:
+        table = get_form_factor_table(elements, pdf_qbin, pdf_qmax_bin)
+    index = np.searchsorted(elements, atoms.numbers).astype(np.int32)
+    return index, table
+
+
+def get_scatter_factors(atoms, sum_type='fq'):
+    """
+    Get the NxQ scatter factors of the atoms, for kernels which do not read
+    the compact storage
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration, wrapped by `ElasticScatter`
+    sum_type: {'fq', 'pdf'}
+        Which scatter factors to get
+
+    Returns
+    -------
+    NxQ float32 array:
+        The scatter factors
+    """
+    index, table = get_scatter_tables(atoms, sum_type)
+    return table[index]
+
+
+def get_pair_scatter_average(index, table):
+    """
+    The average of f_i * f_j over the unique pairs, this is the F(Q)
+    normalization, computed from the element counts in O(E Q) instead of
+    over all the pairs
+
+    Parameters
+    ----------
+    index: N array
+        The row of the table for each atom
+    table: ExQ array
+        The scatter factors of each element
+
+    Returns
+    -------
+    Q float32 array:
+        The average
+    """
+    n = len(index)
+    counts = np.bincount(index, minlength=len(table)).astype(np.float64)
+    f_sum = np.dot(counts, table)
+    f2_sum = np.dot(counts, table.astype(np.float64) ** 2)
+    old_settings = np.seterr(all='ignore')
+    ave = (f_sum ** 2 - f2_sum) / (n * (n - 1))
+    np.seterr(**old_settings)
+    return ave.astype(np.float32)
@@ -58,8 +58,9 @@ def k_space_grad_fq_allocation(n, qmax_bin, mem):
 
 
 def atomic_fq(task):
-    q, adps, scatter_array, qbin, k_max, k_cov = task
-    n, qmax_bin = scatter_array.shape
+    q, adps, index, table, qbin, k_max, k_cov = task
+    n = len(index)
+    qmax_bin = table.shape[1]
 
     d = np.zeros((k_max, 3), np.float32)
     get_d_array(d, q, k_cov)
@@ -68,25 +69,26 @@ def atomic_fq(task):
     get_r_array(r, d)
 
     norm = np.zeros((k_max, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, k_cov)
+    get_element_normalization_array(norm, table, index, k_cov)
 
     omega = np.zeros((k_max, qmax_bin), np.float32)
     get_omega(omega, r, qbin)
     fq = np.zeros((k_max, qmax_bin), np.float32)
     get_fq(fq, omega, norm)
-    del q, d, scatter_array, norm, r, omega
+    del q, d, table, norm, r, omega
     return fq.sum(axis=0, dtype=np.float64)
 
 
 def atomic_grad_fq(task):
-    q, adps, scatter_array, qbin, k_max, k_cov = task
-    n, qmax_bin = scatter_array.shape
+    q, adps, index, table, qbin, k_max, k_cov = task
+    n = len(index)
+    qmax_bin = table.shape[1]
     d = np.empty((k_max, 3), np.float32)
     get_d_array(d, q, k_cov)
     r = np.empty(k_max, np.float32)
     get_r_array(r, d)
     norm = np.empty((k_max, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, k_cov)
+    get_element_normalization_array(norm, table, index, k_cov)
     omega = np.zeros((k_max, qmax_bin), np.float32)
     get_omega(omega, r, qbin)
     grad_omega = np.zeros((k_max, 3, qmax_bin), np.float32)
@@ -98,5 +100,5 @@ def atomic_grad_fq(task):
     rtn = np.zeros((n, 3, qmax_bin), np.float32)
     experimental_sum_grad_cpu(rtn, grad, k_cov)
 
-    del grad, q, scatter_array, omega, r, d, norm
+    del grad, q, table, omega, r, d, norm
     return rtn
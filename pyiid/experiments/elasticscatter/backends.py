@@ -0,0 +1,514 @@
+from __future__ import print_function
+
+"""
+The registry of the processor/kernel backends `ElasticScatter` can run on.
+
+A backend is a module with `wrap_fq(atoms, qbin, sum_type)` and
+`wrap_fq_grad(atoms, qbin, sum_type)`, new kernels join by calling
+`register_backend`, without changes to `ElasticScatter`.  When the 'auto'
+kernel type is asked for and the processor has more than one usable
+backend the `Autotuner` times them on the first call of each size class (number of
+atoms, Q bins and cores) and remembers the fastest in a file in the pyiid
+cache directory, so the choice is made once per machine.  Only the backends
+whose `fits` check passes for the memory budget are tried, and calculations
+bigger than `tune_max_work` are not timed, they run on the first of
+`untuned`.
+"""
+import os
+import json
+import time
+import math
+import importlib
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from pyiid.experiments.shared.cache_dir import get_cache_root
+from pyiid.experiments.elasticscatter.profiling import profiled
+
+__author__ = 'christopher'
+
+# The results of the hardware probes, these are slow (they load the CUDA
+# backends) and do not change during a run so they are done at most once
+_probes = {}
+
+
+def check_mpi():
+    # Test if MPI GPU is viable
+    # Currently no working MPI GPU implementation
+    return False
+
+
+def check_gpu():
+    """
+    Check if GPUs are available on this machine
+    """
+    if 'gpu' not in _probes:
+        try:
+            from accelerate import cuda
+            try:
+                cuda.cuda.gpus.lst
+                tf = True
+            except cuda.cuda.CudaSupportError:
+                tf = False
+        except ImportError:
+            tf = False
+        _probes['gpu'] = tf
+    return _probes['gpu']
+
+
+def check_cudafft():
+    if 'cudafft' not in _probes:
+        try:
+            from accelerate.cuda import fft as cufft
+            tf = True
+        except ImportError:
+            tf = False
+            print('no cudafft')
+        _probes['cudafft'] = tf
+    return _probes['cudafft']
+
+
+def get_gpu_grad_pdf():
+    # The cuFFT grad PDF if it is available
+    if check_cudafft():
+        from pyiid.experiments.elasticscatter.gpu_wrappers.gpu_wrap import \
+            grad_pdf
+        return grad_pdf
+    return None
+
+
+def fits_budget(byte_model):
+    """
+    A `Backend.fits` check from the peak bytes of a backend
+
+    Parameters
+    ----------
+    byte_model: callable
+        byte_model(kind, n, qmax_bin) gives the peak bytes of a calculation
+
+    Returns
+    -------
+    callable:
+        fits(kind, n, qmax_bin), True if the calculation is inside the memory
+        budget
+    """
+    def fits(kind, n, qmax_bin):
+        from pyiid.experiments.elasticscatter.memory import get_memory_budget
+        return byte_model(kind, n, qmax_bin) <= get_memory_budget()
+
+    return fits
+
+
+def nxn_model(kind, n, qmax_bin):
+    from pyiid.experiments.elasticscatter.memory import nxn_bytes
+    return nxn_bytes(kind, n, qmax_bin)
+
+
+def flat_serial_model(kind, n, qmax_bin):
+    from pyiid.experiments.elasticscatter.memory import flat_serial_bytes
+    return flat_serial_bytes(kind, n, qmax_bin)
+
+
+def threaded_model(kind, n, qmax_bin):
+    from pyiid.experiments.elasticscatter.cpu_wrappers\
+        .flat_threaded_cpu_wrap import get_bytes
+    return get_bytes(kind, n, qmax_bin)
+
+
+def flat_model(kind, n, qmax_bin):
+    # the plan of the flat backend, workers included
+    from pyiid.experiments.elasticscatter.memory import MemoryPlan
+    return MemoryPlan(kind, n, qmax_bin).report.predicted_peak
+
+
+def flat_fits(kind, n, qmax_bin):
+    # the flat backend chunks the pairs, it only fails if one pair does not
+    # fit in the budget
+    from pyiid.experiments.elasticscatter.memory import MemoryPlan
+    try:
+        MemoryPlan(kind, n, qmax_bin, processes=1)
+    except MemoryError:
+        return False
+    return True
+
+
+def stream_fits(kind, n, qmax_bin):
+    # the stream holds the total and at least one accumulator
+    from pyiid.experiments.elasticscatter.memory import get_memory_budget, \
+        threaded_bytes
+    return threaded_bytes(kind, n, qmax_bin, 1) <= get_memory_budget()
+
+
+class Backend(object):
+    """
+    A processor/kernel combination
+
+    Parameters
+    ----------
+    processor: str
+        The processor, eg. 'CPU'
+    kernel_type: str
+        The kernel, eg. 'flat'
+    module: str
+        The module holding `wrap_fq` and `wrap_fq_grad`, only imported when
+        the backend is used
+    available: callable, optional
+        Returns True if the backend can run on this machine
+    grad_pdf: callable, optional
+        Returns the grad PDF function for this backend, or None to use the
+        CPU one
+    fits: callable, optional
+        fits(kind, n, qmax_bin) returns False if an 'fq' or 'grad'
+        calculation of that size is too big for the backend, the autotuner
+        will not try it
+    nbytes: callable, optional
+        nbytes(kind, n, qmax_bin) gives the peak bytes of a calculation, the
+        byte model the backend plans its memory with
+    """
+
+    def __init__(self, processor, kernel_type, module, available=None,
+                 grad_pdf=None, fits=None, nbytes=None):
+        self.processor = processor
+        self.kernel_type = kernel_type
+        self.module = module
+        self.available = available
+        self.grad_pdf = grad_pdf
+        self.fits = fits
+        self.nbytes = nbytes
+
+    @property
+    def name(self):
+        return '{0}/{1}'.format(self.processor, self.kernel_type)
+
+    def is_available(self):
+        return self.available is None or bool(self.available())
+
+    def load(self):
+        """
+        Import the backend
+
+        Returns
+        -------
+        fq: callable
+            The F(Q) function
+        grad: callable
+            The grad F(Q) function
+        grad_pdf: callable or None
+            The grad PDF function, if the backend has its own
+        """
+        module = importlib.import_module(self.module)
+        grad_pdf = self.grad_pdf() if self.grad_pdf is not None else None
+        # marked so profiling records the stages under this backend
+        return profiled(self.name, module.wrap_fq), \
+            profiled(self.name, module.wrap_fq_grad), grad_pdf
+
+
+backends = OrderedDict()
+
+
+def register_backend(processor, kernel_type, module, available=None,
+                     grad_pdf=None, fits=None, nbytes=None):
+    """
+    Add a backend to the registry, processors are tried in the order they
+    were first registered
+
+    Parameters
+    ----------
+    processor: str
+        The processor, eg. 'CPU'
+    kernel_type: str
+        The kernel, eg. 'flat'
+    module: str
+        The module holding `wrap_fq` and `wrap_fq_grad`
+    available: callable, optional
+        Returns True if the backend can run on this machine
+    grad_pdf: callable, optional
+        Returns the grad PDF function for this backend
+    fits: callable, optional
+        fits(kind, n, qmax_bin) returns False if a calculation is too big for
+        the backend
+    nbytes: callable, optional
+        nbytes(kind, n, qmax_bin) gives the peak bytes of a calculation
+
+    Returns
+    -------
+    Backend:
+        The new backend
+    """
+    backend = Backend(processor, kernel_type, module, available, grad_pdf,
+                      fits, nbytes)
+    backends[(processor, kernel_type)] = backend
+    return backend
+
+
+def get_backend(processor, kernel_type):
+    return backends[(processor, kernel_type)]
+
+
+def get_processors():
+    """
+    The registered processors, from most advanced to least
+    """
+    processors = []
+    for processor, kernel_type in backends.keys():
+        if processor not in processors:
+            processors.append(processor)
+    return processors
+
+
+def get_backends(processor=None, kernel_type=None):
+    """
+    The registered backends which are available on this machine
+
+    Parameters
+    ----------
+    processor: str, optional
+        Only give backends for this processor
+    kernel_type: str, optional
+        Only give backends with this kernel
+
+    Returns
+    -------
+    list of Backend:
+        The backends
+    """
+    return [b for b in backends.values()
+            if (processor is None or b.processor == processor) and
+            (kernel_type is None or b.kernel_type == kernel_type) and
+            b.is_available()]
+
+
+register_backend('MPI-GPU', 'flat',
+                 'pyiid.experiments.elasticscatter.mpi_wrappers.mpi_gpu_wrap',
+                 available=check_mpi)
+register_backend('Multi-GPU', 'flat',
+                 'pyiid.experiments.elasticscatter.gpu_wrappers.gpu_wrap',
+                 available=check_gpu, grad_pdf=get_gpu_grad_pdf)
+register_backend('CPU', 'nxn',
+                 'pyiid.experiments.elasticscatter.cpu_wrappers.nxn_cpu_wrap',
+                 fits=fits_budget(nxn_model), nbytes=nxn_model)
+register_backend('CPU', 'flat-serial',
+                 'pyiid.experiments.elasticscatter.cpu_wrappers'
+                 '.flat_serial_cpu_wrap',
+                 fits=fits_budget(flat_serial_model),
+                 nbytes=flat_serial_model)
+register_backend('CPU', 'flat',
+                 'pyiid.experiments.elasticscatter.cpu_wrappers'
+                 '.flat_multi_cpu_wrap',
+                 fits=flat_fits, nbytes=flat_model)
+register_backend('CPU', 'flat-threaded',
+                 'pyiid.experiments.elasticscatter.cpu_wrappers'
+                 '.flat_threaded_cpu_wrap',
+                 fits=fits_budget(threaded_model),
+                 nbytes=threaded_model)
+register_backend('CPU', 'stream',
+                 'pyiid.experiments.elasticscatter.cpu_wrappers'
+                 '.stream_cpu_wrap',
+                 fits=stream_fits, nbytes=threaded_model)
+
+
+# The largest calculation the autotuner times every candidate on, in pairs
+# times Q bins (about 1400 atoms with 250 Q bins)
+tune_max_work = 2 ** 28
+# The backends used, in order of preference, for calculations too big to tune,
+# they plan their memory against the budget
+untuned = ['CPU/flat', 'CPU/stream']
+
+
+class Autotuner(object):
+    """
+    Pick the fastest backend for each size of calculation
+
+    Parameters
+    ----------
+    cache_file: str, optional
+        The file where the choices are kept, defaults to autotune.json in
+        the pyiid cache directory
+    persist: bool
+        Write the choices to the cache file
+    max_work: int, optional
+        The largest calculation which is timed, in pairs times Q bins,
+        defaults to `tune_max_work`.  Bigger calculations are not tuned, they
+        run on the first of `untuned` which is a candidate
+
+    >>> tuner = Autotuner(persist=False)
+    >>> tuner.get_key('fq', ['CPU/nxn', 'CPU/flat'], 100, 250)[-3:]
+    [128, 250, 'CPU/flat,CPU/nxn']
+    """
+
+    def __init__(self, cache_file=None, persist=True, max_work=None):
+        self.cache_file = cache_file
+        self.persist = persist
+        self.max_work = tune_max_work if max_work is None else max_work
+        self._table = None
+
+    def get_cache_file(self):
+        if self.cache_file is not None:
+            return self.cache_file
+        return os.path.join(get_cache_root(), 'autotune.json')
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = {}
+            f_name = self.get_cache_file()
+            if self.persist and os.path.exists(f_name):
+                try:
+                    with open(f_name, 'r') as f:
+                        self._table = json.load(f)
+                except (IOError, ValueError):
+                    self._table = {}
+        return self._table
+
+    @staticmethod
+    def get_key(kind, names, n, qmax_bin):
+        """
+        The size class of a calculation
+
+        Parameters
+        ----------
+        kind: {'fq', 'grad'}
+            The calculation
+        names: list of str
+            The candidate backends
+        n: int
+            The number of atoms, this is rounded up to a power of two
+        qmax_bin: int
+            The number of Q bins
+
+        Returns
+        -------
+        list:
+            The key
+        """
+        n_class = 2 ** int(math.ceil(math.log(max(n, 1), 2)))
+        return [kind, cpu_count(), n_class, int(qmax_bin),
+                ','.join(sorted(names))]
+
+    def lookup(self, key):
+        entry = self.table.get(json.dumps(key))
+        if entry is None:
+            return None
+        return entry['backend']
+
+    def record(self, key, name, times):
+        self.table[json.dumps(key)] = {'backend': name, 'times': times}
+        if not self.persist:
+            return
+        f_name = self.get_cache_file()
+        try:
+            if not os.path.exists(os.path.dirname(f_name)):
+                os.makedirs(os.path.dirname(f_name))
+            # write then move so readers never see a partial file
+            tmp = f_name + '.{0}.tmp'.format(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.table, f, indent=1, sort_keys=True)
+            os.rename(tmp, f_name)
+        except (IOError, OSError):
+            pass
+
+    def tune(self, kind, candidates, atoms, qbin, sum_type='fq'):
+        """
+        Time the candidate backends on a calculation
+
+        Parameters
+        ----------
+        kind: {'fq', 'grad'}
+            The calculation
+        candidates: list of Backend
+            The backends to try
+        atoms: ase.Atoms
+            The atomic configuration
+        qbin: float
+            The Q grid spacing
+        sum_type: {'fq', 'pdf'}
+            Which scatter factors to use
+
+        Returns
+        -------
+        name: str
+            The fastest backend
+        result: ndarray
+            The result of the calculation
+        times: dict
+            The time taken by each backend
+        """
+        idx = 0 if kind == 'fq' else 1
+        times = {}
+        result = None
+        # compile (or load) the kernels on a few atoms, so the compile time
+        # does not count against the first candidate
+        small = atoms[:min(len(atoms), 4)]
+        for backend in candidates:
+            f = backend.load()[idx]
+            f(small, qbin, sum_type)
+            t0 = time.time()
+            r = f(atoms, qbin, sum_type)
+            times[backend.name] = time.time() - t0
+            if result is None:
+                result = r
+        name = min(times, key=times.get)
+        return name, result, times
+
+
+autotuner = Autotuner()
+
+
+class AutoBackend(object):
+    """
+    Run each calculation on the backend the autotuner picks for its size
+
+    Parameters
+    ----------
+    names: list of str
+        The candidate backends, as processor/kernel_type
+    kind: {'fq', 'grad'}
+        The calculation
+    """
+
+    def __init__(self, names, kind):
+        self.names = list(names)
+        self.kind = kind
+
+    def get_candidates(self, n, qmax_bin):
+        candidates = []
+        for name in self.names:
+            backend = get_backend(*name.split('/', 1))
+            if backend.fits is None or backend.fits(self.kind, n, qmax_bin):
+                candidates.append(backend)
+        if not candidates:
+            raise MemoryError(
+                'None of {0} fit a {1} calculation of {2} atoms and {3} Q '
+                'bins in the memory budget'.format(', '.join(self.names),
+                                                   self.kind, n, qmax_bin))
+        return candidates
+
+    @staticmethod
+    def get_untuned(candidates):
+        # the first preferred backend, or the first candidate
+        names = [b.name for b in candidates]
+        for name in untuned:
+            if name in names:
+                return candidates[names.index(name)]
+        return candidates[0]
+
+    def __call__(self, atoms, qbin=.1, sum_type='fq'):
+        n = len(atoms)
+        qmax_bin = int(math.floor(atoms.info['exp']['qmax'] / qbin))
+        candidates = self.get_candidates(n, qmax_bin)
+        if len(candidates) > 1 and \
+                n * (n - 1) // 2 * qmax_bin > autotuner.max_work:
+            candidates = [self.get_untuned(candidates)]
+        if len(candidates) == 1:
+            return candidates[0].load()[0 if self.kind == 'fq' else 1](
+                atoms, qbin, sum_type)
+        key = autotuner.get_key(self.kind, [b.name for b in candidates],
+                                n, qmax_bin)
+        name = autotuner.lookup(key)
+        if name is None:
+            name, result, times = autotuner.tune(self.kind, candidates, atoms,
+                                                 qbin, sum_type)
+            autotuner.record(key, name, times)
+            return result
+        backend = get_backend(*name.split('/', 1))
+        return backend.load()[0 if self.kind == 'fq' else 1](atoms, qbin,
+                                                              sum_type)
@@ -1,7 +1,11 @@
 from __future__ import print_function
-from multiprocessing import Pool, cpu_count
-import psutil
 from pyiid.experiments.elasticscatter.atomics.cpu_atomics import *
+from pyiid.experiments.elasticscatter.atomics import get_scatter_tables, \
+    get_pair_scatter_average
+from pyiid.experiments.elasticscatter.memory import MemoryPlan, \
+    measure_task, warm_up, reports
+from pyiid.experiments.elasticscatter.profiling import stage
+from pyiid.experiments.shared.pool import Pool
 
 __author__ = 'christopher'
 
@@ -10,13 +14,10 @@ def setup_cpu_calc(atoms, sum_type):
     # atoms info
     q = atoms.get_positions()
     q = q.astype(np.float32)
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter').astype(np.float32)
-    else:
-        scatter_array = atoms.get_array('PDF scatter').astype(np.float32)
-    n, qmax_bin = scatter_array.shape
-    return q.astype(np.float32), None, n, qmax_bin, scatter_array.astype(
-        np.float32)
+    index, table = get_scatter_tables(atoms, sum_type)
+    n = len(index)
+    qmax_bin = table.shape[1]
+    return q.astype(np.float32), None, n, qmax_bin, index, table
 
 
 def wrap_fq(atoms, qbin=.1, sum_type='fq'):
@@ -37,26 +38,21 @@ def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     fq:1darray
         The reduced structure function
     """
-    q, adps, n, qmax_bin, scatter_array = setup_cpu_calc(atoms, sum_type)
-    k_max = int((n ** 2 - n) / 2.)
-    allocation = cpu_k_space_fq_allocation
-
-    master_task = [q, adps, scatter_array, qbin]
-
-    ans = cpu_multiprocessing(atomic_fq, allocation, master_task,
-                              (n, qmax_bin))
+    q, adps, n, qmax_bin, index, table = setup_cpu_calc(atoms, sum_type)
+    k_max = n * (n - 1) // 2
+    if k_max == 0:
+        return np.zeros(qmax_bin, np.float32)
+    plan = MemoryPlan('fq', n, qmax_bin, len(table))
+    master_task = [q, adps, index, table, qbin]
+    ans = cpu_multiprocessing(atomic_fq, plan, master_task)
 
-    # sum the answers
-    final = np.sum(ans, axis=0, dtype=np.float64)
-    final = final.astype(np.float32)
-    norm = np.empty((k_max, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, 0)
-    na = np.mean(norm, axis=0, dtype=np.float32) * np.float32(n)
+    final = ans.astype(np.float32)
+    na = get_pair_scatter_average(index, table) * np.float32(n)
     # na = np.mean(norm, axis=0, dtype=np.float64) * n
     old_settings = np.seterr(all='ignore')
     final = np.nan_to_num(final / na)
     np.seterr(**old_settings)
-    del q, n, qmax_bin, scatter_array, k_max, ans
+    del q, n, qmax_bin, index, table, k_max, ans
     return 2 * final
 
 
@@ -80,58 +76,69 @@ def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
         The reduced structure function gradient
     """
     # setup variables of interest
-    q, adps, n, qmax_bin, scatter_array = setup_cpu_calc(atoms, sum_type)
-    k_max = int((n ** 2 - n) / 2.)
+    q, adps, n, qmax_bin, index, table = setup_cpu_calc(atoms, sum_type)
+    k_max = n * (n - 1) // 2
     if k_max == 0:
         return np.zeros((n, 3, qmax_bin)).astype(np.float32)
-    allocation = k_space_grad_fq_allocation
-    master_task = [q, adps, scatter_array, qbin]
-    ans = cpu_multiprocessing(atomic_grad_fq, allocation, master_task,
-                              (n, qmax_bin))
-    # sum the answers
-    # print ans
-    grad_p = np.sum(ans, axis=0)
-    # print grad_p.shape
-    norm = np.empty((k_max, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, 0)
-    na = np.mean(norm, axis=0) * n
+    plan = MemoryPlan('grad', n, qmax_bin, len(table))
+    master_task = [q, adps, index, table, qbin]
+    ans = cpu_multiprocessing(atomic_grad_fq, plan, master_task)
+    grad_p = ans.astype(np.float32)
+    na = get_pair_scatter_average(index, table) * np.float32(n)
     old_settings = np.seterr(all='ignore')
     grad_p = np.nan_to_num(grad_p / na)
     np.seterr(**old_settings)
-    del q, n, qmax_bin, scatter_array, k_max, ans
+    del q, n, qmax_bin, index, table, k_max, ans
     return grad_p
 
 
-def cpu_multiprocessing(atomic_function, allocation,
-                        master_task, constants):
-    # print atomic_function, allocation, master_task, constants
-    n, qmax_bin = constants
-    k_max = int((n ** 2 - n) / 2.)
-    # TODO: what if n is 1 kmax = 0???
-    # break up problem
-    pool_size = cpu_count()
-    if pool_size <= 0:
-        pool_size = 1
-    p = Pool(pool_size, maxtasksperchild=1)
-    tasks = []
-    k_cov = 0
-    # print k_max
-    while k_cov < k_max:
-        # print type(allocation)
-        m = allocation(n, qmax_bin, float(
-            psutil.virtual_memory().available) / pool_size)
-        if m > k_max - k_cov:
-            m = k_max - k_cov
-        # print m, k_cov
-        sub_task = tuple(master_task + [m, k_cov])
-        tasks.append(sub_task)
-        k_cov += m
-    # multiprocessing map problem
-    # print k_cov
-    ans = p.map(atomic_function, tasks)
-    p.close()
-    # print ans
-    return ans
+def cpu_multiprocessing(atomic_function, plan, master_task):
+    """
+    Run a flat calculation over the pairs in chunks on a process pool
+
+    Parameters
+    ----------
+    atomic_function: callable
+        Calculates the answer for one chunk
+    plan: MemoryPlan
+        The chunks and number of processes, the observed peak memory is
+        added to its report
+    master_task: list
+        The arguments shared by all the chunks
+
+    Returns
+    -------
+    ndarray:
+        The sum of the chunk answers, in float64
+    """
+    tasks = ((atomic_function, tuple(master_task + [size, k_cov]))
+             for size, k_cov in plan.chunks)
+    # each worker runs one pair first so the compiler does not count
+    # against the chunk
+    with stage('pool'):
+        p = Pool(plan.processes, warm_up, (atomic_function,
+                                           tuple(master_task + [1, 0])),
+                 maxtasksperchild=1)
+    # the answers are summed in order as they arrive rather than kept, so
+    # the grad does not hold an Nx3xQ array per chunk
+    total = None
+    try:
+        # the wait for the workers, including pickling the tasks and answers
+        with stage('workers'):
+            for ans, peak in p.imap(measure_task, tasks):
+                plan.observe_worker(peak)
+                with stage('sum'):
+                    if total is None:
+                        total = ans.astype(np.float64)
+                    else:
+                        total += ans
+                plan.observe_parent(total.nbytes + ans.nbytes)
+    finally:
+        with stage('pool'):
+            p.close()
+            p.join()
+    reports.append(plan.report)
+    return total
 
 
 if __name__ == '__main__':
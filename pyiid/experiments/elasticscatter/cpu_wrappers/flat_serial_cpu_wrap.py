@@ -6,10 +6,17 @@ from pyiid.experiments.elasticscatter.kernels.cpu_experimental import \
 
 from pyiid.experiments.elasticscatter.kernels import antisymmetric_reshape, \
     symmetric_reshape
+from pyiid.experiments.elasticscatter.atomics import get_scatter_tables, \
+    get_pair_scatter_average
+from pyiid.experiments.shared import get_flat_geometry
+from pyiid.experiments.elasticscatter.profiling import stage
+from pyiid.experiments.elasticscatter.memory import planned, \
+    flat_serial_bytes
 
 __author__ = 'christopher'
 
 
+@planned('fq', flat_serial_bytes)
 def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     """
     Generate the reduced structure function
@@ -30,37 +37,36 @@ def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     """
     q = atoms.get_positions().astype(np.float32)
 
-    # get scatter array
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter')
-    else:
-        scatter_array = atoms.get_array('PDF scatter')
+    # get the element scatter factors and each atom's element
+    index, table = get_scatter_tables(atoms, sum_type)
     # define scatter_q information and initialize constants
 
-    n, qmax_bin = scatter_array.shape
-    k_max = int(n * (n - 1) / 2.)
-    k_cov = i4(0)
-
-    d = np.zeros((k_max, 3), np.float32)
-    get_d_array(d, q, k_cov)
+    n = len(index)
+    qmax_bin = table.shape[1]
+    k_max = n * (n - 1) // 2
+    k_cov = 0
 
-    r = np.zeros(k_max, np.float32)
-    get_r_array(r, d)
+    with stage('get_flat_geometry'):
+        d, r = get_flat_geometry(atoms)
 
-    norm = np.zeros((k_max, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, k_cov)
+    with stage('get_element_normalization_array'):
+        norm = np.zeros((k_max, qmax_bin), np.float32)
+        get_element_normalization_array(norm, table, index, k_cov)
 
-    omega = np.zeros((k_max, qmax_bin), np.float32)
-    get_omega(omega, r, qbin)
+    with stage('get_omega'):
+        omega = np.zeros((k_max, qmax_bin), np.float32)
+        get_omega(omega, r, qbin)
 
-    get_fq_inplace(omega, norm)
+    with stage('get_fq_inplace'):
+        get_fq_inplace(omega, norm)
     fq = omega
     # Normalize fq
     # '''
     # fq = np.sum(fq, axis=0, dtype=np.float32)
-    fq = np.sum(fq, axis=0, dtype=np.float64)
+    with stage('sum'):
+        fq = np.sum(fq, axis=0, dtype=np.float64)
     fq = fq.astype(np.float32)
-    na = np.mean(norm, axis=0, dtype=np.float32) * np.float32(n)
+    na = get_pair_scatter_average(index, table) * np.float32(n)
     # na = np.mean(norm, axis=0, dtype=np.float64) * n
     old_settings = np.seterr(all='ignore')
     fq = np.nan_to_num(fq / na)
@@ -69,6 +75,7 @@ def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     return fq * 2.
 
 
+@planned('grad', flat_serial_bytes)
 def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
     """
     Generate the reduced structure function gradient
@@ -91,43 +98,42 @@ def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
     q = atoms.get_positions().astype(np.float32)
     qbin = np.float32(qbin)
 
-    # get scatter array
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter')
-    else:
-        scatter_array = atoms.get_array('PDF scatter')
+    # get the element scatter factors and each atom's element
+    index, table = get_scatter_tables(atoms, sum_type)
 
     # define scatter_q information and initialize constants
-    qmax_bin = scatter_array.shape[1]
+    qmax_bin = table.shape[1]
     n = len(q)
-    k_max = int(n * (n - 1) / 2.)
+    k_max = n * (n - 1) // 2
     k_cov = 0
 
-    d = np.empty((k_max, 3), np.float32)
-    get_d_array(d, q, k_cov)
-
-    r = np.empty(k_max, np.float32)
-    get_r_array(r, d)
+    with stage('get_flat_geometry'):
+        d, r = get_flat_geometry(atoms)
 
-    norm = np.empty((k_max, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, k_cov)
+    with stage('get_element_normalization_array'):
+        norm = np.empty((k_max, qmax_bin), np.float32)
+        get_element_normalization_array(norm, table, index, k_cov)
 
-    omega = np.zeros((k_max, qmax_bin), np.float32)
-    get_omega(omega, r, qbin)
+    with stage('get_omega'):
+        omega = np.zeros((k_max, qmax_bin), np.float32)
+        get_omega(omega, r, qbin)
 
-    grad_omega = np.zeros((k_max, 3, qmax_bin), np.float32)
-    get_grad_omega(grad_omega, omega, r, d, qbin)
+    with stage('get_grad_omega'):
+        grad_omega = np.zeros((k_max, 3, qmax_bin), np.float32)
+        get_grad_omega(grad_omega, omega, r, d, qbin)
 
-    get_grad_fq_inplace(grad_omega, norm)
+    with stage('get_grad_fq_inplace'):
+        get_grad_fq_inplace(grad_omega, norm)
     grad = grad_omega
 
-    rtn = np.zeros((n, 3, qmax_bin), np.float32)
-    experimental_sum_grad_cpu(rtn, grad, k_cov)
+    with stage('sum'):
+        rtn = np.zeros((n, 3, qmax_bin), np.float32)
+        experimental_sum_grad_cpu(rtn, grad, k_cov)
     # '''
     # Normalize FQ
-    na = np.mean(norm, axis=0) * np.float32(n)
+    na = get_pair_scatter_average(index, table) * np.float32(n)
     old_settings = np.seterr(all='ignore')
     rtn = np.nan_to_num(rtn / na)
     np.seterr(**old_settings)
-    del d, r, scatter_array, norm, omega, grad_omega
+    del d, r, table, norm, omega, grad_omega
     return rtn
@@ -0,0 +1,274 @@
+import os
+import math
+import numpy as np
+import numba
+
+from pyiid.experiments.elasticscatter.kernels.cpu_threaded import \
+    get_fq_blocks, get_grad_fq_blocks, get_histogram_blocks, get_tiles, \
+    get_tile_blocks, get_fq_batch_blocks
+from pyiid.experiments.elasticscatter.atomics import get_scatter_tables, \
+    get_pair_scatter_average
+from pyiid.experiments.elasticscatter.profiling import stage
+from pyiid.experiments.elasticscatter.memory import planned, \
+    threaded_bytes, get_memory_budget
+
+__author__ = 'christopher'
+
+# The number of threads, None uses the numba default (NUMBA_NUM_THREADS or
+# the number of cores), can also be set with PYIID_NUM_THREADS
+num_threads = None
+if os.getenv('PYIID_NUM_THREADS'):
+    num_threads = int(os.getenv('PYIID_NUM_THREADS'))
+
+
+def set_num_threads(n):
+    """
+    Set the number of threads used by the threaded kernels
+
+    Parameters
+    ----------
+    n: int or None
+        The number of threads, None for the numba default
+    """
+    global num_threads
+    num_threads = n
+
+
+def get_num_threads():
+    if num_threads is None:
+        return numba.config.NUMBA_NUM_THREADS
+    return min(num_threads, numba.config.NUMBA_NUM_THREADS)
+
+
+# The cache the tiles are sized for, the j rows of the gradient (3xQ float32
+# per atom) of a tile should fit in it
+cache_bytes = 256 * 1024
+
+
+def get_tile_size(qmax_bin):
+    """
+    The number of atoms on each side of a tile
+
+    Parameters
+    ----------
+    qmax_bin: int
+        The number of Q bins
+
+    Returns
+    -------
+    int:
+        The tile size
+
+    >>> get_tile_size(250)
+    87
+    """
+    return int(min(max(cache_bytes // (12 * max(qmax_bin, 1)), 16), 1024))
+
+
+def get_grad_blocks(n, qmax_bin):
+    """
+    The number of blocks of a gradient, one per thread unless their Nx3xQ
+    accumulators do not fit in the memory budget
+
+    Parameters
+    ----------
+    n: int
+        The number of atoms
+    qmax_bin: int
+        The number of Q bins
+
+    Returns
+    -------
+    int:
+        The number of blocks, at least one
+    """
+    budget = get_memory_budget()
+    blocks = get_num_threads()
+    while blocks > 1 and threaded_bytes('grad', n, qmax_bin, blocks) > budget:
+        blocks -= 1
+    return blocks
+
+
+def get_bytes(kind, n, qmax_bin):
+    """
+    The peak bytes of a calculation, see `threaded_bytes`
+    """
+    if kind == 'fq':
+        return threaded_bytes(kind, n, qmax_bin, get_num_threads())
+    return threaded_bytes(kind, n, qmax_bin, get_grad_blocks(n, qmax_bin))
+
+
+def _get_layout(atoms, qmax_bin, n_blocks):
+    # the positions as 3xN, so the j loop reads contiguous coordinates
+    qt = np.ascontiguousarray(atoms.get_positions().T, np.float32)
+    tiles = get_tiles(len(atoms), get_tile_size(qmax_bin))
+    starts = get_tile_blocks(tiles, n_blocks)
+    return qt, tiles, starts
+
+
+@planned('fq', get_bytes)
+def wrap_fq(atoms, qbin=.1, sum_type='fq'):
+    """
+    Generate the reduced structure function
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    qbin: float
+        The size of the scatter vector increment
+    sum_type: {'fq', 'pdf'}
+        Which scatter array should be used for the calculation
+
+    Returns
+    -------
+    fq:1darray
+        The reduced structure function
+    """
+    index, table = get_scatter_tables(atoms, sum_type)
+    n = len(index)
+    qmax_bin = table.shape[1]
+
+    threads = get_num_threads()
+    numba.set_num_threads(threads)
+    # a few blocks per thread keeps the threads busy, the blocks are small
+    with stage('layout'):
+        qt, tiles, starts = _get_layout(atoms, qmax_bin, 4 * threads)
+    with stage('get_fq_blocks'):
+        fq = np.zeros((len(starts) - 1, qmax_bin), np.float64)
+        get_fq_blocks(fq, qt, table, index, np.float32(qbin), tiles, starts)
+    with stage('sum'):
+        fq = np.sum(fq, axis=0).astype(np.float32)
+
+    na = get_pair_scatter_average(index, table) * np.float32(n)
+    old_settings = np.seterr(all='ignore')
+    fq = np.nan_to_num(fq / na)
+    np.seterr(**old_settings)
+    return fq * 2.
+
+
+def wrap_fq_batch(positions, atoms, qbin=.1, sum_type='fq'):
+    """
+    Generate the reduced structure functions of many configurations of the
+    same atoms in one pass over the threads
+
+    Parameters
+    ----------
+    positions: MxNx3 array
+        The atomic positions of each configuration
+    atoms: ase.Atoms
+        The atoms, wrapped by `ElasticScatter`, only the atomic numbers and
+        scatter factors are used
+    qbin: float
+        The size of the scatter vector increment
+    sum_type: {'fq', 'pdf'}
+        Which scatter array should be used for the calculation
+
+    Returns
+    -------
+    fq: MxQ array
+        The reduced structure function of each configuration
+    """
+    index, table = get_scatter_tables(atoms, sum_type)
+    m, n = positions.shape[:2]
+    qmax_bin = table.shape[1]
+
+    threads = get_num_threads()
+    numba.set_num_threads(threads)
+    with stage('layout'):
+        qt = np.ascontiguousarray(np.transpose(positions, (0, 2, 1)),
+                                  np.float32)
+        tiles = get_tiles(n, get_tile_size(qmax_bin))
+        # the configurations already keep the threads busy, only split them
+        # into blocks if there are fewer of them than threads
+        starts = get_tile_blocks(tiles, -(-4 * threads // max(m, 1)))
+    with stage('get_fq_batch_blocks'):
+        fq = np.zeros((m, len(starts) - 1, qmax_bin), np.float64)
+        get_fq_batch_blocks(fq, qt, table, index, np.float32(qbin), tiles,
+                            starts)
+    with stage('sum'):
+        fq = np.sum(fq, axis=1).astype(np.float32)
+
+    na = get_pair_scatter_average(index, table) * np.float32(n)
+    old_settings = np.seterr(all='ignore')
+    fq = np.nan_to_num(fq / na)
+    np.seterr(**old_settings)
+    return fq * 2.
+
+
+@planned('grad', get_bytes)
+def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
+    """
+    Generate the reduced structure function gradient
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    qbin: float
+        The size of the scatter vector increment
+    sum_type: {'fq', 'pdf'}
+        Which scatter array should be used for the calculation
+
+    Returns
+    -------
+
+    dfq_dq:ndarray
+        The reduced structure function gradient
+    """
+    index, table = get_scatter_tables(atoms, sum_type)
+    n = len(index)
+    qmax_bin = table.shape[1]
+
+    threads = get_num_threads()
+    numba.set_num_threads(threads)
+    # one Nx3xQ accumulator per block
+    with stage('layout'):
+        qt, tiles, starts = _get_layout(atoms, qmax_bin,
+                                        get_grad_blocks(n, qmax_bin))
+    with stage('get_grad_fq_blocks'):
+        grad = np.zeros((len(starts) - 1, n, 3, qmax_bin), np.float32)
+        get_grad_fq_blocks(grad, qt, table, index, np.float32(qbin), tiles,
+                           starts)
+    with stage('sum'):
+        grad = np.sum(grad, axis=0)
+
+    na = get_pair_scatter_average(index, table) * np.float32(n)
+    old_settings = np.seterr(all='ignore')
+    grad = np.nan_to_num(grad / na)
+    np.seterr(**old_settings)
+    return grad
+
+
+def get_pair_histogram(atoms, rstep=.01, rmax=40.):
+    """
+    Histogram the pair distances by element pair
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    rstep: float
+        The width of the distance bins
+    rmax: float
+        The largest distance counted
+
+    Returns
+    -------
+    elements: E array
+        The atomic numbers present
+    hist: ExExR array
+        The number of pairs in each distance bin, the pairs of elements
+        a, b are counted once, in hist[max(a, b), min(a, b)]
+    """
+    elements, index = np.unique(atoms.numbers, return_inverse=True)
+    index = index.astype(np.int32)
+    threads = get_num_threads()
+    numba.set_num_threads(threads)
+    qt = np.ascontiguousarray(atoms.get_positions().T, np.float32)
+    tiles = get_tiles(len(atoms), get_tile_size(0))
+    starts = get_tile_blocks(tiles, threads)
+    hist = np.zeros((len(starts) - 1, len(elements), len(elements),
+                     int(math.ceil(rmax / rstep))), np.int64)
+    get_histogram_blocks(hist, qt, index, np.float32(rstep), tiles, starts)
+    return elements, np.sum(hist, axis=0)
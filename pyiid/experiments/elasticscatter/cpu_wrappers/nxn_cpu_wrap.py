@@ -1,11 +1,15 @@
 import numpy as np
 from pyiid.experiments.elasticscatter.kernels.cpu_nxn import *
-from ..kernels.cpu_flat import get_normalization_array as flat_norm
-from pyiid.experiments.elasticscatter.atomics import pad_pdf
+from pyiid.experiments.elasticscatter.atomics import pad_pdf, \
+    get_scatter_tables, get_pair_scatter_average
+from pyiid.experiments.shared import get_nxn_geometry
+from pyiid.experiments.elasticscatter.profiling import stage
+from pyiid.experiments.elasticscatter.memory import planned, nxn_bytes
 
 __author__ = 'christopher'
 
 
+@planned('fq', nxn_bytes)
 def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     """
     Generate the reduced structure function
@@ -26,41 +30,37 @@ def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     """
     q = atoms.get_positions().astype(np.float32)
 
-    # get scatter array
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter')
-    else:
-        scatter_array = atoms.get_array('PDF scatter')
+    # get the element scatter factors and each atom's element
+    index, table = get_scatter_tables(atoms, sum_type)
     # define scatter_q information and initialize constants
 
-    n, qmax_bin = scatter_array.shape
-    # Get pair coordinate distance array
-    d = np.zeros((n, n, 3), np.float32)
-    get_d_array(d, q)
-
-    # Get pair distance array
-    r = np.zeros((n, n), np.float32)
-    get_r_array(r, d)
+    n = len(index)
+    qmax_bin = table.shape[1]
+    # Get pair coordinate distance and pair distance arrays
+    with stage('get_nxn_geometry'):
+        d, r = get_nxn_geometry(atoms)
 
     # Get normalization array
-    norm = np.zeros((n, n, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array)
+    with stage('get_element_normalization_array'):
+        norm = np.zeros((n, n, qmax_bin), np.float32)
+        get_element_normalization_array(norm, table, index)
 
     # Get omega
-    omega = np.zeros((n, n, qmax_bin), np.float32)
-    get_omega(omega, r, qbin)
+    with stage('get_omega'):
+        omega = np.zeros((n, n, qmax_bin), np.float32)
+        get_omega(omega, r, qbin)
 
-    get_fq_inplace(omega, norm)
+    with stage('get_fq_inplace'):
+        get_fq_inplace(omega, norm)
     fq = omega
 
     # Normalize fq
-    fq = np.sum(fq, axis=(0, 1), dtype=np.float64)
+    with stage('sum'):
+        fq = np.sum(fq, axis=(0, 1), dtype=np.float64)
     fq = fq.astype(np.float32)
     # fq = np.sum(fq, axis=0, dtype=np.float32)
     # fq = np.sum(fq, axis=0, dtype=np.float32)
-    norm2 = np.zeros((int(n * (n - 1) / 2.), qmax_bin), np.float32)
-    flat_norm(norm2, scatter_array, 0)
-    na = np.mean(norm2, axis=0, dtype=np.float32) * np.float32(n)
+    na = get_pair_scatter_average(index, table) * np.float32(n)
     # na = np.mean(norm2, axis=0, dtype=np.float64) * n
     old_settings = np.seterr(all='ignore')
     fq = np.nan_to_num(fq / na)
@@ -69,6 +69,7 @@ def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     return fq
 
 
+@planned('grad', nxn_bytes)
 def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
     """
     Generate the reduced structure function gradient
@@ -90,48 +91,44 @@ def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
     """
     q = atoms.get_positions().astype(np.float32)
     qbin = np.float32(qbin)
-    # get scatter array
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter')
-    else:
-        scatter_array = atoms.get_array('PDF scatter')
+    # get the element scatter factors and each atom's element
+    index, table = get_scatter_tables(atoms, sum_type)
 
     # define scatter_q information and initialize constants
-    qmax_bin = scatter_array.shape[1]
+    qmax_bin = table.shape[1]
     n = len(q)
 
-    # Get pair coordinate distance array
-    d = np.zeros((n, n, 3), np.float32)
-    get_d_array(d, q)
-
-    # Get pair distance array
-    r = np.zeros((n, n), np.float32)
-    get_r_array(r, d)
+    # Get pair coordinate distance and pair distance arrays
+    with stage('get_nxn_geometry'):
+        d, r = get_nxn_geometry(atoms)
 
     # Get normalization array
-    norm = np.zeros((n, n, qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array)
+    with stage('get_element_normalization_array'):
+        norm = np.zeros((n, n, qmax_bin), np.float32)
+        get_element_normalization_array(norm, table, index)
 
     # Get omega
-    omega = np.zeros((n, n, qmax_bin), np.float32)
-    get_omega(omega, r, qbin)
+    with stage('get_omega'):
+        omega = np.zeros((n, n, qmax_bin), np.float32)
+        get_omega(omega, r, qbin)
 
     # Get grad omega
-    grad_omega = np.zeros((n, n, 3, qmax_bin), np.float32)
-    get_grad_omega(grad_omega, omega, r, d, qbin)
+    with stage('get_grad_omega'):
+        grad_omega = np.zeros((n, n, 3, qmax_bin), np.float32)
+        get_grad_omega(grad_omega, omega, r, d, qbin)
 
     # Get grad FQ
-    get_grad_fq_inplace(grad_omega, norm)
+    with stage('get_grad_fq_inplace'):
+        get_grad_fq_inplace(grad_omega, norm)
     grad_fq = grad_omega
 
     # Normalize FQ
-    grad_fq = grad_fq.sum(1)
+    with stage('sum'):
+        grad_fq = grad_fq.sum(1)
     # '''
-    norm = np.zeros((int(n * (n - 1) / 2.), qmax_bin), np.float32)
-    flat_norm(norm, scatter_array, 0)
-    na = np.mean(norm, axis=0) * np.float32(n)
+    na = get_pair_scatter_average(index, table) * np.float32(n)
     old_settings = np.seterr(all='ignore')
     grad_fq = np.nan_to_num(grad_fq / na)
     np.seterr(**old_settings)
-    del d, r, scatter_array, norm, omega, grad_omega
+    del d, r, table, norm, omega, grad_omega
     return grad_fq
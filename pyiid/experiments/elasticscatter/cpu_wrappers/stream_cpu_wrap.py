@@ -0,0 +1,327 @@
+"""
+Stream the pair space through the threaded CPU kernels in blocks of rows, for
+calculations too big to hold in memory at once (the flat kernels keep kxQ
+arrays and the pair count passes 2**31 at about 65k atoms).
+
+Each block covers the pairs of a range of rows, i0 <= i < i1 and j < i, with
+at most `block_pairs` pairs.  The blocks are summed in order into a running
+total (float64 for F(Q)) which can be written to a checkpoint file, so a long
+calculation (eg. the Debye sum of a million atoms) which is stopped can be
+picked up where it left off.  The memory used is the total plus the per
+thread accumulators of one block, independent of the number of pairs.
+
+Setting `checkpoint_dir` (or the PYIID_CHECKPOINT_DIR environment variable)
+makes `wrap_fq` and `wrap_fq_grad` checkpoint into that directory, so an
+`ElasticScatter` calculation on the 'stream' kernel which is killed resumes
+when it is run again on the same atoms.
+"""
+import os
+import math
+import time
+import hashlib
+import numpy as np
+import numba
+
+from pyiid.experiments.elasticscatter.kernels.cpu_threaded import \
+    get_fq_blocks, get_grad_fq_blocks, get_tiles, get_tile_blocks
+from pyiid.experiments.elasticscatter.cpu_wrappers.flat_threaded_cpu_wrap \
+    import get_num_threads, get_tile_size, get_grad_blocks, get_bytes
+from pyiid.experiments.elasticscatter.atomics import get_scatter_tables, \
+    get_pair_scatter_average
+from pyiid.experiments.elasticscatter.memory import InProcessPlan
+from pyiid.experiments.elasticscatter.profiling import stage
+
+__author__ = 'christopher'
+
+# The most pairs in a block
+block_pairs = 2 ** 25
+# Where wrap_fq and wrap_fq_grad checkpoint, None for no checkpoints
+checkpoint_dir = os.getenv('PYIID_CHECKPOINT_DIR') or None
+# The least time between checkpoints, in seconds
+checkpoint_interval = 60.
+
+
+def _rows_for_pairs(p):
+    # the largest i with i * (i - 1) / 2 <= p
+    i = int((1. + math.sqrt(1. + 8. * p)) / 2.)
+    while i * (i - 1) // 2 > p:
+        i -= 1
+    while (i + 1) * i // 2 <= p:
+        i += 1
+    return i
+
+
+def get_row_blocks(n, max_pairs):
+    """
+    Split the rows of the pair space into blocks
+
+    Parameters
+    ----------
+    n: int
+        The number of atoms
+    max_pairs: int
+        The most pairs in a block, a block always has at least one row
+
+    Returns
+    -------
+    list of (int, int):
+        The first and one past the last row of each block
+
+    >>> get_row_blocks(10, 10)
+    [(0, 5), (5, 6), (6, 7), (7, 8), (8, 9), (9, 10)]
+    """
+    blocks = []
+    i0 = 0
+    while i0 < n:
+        i1 = _rows_for_pairs(max_pairs + i0 * (i0 - 1) // 2)
+        i1 = min(max(i1, i0 + 1), n)
+        blocks.append((i0, i1))
+        i0 = i1
+    return blocks
+
+
+class PairStream(object):
+    """
+    A pair sum over the atoms, done block by block
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration, wrapped by `ElasticScatter`
+    qbin: float
+        The size of the scatter vector increment
+    sum_type: {'fq', 'pdf'}
+        Which scatter array should be used for the calculation
+    kind: {'fq', 'grad'}
+        The calculation
+    max_pairs: int, optional
+        The most pairs in a block, defaults to `block_pairs`
+    checkpoint: str, optional
+        The checkpoint file, if it holds a checkpoint of the same
+        calculation the stream starts from there
+    interval: float, optional
+        The least time between checkpoints, defaults to
+        `checkpoint_interval`
+    """
+
+    def __init__(self, atoms, qbin=.1, sum_type='fq', kind='fq',
+                 max_pairs=None, checkpoint=None, interval=None):
+        if kind not in ['fq', 'grad']:
+            raise ValueError('kind must be fq or grad, not {0}'.format(kind))
+        self.kind = kind
+        self.qbin = qbin
+        self.index, self.table = get_scatter_tables(atoms, sum_type)
+        self.n = len(self.index)
+        self.qmax_bin = self.table.shape[1]
+        self.qt = np.ascontiguousarray(atoms.get_positions().T, np.float32)
+        self.max_pairs = block_pairs if max_pairs is None else max_pairs
+        self.blocks = get_row_blocks(self.n, self.max_pairs)
+        self.checkpoint = checkpoint
+        self.interval = checkpoint_interval if interval is None else interval
+        self.key = self.get_key(atoms)
+        self.next_block = 0
+        if kind == 'fq':
+            self.total = np.zeros(self.qmax_bin, np.float64)
+        else:
+            self.total = np.zeros((self.n, 3, self.qmax_bin), np.float32)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load()
+
+    def get_key(self, atoms):
+        """
+        A hash of everything which changes the answer, a checkpoint is only
+        used by a stream with the same key
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(self.qt).tobytes())
+        h.update(np.ascontiguousarray(atoms.numbers).tobytes())
+        h.update(np.ascontiguousarray(self.table).tobytes())
+        h.update(repr((self.kind, float(self.qbin),
+                       int(self.max_pairs))).encode())
+        return h.hexdigest()
+
+    def get_grad_blocks(self):
+        """
+        The number of blocks each row block of a gradient is split into, see
+        `flat_threaded_cpu_wrap.get_grad_blocks`
+        """
+        return get_grad_blocks(self.n, self.qmax_bin)
+
+    def get_bytes(self):
+        """
+        The predicted peak bytes, those of the threaded backend as a row
+        block is done the same way
+        """
+        return get_bytes(self.kind, self.n, self.qmax_bin)
+
+    @property
+    def done(self):
+        return self.next_block >= len(self.blocks)
+
+    def run_block(self, i0, i1):
+        """
+        Sum the pairs of rows i0 <= i < i1
+
+        Returns
+        -------
+        ndarray:
+            The un-normalized sum of the block
+        """
+        threads = get_num_threads()
+        numba.set_num_threads(threads)
+        tiles = get_tiles(self.n, get_tile_size(self.qmax_bin), i0, i1)
+        qbin = np.float32(self.qbin)
+        if self.kind == 'fq':
+            starts = get_tile_blocks(tiles, 4 * threads)
+            acc = np.zeros((len(starts) - 1, self.qmax_bin), np.float64)
+            get_fq_blocks(acc, self.qt, self.table, self.index, qbin, tiles,
+                          starts)
+        else:
+            # one Nx3xQ accumulator per block, fewer blocks than threads if
+            # they do not fit in the memory budget next to the total
+            starts = get_tile_blocks(tiles, self.get_grad_blocks())
+            acc = np.zeros((len(starts) - 1, self.n, 3, self.qmax_bin),
+                           np.float32)
+            get_grad_fq_blocks(acc, self.qt, self.table, self.index, qbin,
+                               tiles, starts)
+        return np.sum(acc, axis=0)
+
+    def run(self, max_blocks=None):
+        """
+        Sum the remaining blocks
+
+        Parameters
+        ----------
+        max_blocks: int, optional
+            Stop after this many blocks, the stream can be run again to
+            carry on
+
+        Returns
+        -------
+        bool:
+            True if all the blocks are done
+        """
+        last_save = time.time()
+        count = 0
+        while not self.done and (max_blocks is None or count < max_blocks):
+            with stage('run_block'):
+                self.total += self.run_block(*self.blocks[self.next_block])
+            self.next_block += 1
+            count += 1
+            if self.checkpoint is not None and \
+                    time.time() - last_save >= self.interval:
+                with stage('checkpoint'):
+                    self.save()
+                last_save = time.time()
+        if self.checkpoint is not None:
+            with stage('checkpoint'):
+                self.save()
+        return self.done
+
+    def save(self):
+        """
+        Write the checkpoint
+        """
+        d = os.path.dirname(os.path.abspath(self.checkpoint))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        # write then move so a stop while writing keeps the old checkpoint
+        tmp = self.checkpoint + '.{0}.tmp.npz'.format(os.getpid())
+        np.savez(tmp, key=np.array(self.key), next_block=self.next_block,
+                 total=self.total)
+        os.rename(tmp, self.checkpoint)
+
+    def load(self):
+        """
+        Read the checkpoint
+
+        Raises
+        ------
+        ValueError:
+            If the checkpoint is of a different calculation
+        """
+        with np.load(self.checkpoint) as f:
+            if str(f['key']) != self.key:
+                raise ValueError('{0} is a checkpoint of a different '
+                                 'calculation'.format(self.checkpoint))
+            self.next_block = int(f['next_block'])
+            self.total = f['total'].astype(self.total.dtype)
+
+    def get_result(self):
+        """
+        The normalized answer, with the same normalization as the other
+        backends
+
+        Returns
+        -------
+        ndarray:
+            F(Q) or grad F(Q)
+        """
+        if not self.done:
+            raise RuntimeError('{0} of {1} blocks are done'.format(
+                self.next_block, len(self.blocks)))
+        na = get_pair_scatter_average(self.index, self.table) * \
+            np.float32(self.n)
+        old_settings = np.seterr(all='ignore')
+        ans = np.nan_to_num(self.total.astype(np.float32) / na)
+        np.seterr(**old_settings)
+        if self.kind == 'fq':
+            return ans * 2.
+        return ans
+
+
+def _stream(atoms, qbin, sum_type, kind):
+    s = PairStream(atoms, qbin, sum_type, kind)
+    if checkpoint_dir is not None:
+        s.checkpoint = os.path.join(checkpoint_dir,
+                                    'stream_{0}.npz'.format(s.key))
+        if os.path.exists(s.checkpoint):
+            s.load()
+    plan = InProcessPlan(kind, s.n, s.qmax_bin, s.get_bytes())
+    plan.run(s.run)
+    if s.checkpoint is not None:
+        os.remove(s.checkpoint)
+    return s.get_result()
+
+
+def wrap_fq(atoms, qbin=.1, sum_type='fq'):
+    """
+    Generate the reduced structure function
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    qbin: float
+        The size of the scatter vector increment
+    sum_type: {'fq', 'pdf'}
+        Which scatter array should be used for the calculation
+
+    Returns
+    -------
+    fq:1darray
+        The reduced structure function
+    """
+    return _stream(atoms, qbin, sum_type, 'fq')
+
+
+def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
+    """
+    Generate the reduced structure function gradient
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    qbin: float
+        The size of the scatter vector increment
+    sum_type: {'fq', 'pdf'}
+        Which scatter array should be used for the calculation
+
+    Returns
+    -------
+
+    dfq_dq:ndarray
+        The reduced structure function gradient
+    """
+    return _stream(atoms, qbin, sum_type, 'grad')
@@ -0,0 +1,155 @@
+"""
+Projection of 1D scattering onto 2D detectors.
+
+A `DetectorMap` bins the Q of every pixel once, with a binary search over the
+Q grid, so projecting an I(Q) onto the detector is one gather over the
+pixels.  The maps of the last few detector geometries are cached, keyed on a
+stamp of the pixel Q values and the Q grid, so the frames of a trajectory
+projected onto the same detector only pay for the gather.
+"""
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+__author__ = 'christopher'
+
+
+class DetectorMap(object):
+    """
+    The Q bin of each pixel of a detector
+
+    Parameters
+    ----------
+    pixel_array: ndarray
+        The Q of each pixel
+    s: 1darray
+        The Q grid, evenly spaced bin centers
+    qbin: float
+        The bin width
+    interpolate: bool
+        Interpolate linearly between the two nearest bin centers rather than
+        take the bin the pixel falls in
+
+    Pixels which are not inside any bin, s - qbin / 2 < q < s + qbin / 2, get
+    zero intensity.
+
+    >>> m = DetectorMap(np.array([[.04, .12], [.3, 1.]]), np.arange(0, .4, .1),
+    ...                 .1)
+    >>> m.project(np.array([1., 2., 3., 4.])).tolist()
+    [[1.0, 2.0], [4.0, 0.0]]
+    >>> m = DetectorMap(np.array([.04, .12]), np.arange(0, .4, .1), .1, True)
+    >>> np.round(m.project(np.array([1., 2., 3., 4.])), 6).tolist()
+    [1.4, 2.2]
+    """
+
+    def __init__(self, pixel_array, s, qbin, interpolate=False):
+        self.shape = pixel_array.shape
+        self.n_bins = len(s)
+        self.interpolate = interpolate
+        q = np.ravel(pixel_array)
+        # the last bin whose lower edge is below the pixel, it holds the
+        # pixel if the pixel is also below its upper edge
+        lower = s - qbin / 2.
+        b = np.searchsorted(lower, q, side='left') - 1
+        inside = b >= 0
+        inside[inside] = q[inside] < s[b[inside]] + qbin / 2.
+        if not interpolate:
+            # pixels outside read the zero past the end of the I(Q)
+            self.index = np.where(inside, b, self.n_bins).astype(np.int32)
+            self.weight = None
+            return
+        # interpolate between the bin centers either side of the pixel,
+        # the pixels beyond the first or last center take its value
+        lo = np.clip(np.searchsorted(s, q, side='right') - 1, 0,
+                     max(self.n_bins - 2, 0))
+        if self.n_bins > 1:
+            w = np.clip((q - s[lo]) / (s[lo + 1] - s[lo]), 0., 1.)
+        else:
+            w = np.zeros(q.shape)
+        self.index = np.where(inside, lo, self.n_bins).astype(np.int32)
+        self.weight = np.where(inside, w, 0.).astype(np.float32)
+
+    def project(self, iq):
+        """
+        Project an I(Q) onto the detector
+
+        Parameters
+        ----------
+        iq: 1darray
+            The intensity of each bin
+
+        Returns
+        -------
+        ndarray:
+            The intensity of each pixel
+        """
+        # two zeros past the end, read by the pixels outside of the bins
+        ext = np.zeros(self.n_bins + 2)
+        ext[:self.n_bins] = iq[:self.n_bins]
+        if self.n_bins == 1:
+            ext[1] = ext[0]
+        img = ext[self.index]
+        if self.weight is not None:
+            img += self.weight * (ext[self.index + 1] - img)
+        return img.reshape(self.shape)
+
+
+def get_pixel_stamp(pixel_array):
+    """
+    A stamp which changes whenever the pixel Q values change
+
+    Parameters
+    ----------
+    pixel_array: ndarray
+        The Q of each pixel
+
+    Returns
+    -------
+    str:
+        The stamp
+    """
+    p = np.ascontiguousarray(pixel_array)
+    h = hashlib.sha1(p.view(np.uint8))
+    h.update(repr((p.shape, p.dtype.str)).encode())
+    return h.hexdigest()
+
+
+class DetectorMapCache(object):
+    """
+    Least recently used cache of detector maps
+
+    Parameters
+    ----------
+    max_entries: int
+        The number of maps to keep
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, pixel_array, s, qbin, interpolate=False):
+        """
+        Get the map of a detector, see `DetectorMap`
+        """
+        key = (get_pixel_stamp(pixel_array), len(s), float(s[0]) if len(s)
+               else 0., float(qbin), bool(interpolate))
+        if key in self.entries:
+            self.hits += 1
+            value = self.entries.pop(key)
+        else:
+            self.misses += 1
+            value = DetectorMap(pixel_array, s, qbin, interpolate)
+            while len(self.entries) >= self.max_entries > 0:
+                self.entries.popitem(last=False)
+        if self.max_entries > 0:
+            self.entries[key] = value
+        return value
+
+
+detector_map_cache = DetectorMapCache()
@@ -4,6 +4,8 @@ from pyiid.experiments.elasticscatter.atomics.gpu_atomics import *
 from pyiid.experiments import *
 from pyiid.experiments.elasticscatter.kernels.cpu_flat import \
     get_normalization_array
+from pyiid.experiments.elasticscatter.atomics import get_scatter_factors
+from pyiid.experiments.elasticscatter.profiling import stage
 from builtins import range
 
 __author__ = 'christopher'
@@ -14,10 +16,8 @@ def setup_gpu_calc(atoms, sum_type):
     q = atoms.get_positions()
     q = q.astype(np.float32)
     n = len(q)
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter').astype(np.float32)
-    else:
-        scatter_array = atoms.get_array('PDF scatter').astype(np.float32)
+    # the GPU kernels read the per atom scatter factors
+    scatter_array = get_scatter_factors(atoms, sum_type)
     qmax_bin = scatter_array.shape[1]
     sort_gpus, sort_gmem = get_gpus_mem()
 
@@ -142,11 +142,13 @@ def wrap_fq(atoms, qbin=.1, sum_type='fq'):
 
     fq = np.zeros(qmax_bin, np.float64)
     master_task = [fq, q, scatter_array, qbin]
-    fq = gpu_multithreading(subs_fq, allocation, master_task, (n, qmax_bin),
-                            (gpus, mem_list))
+    with stage('gpu_multithreading'):
+        fq = gpu_multithreading(subs_fq, allocation, master_task,
+                                (n, qmax_bin), (gpus, mem_list))
     fq = fq.astype(np.float32)
-    norm = np.empty((int(n * (n - 1) / 2.), qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, 0)
+    with stage('get_normalization_array'):
+        norm = np.empty((int(n * (n - 1) / 2.), qmax_bin), np.float32)
+        get_normalization_array(norm, scatter_array, 0)
     na = np.mean(norm, axis=0) * n
     old_settings = np.seterr(all='ignore')
     fq = np.nan_to_num(fq / na)
@@ -182,11 +184,13 @@ def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
 
     grad_p = np.zeros((n, 3, qmax_bin))
     master_task = [grad_p, q, scatter_array, qbin]
-    grad_p = gpu_multithreading(subs_grad_fq, allocation, master_task,
-                                (n, qmax_bin),
-                                (gpus, mem_list))
-    norm = np.empty((int(n * (n - 1) / 2.), qmax_bin), np.float32)
-    get_normalization_array(norm, scatter_array, 0)
+    with stage('gpu_multithreading'):
+        grad_p = gpu_multithreading(subs_grad_fq, allocation, master_task,
+                                    (n, qmax_bin),
+                                    (gpus, mem_list))
+    with stage('get_normalization_array'):
+        norm = np.empty((int(n * (n - 1) / 2.), qmax_bin), np.float32)
+        get_normalization_array(norm, scatter_array, 0)
     na = np.mean(norm, axis=0) * n
     old_settings = np.seterr(all='ignore')
     grad_p = np.nan_to_num(grad_p / na)
@@ -288,7 +292,7 @@ def gpu_multithreading(subs_function, allocation,
                        master_task, constants, gpu_info):
     n, qmax_bin = constants
     gpus, mem_list = gpu_info
-    k_max = int((n ** 2 - n) / 2.)
+    k_max = n * (n - 1) // 2
 
     k_cov = 0
     p_dict = {}
@@ -297,6 +301,9 @@ def gpu_multithreading(subs_function, allocation,
         for gpu, mem in zip(gpus, mem_list):
             if gpu not in p_dict.keys() or p_dict[gpu].is_alive() is False:
                 k_per_thread = allocation(n, qmax_bin, mem)
+                if k_per_thread < 1:
+                    raise MemoryError('GPU {0} does not have room for one '
+                                      'pair'.format(gpu))
                 if k_per_thread > k_max - k_cov:
                     k_per_thread = k_max - k_cov
                 if k_cov >= k_max:
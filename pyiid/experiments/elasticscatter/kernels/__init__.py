@@ -1,22 +1,35 @@
 import math
 from numba import *
-from numba import cuda, f4, i4, int32
+from numba import f4, i4, i8
 import numpy as np
 from builtins import range
 
 __author__ = 'christopher'
 
 
+def readonly(array_type):
+    # The type of an array argument which the kernel only reads, it takes the
+    # read only arrays of the geometry cache as well as writable arrays
+    return array_type.copy(readonly=True)
+
+
+# The pair index k = j + i * (i - 1) / 2, j < i, is 64 bit, k_max = N(N-1)/2
+# overflows 32 bits above about 65k atoms
 @jit(target='cpu', nopython=True)
 def ij_to_k(i, j):
-    return int(j + i * (i - 1) / 2)
+    return i8(j) + i8(i) * (i8(i) - 1) // 2
 
 
 @jit(target='cpu', nopython=True)
 def k_to_ij(k):
-    i = math.floor(float((1 + math.sqrt(1 + 8. * k))) / 2.)
-    j = k - i * (i - 1) / 2.
-    return i4(i), i4(j)
+    k = i8(k)
+    i = i8(math.floor((1. + math.sqrt(1. + 8. * k)) / 2.))
+    # the float sqrt can be off by one for large k
+    if i * (i - 1) // 2 > k:
+        i -= 1
+    elif i * (i + 1) // 2 <= k:
+        i += 1
+    return i, k - i * (i - 1) // 2
 
 
 def symmetric_reshape(in_data):
@@ -37,15 +50,3 @@ def antisymmetric_reshape(in_data):
         out_data[i, j] = -1 * in_data[k]
         out_data[j, i] = in_data[k]
     return out_data
-
-
-@cuda.jit(device=True)
-def cuda_k_to_ij(k):
-    i = math.floor((f4(1) + f4(math.sqrt(f4(1) + f4(8.) * f4(k)))) * f4(.5))
-    j = f4(k) - f4(i) * (f4(i) - f4(1)) * f4(.5)
-    return i4(i), i4(j)
-
-
-@cuda.jit(device=True)
-def cuda_ij_to_k(i, j):
-    return int32(j + i * (i - 1) / 2)
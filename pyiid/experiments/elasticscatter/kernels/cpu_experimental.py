@@ -1,15 +1,25 @@
-from numba import jit, i4
+import os
+from numba import jit
 from builtins import range
 from pyiid.experiments.elasticscatter.kernels import k_to_ij
 
 __author__ = 'christopher'
 
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
 
-@jit(target='cpu', nopython=True)
+
+@jit(target='cpu', nopython=True, cache=cache)
 def experimental_sum_grad_cpu(new_grad, grad, k_cov):
+    # decode the first pair, then walk the rest in row major order
+    i, j = k_to_ij(k_cov)
     for k in range(grad.shape[0]):
-        i, j = k_to_ij(i4(k + k_cov))
         for qx in range(grad.shape[2]):
             for tz in range(3):
                 new_grad[i, tz, qx] -= grad[k, tz, qx]
                 new_grad[j, tz, qx] += grad[k, tz, qx]
+        j += 1
+        if j == i:
+            i += 1
+            j = 0
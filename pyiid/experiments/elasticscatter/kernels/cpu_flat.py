@@ -11,7 +11,7 @@ processor_target = 'cpu'
 
 
 # F(sv) kernels ---------------------------------------------------------------
-@jit(void(f4[:, :], f4[:, :], i4), target=processor_target, nopython=True,
+@jit(void(f4[:, :], f4[:, :], i8), target=processor_target, nopython=True,
      cache=cache)
 def get_d_array(d, q, offset):
     """
@@ -26,10 +26,15 @@ def get_d_array(d, q, offset):
     offset: int
         The amount of previously covered pairs
     """
-    for k in range(i4(len(d))):
-        i, j = k_to_ij(i4(k + offset))
+    # decode the first pair, then walk the rest in row major order
+    i, j = k_to_ij(offset)
+    for k in range(len(d)):
         for tz in range(i4(3)):
             d[k, tz] = q[i, tz] - q[j, tz]
+        j += 1
+        if j == i:
+            i += 1
+            j = 0
 
 
 @jit(void(f4[:], f4[:, :]), target=processor_target, nopython=True,
@@ -45,14 +50,14 @@ def get_r_array(r, d):
     d: kx3 array
         The pair displacements
     """
-    for k in range(i4(len(r))):
+    for k in range(len(r)):
         tmp = f4(0.)
         for w in range(i4(3)):
             tmp += d[k, w] * d[k, w]
         r[k] = math.sqrt(tmp)
 
 
-@jit(void(f4[:, :], f4[:, :], i4), target=processor_target, nopython=True,
+@jit(void(f4[:, :], f4[:, :], i8), target=processor_target, nopython=True,
      cache=cache)
 def get_normalization_array(norm, scat, offset):
     """
@@ -68,14 +73,49 @@ def get_normalization_array(norm, scat, offset):
         The amount of previously covered pairs
     """
     kmax, qmax_bin = norm.shape
-    for k in range(i4(kmax)):
-        i, j = k_to_ij(i4(k + offset))
+    i, j = k_to_ij(offset)
+    for k in range(kmax):
         for qx in range(i4(qmax_bin)):
             norm[k, qx] = scat[i, qx] * scat[j, qx]
+        j += 1
+        if j == i:
+            i += 1
+            j = 0
 
 
-@jit(void(f4[:, :], f4[:], f4), target=processor_target, nopython=True,
-     cache=cache)
+@jit(void(f4[:, :], f4[:, :], i4[:], i8), target=processor_target,
+     nopython=True, cache=cache)
+def get_element_normalization_array(norm, table, index, offset):
+    """
+    Generate the sv dependant normalization factors for the F(sv) array from
+    the element-wise scatter factors
+
+    Parameters
+    -----------
+    norm: kxQ array
+        Normalization array
+    table: ExQ array
+        The scatter factors of each element
+    index: N array
+        The row of the table for each atom
+    offset: int
+        The amount of previously covered pairs
+    """
+    kmax, qmax_bin = norm.shape
+    i, j = k_to_ij(offset)
+    for k in range(kmax):
+        ei = index[i]
+        ej = index[j]
+        for qx in range(i4(qmax_bin)):
+            norm[k, qx] = table[ei, qx] * table[ej, qx]
+        j += 1
+        if j == i:
+            i += 1
+            j = 0
+
+
+@jit(void(f4[:, :], readonly(f4[:]), f4), target=processor_target,
+     nopython=True, cache=cache)
 def get_omega(omega, r, qbin):
     """
     Generate Omega
@@ -91,7 +131,7 @@ def get_omega(omega, r, qbin):
     kmax, qmax_bin = omega.shape
     for qx in range(i4(qmax_bin)):
         sv = qbin * f4(qx)
-        for k in range(i4(kmax)):
+        for k in range(kmax):
             rk = r[k]
             omega[k, qx] = math.sin(sv * rk) / rk
 
@@ -117,13 +157,13 @@ def get_fq_inplace(omega, norm):
 # Gradient test_kernels -------------------------------------------------------
 
 
-@jit(void(f4[:, :, :], f4[:, :], f4[:], f4[:, :], f4),
+@jit(void(f4[:, :, :], f4[:, :], readonly(f4[:]), readonly(f4[:, :]), f4),
      target=processor_target, nopython=True, cache=cache)
 def get_grad_omega(grad_omega, omega, r, d, qbin):
     kmax, _, qmax_bin = grad_omega.shape
     for qx in range(i4(qmax_bin)):
         sv = f4(qx) * qbin
-        for k in range(i4(kmax)):
+        for k in range(kmax):
             rk = r[k]
             a = sv * math.cos(sv * rk) - omega[k, qx]
             a /= rk * rk
@@ -202,10 +242,10 @@ def fast_fast_flat_sum(new_grad, grad, k_cov):
         for j in range(n):
             alpha = 0
             if j < i:
-                k = j + i * (i - 1) / 2 - k_cov
+                k = j + i * (i - 1) // 2 - k_cov
                 alpha = -1
             elif i < j:
-                k = i + j * (j - 1) / 2 - k_cov
+                k = i + j * (j - 1) // 2 - k_cov
                 alpha = 1
             else:
                 k = -1
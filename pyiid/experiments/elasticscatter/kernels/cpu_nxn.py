@@ -1,8 +1,8 @@
 import math
 from numba import *
-import mkl
 import os
 from builtins import range
+from pyiid.experiments.elasticscatter.kernels import readonly
 
 __author__ = 'christopher'
 
@@ -76,8 +76,33 @@ def get_normalization_array(norm_array, scatter_array):
                                            scatter_array[j, qx]
 
 
-@jit(void(f4[:, :, :], f4[:, :], f4), target=processor_target, nopython=True,
-     cache=cache)
+@jit(void(f4[:, :, :], f4[:, :], i4[:]), target=processor_target,
+     nopython=True, cache=cache)
+def get_element_normalization_array(norm_array, table, index):
+    """
+    Generate the sv dependant normalization factors for the F(sv) array from
+    the element-wise scatter factors
+
+    Parameters
+    -----------
+    norm_array: NxNxQ array
+        Normalization array
+    table: ExQ array
+        The scatter factors of each element
+    index: N array
+        The row of the table for each atom
+    """
+    n, _, qmax_bin = norm_array.shape
+    for qx in range(i4(qmax_bin)):
+        for i in range(i4(n)):
+            for j in range(i4(n)):
+                if i != j:
+                    norm_array[i, j, qx] = table[index[i], qx] * \
+                                           table[index[j], qx]
+
+
+@jit(void(f4[:, :, :], readonly(f4[:, :]), f4), target=processor_target,
+     nopython=True, cache=cache)
 def get_omega(omega, r, qbin):
     """
     Generate F(Q), not normalized, via the Debye sum
@@ -134,7 +159,8 @@ def get_fq_inplace(omega, norm):
 # Gradient test_kernels -------------------------------------------------------
 
 
-@jit(void(f4[:, :, :, :], f4[:, :, :], f4[:, :], f4[:, :, :], f4),
+@jit(void(f4[:, :, :, :], f4[:, :, :], readonly(f4[:, :]),
+          readonly(f4[:, :, :]), f4),
      target=processor_target, nopython=True, cache=cache)
 def get_grad_omega(grad_omega, omega, r, d, qbin):
     n, _, _, qmax_bin = grad_omega.shape
@@ -0,0 +1,305 @@
+from pyiid.experiments.elasticscatter.kernels import *
+from numba import prange
+import math
+import os
+
+__author__ = 'christopher'
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
+processor_target = 'cpu'
+
+# Thread parallel kernels.  The lower triangle of pairs is cut into tiles of
+# i atoms x j atoms (see `get_tiles`), so a tile's coordinates and gradient
+# rows stay in cache while all of its pairs are summed, and the pairs are
+# walked with two loops rather than decoding each linear pair index.  The
+# tiles are grouped into blocks (see `get_tile_blocks`) and each block is
+# summed by one thread into its own accumulator, so the threads never write
+# to the same memory and the result does not depend on the scheduling.  The
+# blocks are reduced by the caller.  The arrays are declared C contiguous
+# (::1) so the Q loops vectorize.
+
+
+def get_tiles(n, tile_size, i_start=0, i_stop=None):
+    """
+    Cut the lower triangle of pairs, j < i, into tiles
+
+    Parameters
+    ----------
+    n: int
+        The number of atoms
+    tile_size: int
+        The number of atoms along each side of a tile
+    i_start, i_stop: int, optional
+        Only cover the pairs of these rows, i_start <= i < i_stop
+
+    Returns
+    -------
+    Tx4 array:
+        The i0, i1, j0, j1 atom ranges of each tile, the tile holds the pairs
+        i0 <= i < i1, j0 <= j < min(j1, i)
+
+    >>> get_tiles(5, 2).tolist()
+    [[0, 2, 0, 2], [2, 4, 0, 2], [2, 4, 2, 4], [4, 5, 0, 2], [4, 5, 2, 4]]
+    >>> get_tiles(5, 2, 3, 5).tolist()
+    [[3, 5, 0, 2], [3, 5, 2, 4]]
+    """
+    tile_size = max(int(tile_size), 1)
+    if i_stop is None:
+        i_stop = n
+    i_edges = list(range(i_start, i_stop, tile_size)) + [i_stop]
+    tiles = []
+    for i0, i1 in zip(i_edges[:-1], i_edges[1:]):
+        # the j tiles stop at i1 - 1, the largest j of the tile
+        for j0 in range(0, i1 - 1, tile_size):
+            tiles.append((i0, i1, j0, min(j0 + tile_size, i1)))
+    if not tiles:
+        return np.zeros((0, 4), np.int64)
+    return np.asarray(tiles, np.int64)
+
+
+def get_tile_pairs(tiles):
+    """
+    The number of pairs in each tile
+
+    Parameters
+    ----------
+    tiles: Tx4 array
+        The tiles, see `get_tiles`
+
+    Returns
+    -------
+    T array:
+        The number of pairs
+    """
+    pairs = np.zeros(len(tiles), np.int64)
+    for t, (i0, i1, j0, j1) in enumerate(tiles):
+        i = np.arange(i0, i1)
+        pairs[t] = np.sum(np.clip(np.minimum(i, j1) - j0, 0, None))
+    return pairs
+
+
+def get_tile_blocks(tiles, n_blocks):
+    """
+    Split the tiles into consecutive blocks with about the same number of
+    pairs
+
+    Parameters
+    ----------
+    tiles: Tx4 array
+        The tiles, see `get_tiles`
+    n_blocks: int
+        The number of blocks
+
+    Returns
+    -------
+    1darray:
+        The first tile of each block, the last entry is the number of tiles
+    """
+    n_blocks = max(min(n_blocks, len(tiles)), 1)
+    work = np.cumsum(get_tile_pairs(tiles))
+    if len(work) == 0 or work[-1] == 0:
+        return np.zeros(2, np.int64)
+    targets = work[-1] * np.arange(1, n_blocks) / float(n_blocks)
+    starts = np.searchsorted(work, targets, side='left') + 1
+    starts = np.unique(np.concatenate(([0], starts, [len(tiles)])))
+    return starts.astype(np.int64)
+
+
+@jit(void(f8[:, ::1], f4[:, ::1], f4[:, ::1], i4[::1], f4, i8[:, ::1],
+          i8[::1]),
+     target=processor_target, nopython=True, parallel=True, cache=cache)
+def get_fq_blocks(fq, qt, table, index, qbin, tiles, starts):
+    """
+    Generate the un-normalized F(Q) of each block of tiles
+
+    Parameters
+    ----------
+    fq: BxQ array
+        The F(Q) of each block
+    qt: 3xN array
+        The atomic positions, one row per coordinate
+    table: ExQ array
+        The scatter factors of each element
+    index: N array
+        The row of the table for each atom
+    qbin: float
+        The qbin size
+    tiles: Tx4 array
+        The tiles, see `get_tiles`
+    starts: B + 1 array
+        The first tile of each block, the last entry is the number of tiles
+    """
+    n_blocks, qmax_bin = fq.shape
+    for b in prange(n_blocks):
+        acc = np.zeros(qmax_bin)
+        for t in range(starts[b], starts[b + 1]):
+            for i in range(tiles[t, 0], tiles[t, 1]):
+                x = qt[0, i]
+                y = qt[1, i]
+                z = qt[2, i]
+                ei = index[i]
+                for j in range(tiles[t, 2], min(tiles[t, 3], i)):
+                    d0 = x - qt[0, j]
+                    d1 = y - qt[1, j]
+                    d2 = z - qt[2, j]
+                    r = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+                    ej = index[j]
+                    for qx in range(qmax_bin):
+                        sv = qbin * f4(qx)
+                        acc[qx] += table[ei, qx] * table[ej, qx] * \
+                            math.sin(sv * r) / r
+        for qx in range(qmax_bin):
+            fq[b, qx] = acc[qx]
+
+
+@jit(void(f8[:, :, ::1], f4[:, :, ::1], f4[:, ::1], i4[::1], f4,
+          i8[:, ::1], i8[::1]),
+     target=processor_target, nopython=True, parallel=True, cache=cache)
+def get_fq_batch_blocks(fq, qt, table, index, qbin, tiles, starts):
+    """
+    Generate the un-normalized F(Q) of each block of tiles of many
+    configurations of the same atoms, the blocks of all the configurations
+    are shared out over the threads at once
+
+    Parameters
+    ----------
+    fq: MxBxQ array
+        The F(Q) of each configuration and block
+    qt: Mx3xN array
+        The atomic positions of each configuration, one row per coordinate
+    table: ExQ array
+        The scatter factors of each element
+    index: N array
+        The row of the table for each atom
+    qbin: float
+        The qbin size
+    tiles: Tx4 array
+        The tiles, see `get_tiles`
+    starts: B + 1 array
+        The first tile of each block, the last entry is the number of tiles
+    """
+    n_frames, n_blocks, qmax_bin = fq.shape
+    for fb in prange(n_frames * n_blocks):
+        m = fb // n_blocks
+        b = fb % n_blocks
+        acc = np.zeros(qmax_bin)
+        for t in range(starts[b], starts[b + 1]):
+            for i in range(tiles[t, 0], tiles[t, 1]):
+                x = qt[m, 0, i]
+                y = qt[m, 1, i]
+                z = qt[m, 2, i]
+                ei = index[i]
+                for j in range(tiles[t, 2], min(tiles[t, 3], i)):
+                    d0 = x - qt[m, 0, j]
+                    d1 = y - qt[m, 1, j]
+                    d2 = z - qt[m, 2, j]
+                    r = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+                    ej = index[j]
+                    for qx in range(qmax_bin):
+                        sv = qbin * f4(qx)
+                        acc[qx] += table[ei, qx] * table[ej, qx] * \
+                            math.sin(sv * r) / r
+        for qx in range(qmax_bin):
+            fq[m, b, qx] = acc[qx]
+
+
+@jit(void(f4[:, :, :, ::1], f4[:, ::1], f4[:, ::1], i4[::1], f4,
+          i8[:, ::1], i8[::1]),
+     target=processor_target, nopython=True, parallel=True, cache=cache)
+def get_grad_fq_blocks(grad, qt, table, index, qbin, tiles, starts):
+    """
+    Generate the un-normalized gradient of F(Q) of each block of tiles
+
+    Parameters
+    ----------
+    grad: BxNx3xQ array
+        The gradient of each block
+    qt: 3xN array
+        The atomic positions, one row per coordinate
+    table: ExQ array
+        The scatter factors of each element
+    index: N array
+        The row of the table for each atom
+    qbin: float
+        The qbin size
+    tiles: Tx4 array
+        The tiles, see `get_tiles`
+    starts: B + 1 array
+        The first tile of each block, the last entry is the number of tiles
+    """
+    n_blocks, _, _, qmax_bin = grad.shape
+    for b in prange(n_blocks):
+        # the i row is summed here and written once per tile row
+        row = np.zeros((3, qmax_bin), np.float32)
+        for t in range(starts[b], starts[b + 1]):
+            for i in range(tiles[t, 0], tiles[t, 1]):
+                x = qt[0, i]
+                y = qt[1, i]
+                z = qt[2, i]
+                ei = index[i]
+                row[:, :] = 0.
+                for j in range(tiles[t, 2], min(tiles[t, 3], i)):
+                    d0 = x - qt[0, j]
+                    d1 = y - qt[1, j]
+                    d2 = z - qt[2, j]
+                    r = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+                    ej = index[j]
+                    for qx in range(qmax_bin):
+                        sv = qbin * f4(qx)
+                        a = table[ei, qx] * table[ej, qx] * \
+                            (sv * math.cos(sv * r) - math.sin(sv * r) / r) / \
+                            (r * r)
+                        row[0, qx] -= a * d0
+                        row[1, qx] -= a * d1
+                        row[2, qx] -= a * d2
+                        grad[b, j, 0, qx] += a * d0
+                        grad[b, j, 1, qx] += a * d1
+                        grad[b, j, 2, qx] += a * d2
+                for w in range(3):
+                    for qx in range(qmax_bin):
+                        grad[b, i, w, qx] += row[w, qx]
+
+
+@jit(void(i8[:, :, :, ::1], f4[:, ::1], i4[::1], f4, i8[:, ::1], i8[::1]),
+     target=processor_target, nopython=True, parallel=True, cache=cache)
+def get_histogram_blocks(hist, qt, index, rstep, tiles, starts):
+    """
+    Histogram the pair distances of each block of tiles by element pair
+
+    Parameters
+    ----------
+    hist: BxExExR array
+        The histogram of each block, the pair of elements ei, ej is counted
+        in hist[b, max(ei, ej), min(ei, ej)]
+    qt: 3xN array
+        The atomic positions, one row per coordinate
+    index: N array
+        The element of each atom
+    rstep: float
+        The width of the distance bins, pairs beyond the last bin are not
+        counted
+    tiles: Tx4 array
+        The tiles, see `get_tiles`
+    starts: B + 1 array
+        The first tile of each block, the last entry is the number of tiles
+    """
+    n_blocks, _, _, rmax_bin = hist.shape
+    for b in prange(n_blocks):
+        for t in range(starts[b], starts[b + 1]):
+            for i in range(tiles[t, 0], tiles[t, 1]):
+                x = qt[0, i]
+                y = qt[1, i]
+                z = qt[2, i]
+                ei = index[i]
+                for j in range(tiles[t, 2], min(tiles[t, 3], i)):
+                    d0 = x - qt[0, j]
+                    d1 = y - qt[1, j]
+                    d2 = z - qt[2, j]
+                    rb = int(math.sqrt(d0 * d0 + d1 * d1 + d2 * d2) / rstep)
+                    if rb < rmax_bin:
+                        ej = index[j]
+                        if ei >= ej:
+                            hist[b, ei, ej, rb] += 1
+                        else:
+                            hist[b, ej, ei, rb] += 1
@@ -2,12 +2,12 @@ import math
 
 from numba import *
 
-from experiments.elasticscatter.kernels import cuda_k_to_ij
+from pyiid.experiments.elasticscatter.kernels.gpu_flat import cuda_k_to_ij
 
 __author__ = 'christopher'
 
 
-@cuda.jit(argtypes=[f4[:, :], f4[:, :], i4])
+@cuda.jit(argtypes=[f4[:, :], f4[:, :], i8])
 def get_normalization_array(norm_array, scat, offset):
     """
     Generate the Q dependant normalization factors for the F(Q) array
@@ -30,7 +30,7 @@ def get_normalization_array(norm_array, scat, offset):
     if k >= n or qx >= qmax_bin:
         return
     tid = cuda.threadIdx.y
-    i, j = cuda_k_to_ij(int32(k + offset))
+    i, j = cuda_k_to_ij(i8(k) + offset)
     snormi[0, tid] = scat[i, qx]
     snormj[0, tid] = scat[j, qx]
     cuda.syncthreads()
@@ -89,24 +89,24 @@ def get_grad_fq_e(e, d, c):
         e[k, w, qx] = d[k, qx] * c[k, w]
 
 
-@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i4])
+@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i8])
 def experimental_sum_grad_fq2(new_grad, grad, k_cov):
     k, qx = cuda.grid(2)
     if k >= len(grad) or qx >= grad.shape[2]:
         return
-    i, j = cuda_k_to_ij(i4(k + k_cov))
+    i, j = cuda_k_to_ij(i8(k) + k_cov)
     for tz in range(3):
         cuda.atomic.add(new_grad, (j, tz, qx), 1)
         # new_grad[i, tz, qx] = j
         # cuda.atomic.add(new_grad, (i, tz, qx), j)
 
 
-@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i4])
+@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i8])
 def experimental_sum_grad_fq3(new_grad, grad, k_cov):
     k, qx = cuda.grid(2)
     if k >= len(grad) or qx >= grad.shape[2]:
         return
-    i, j = cuda_k_to_ij(i4(k + k_cov))
+    i, j = cuda_k_to_ij(i8(k) + k_cov)
     # for tz in range(3):
     #     new_grad[i, tz, qx] -= grad[k, tz, qx]
     #     new_grad[j, tz, qx] += grad[k, tz, qx]
@@ -1,14 +1,30 @@
 import math
 
 from numba import *
-from numba import cuda, f4, i4
+from numba import cuda, f4, f8, i4, i8, int32
 
-from pyiid.experiments.elasticscatter.kernels import cuda_k_to_ij, cuda_ij_to_k
 from builtins import range
 __author__ = 'christopher'
 
+
+@cuda.jit(device=True)
+def cuda_k_to_ij(k):
+    # 64 bit, with the same off by one correction as k_to_ij
+    i = i8(math.floor((f8(1) + math.sqrt(f8(1) + f8(8.) * f8(k))) * f8(.5)))
+    if i * (i - 1) // 2 > k:
+        i -= 1
+    elif i * (i + 1) // 2 <= k:
+        i += 1
+    return i, i8(k - i * (i - 1) // 2)
+
+
+@cuda.jit(device=True)
+def cuda_ij_to_k(i, j):
+    return i8(j) + i8(i) * (i8(i) - 1) // 2
+
+
 # F(sv) kernels ---------------------------------------------------------------
-@cuda.jit(argtypes=[f4[:, :], f4[:, :], i4])
+@cuda.jit(argtypes=[f4[:, :], f4[:, :], i8])
 def get_d_array(d, q, offset):
     """
     Generate the kx3 array which holds the pair displacements
@@ -25,7 +41,7 @@ def get_d_array(d, q, offset):
     k = cuda.grid(1)
     if k >= len(d):
         return
-    i, j = cuda_k_to_ij(i4(k + offset))
+    i, j = cuda_k_to_ij(i8(k) + offset)
     for w in range(3):
         d[k, w] = q[i, w] - q[j, w]
 
@@ -49,7 +65,7 @@ def get_r_array(r, d):
     r[k] = math.sqrt(a * a + b * b + c * c)
 
 
-@cuda.jit(argtypes=[f4[:, :], f4[:, :], i4])
+@cuda.jit(argtypes=[f4[:, :], f4[:, :], i8])
 def get_normalization_array(norm_array, scat, offset):
     """
     Generate the sv dependant normalization factors for the F(sv) array
@@ -66,7 +82,7 @@ def get_normalization_array(norm_array, scat, offset):
     k, qx = cuda.grid(2)
     if k >= norm_array.shape[0] or qx >= norm_array.shape[1]:
         return
-    i, j = cuda_k_to_ij(i4(k + offset))
+    i, j = cuda_k_to_ij(i8(k) + offset)
     norm_array[k, qx] = scat[i, qx] * scat[j, qx]
 
 
@@ -192,7 +208,7 @@ def d2_to_d1_sum(d1, d2):
     d1[qx] = tmp
 
 
-@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i4])
+@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i8])
 def fast_fast_flat_sum(new_grad, grad, k_cov):
     i, j, qx = cuda.grid(3)
     n = len(new_grad)
@@ -287,12 +303,12 @@ def get_fq_inplace(norm, omega):
     norm[k, qx] *= omega[k, qx]
 
 
-@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i4])
+@cuda.jit(argtypes=[f4[:, :, :], f4[:, :, :], i8])
 def experimental_sum_grad_fq1(new_grad, grad, k_cov):
     k, qx = cuda.grid(2)
     if k >= len(grad) or qx >= grad.shape[2]:
         return
-    i, j = cuda_k_to_ij(i4(k + k_cov))
+    i, j = cuda_k_to_ij(i8(k) + k_cov)
     for tz in range(3):
         a = grad[k, tz, qx]
         cuda.atomic.add(new_grad, (j, tz, qx), a)
@@ -1,17 +1,20 @@
 import math
+import os
 from numba import *
-import mkl
 import numpy as np
-import xraylib
-from multiprocessing import Pool, cpu_count
+from pyiid.experiments.shared.scatter_factors import get_form_factor_table
+from multiprocessing import cpu_count
+from pyiid.experiments.shared.pool import Pool
 
 __author__ = 'christopher'
 
 targ = 'cpu'
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
 
 
 # F(Q) test_kernels -----------------------------------------------------------
-@jit(target=targ)
 def get_scatter_array(scatter_array, numbers, qbin):
     """
     Generate the scattering array, which holds all the Q dependant scatter
@@ -26,14 +29,10 @@ def get_scatter_array(scatter_array, numbers, qbin):
     qbin: float
         The qbin size
     """
-    n = len(scatter_array)
-    qmax_bin = scatter_array.shape[1]
-    for kq in range(0, qmax_bin):
-        for tx in range(n):
-            # note xraylib uses q = sin(th/2)
-            # as opposed to our q = 4pi sin(th/2)
-            scatter_array[tx, kq] = xraylib.FF_Rayl(int(numbers[tx]),
-                                                    kq * qbin / 4 / np.pi)
+    n, qmax_bin = scatter_array.shape
+    e_list, inverse = np.unique(np.asarray(numbers[:n]), return_inverse=True)
+    table = get_form_factor_table(e_list, qbin, qmax_bin)
+    scatter_array[:] = table[inverse.ravel()]
 
 
 def get_pdf_at_qmin(fpad, rstep, qstep, rgrid, qmin):
@@ -105,6 +104,53 @@ def get_pdf_at_qmin(fpad, rstep, qstep, rgrid, qmin):
     # return gpad
 
 
+def get_pdf_at_qmin_batch(fq, rstep, qstep, rgrid, qmin):
+    """
+    Get the atomic pair distribution functions of many F(Q), the same as
+    `get_pdf_at_qmin` on each row but with one padded FFT over all of them
+
+    Parameters
+    -----------
+    fq: MxQ array
+        The reduced structure functions
+    rstep: float
+        The step size in real space
+    qstep: float
+        The step size in inverse space
+    rgrid: 1d array
+        The real space r values
+    qmin: float
+        The minimum Q value
+
+    Returns
+    -------
+    MxR array:
+        The atomic pair distribution functions
+    """
+    fq = np.array(fq, np.float64, ndmin=2)
+    m, length = fq.shape
+    # Zero out F(Q) below qmin theshold
+    fq[:, :int(math.ceil(qmin / qstep))] = 0.0
+    # Expanding F(Q) with zeros only changes the padded length
+    length = max(length, int(math.ceil(math.pi / rstep / qstep)))
+    npad1 = int(round(qmin / qstep)) + length
+    npad2 = (1 << int(math.ceil(math.log(npad1, 2)))) * 2
+    # the odd extension of each row, see `fft_gr_to_fq`
+    gpadc = np.zeros((m, 4 * npad2))
+    gpadc[:, :2 * fq.shape[1]:2] = fq
+    gpadc[:, -2:-2 * fq.shape[1] + 1:-2] = -1 * fq[:, 1:]
+    gpadcfft = np.fft.ifft(gpadc, axis=1)
+    gpad = gpadcfft[:, :npad2 * 2:2].imag * npad2 * qstep * 2.0 / math.pi
+
+    drpad = math.pi / (npad2 * qstep)
+    axdrp = rgrid / drpad / 2
+    aiplo = axdrp.astype(np.int64)
+    aiphi = aiplo + 1
+    awphi = axdrp - aiplo
+    awplo = 1.0 - awphi
+    return (awplo * gpad[:, aiplo] + awphi * gpad[:, aiphi]) * 2
+
+
 def fft_fq_to_gr(f, qbin, qmin):
     """
     Fourier Transform from F(Q) to G(r)
@@ -376,7 +422,7 @@ def get_grad_chi_sq(grad_rw, grad_pdf, gcalc, gobs, scale):
 
 
 # Misc. Kernels----------------------------------------------------------------
-@jit(target=targ)
+@jit(target=targ, cache=cache)
 def spring_force_kernel(direction, d, r, mag):
     n = len(r)
     for i in range(n):
@@ -0,0 +1,462 @@
+"""
+Memory budgets for the CPU calculations.
+
+`MemoryPlan` turns a memory budget into the chunking of a calculation from a
+byte model of the arrays each stage of the flat kernels allocates, so the
+chunk size does not change with whatever else is running on the machine and
+the whole calculation stays under the budget.  The backends which run in
+this process (nxn, flat-serial, flat-threaded and stream) are planned with
+an `InProcessPlan` from their byte models instead.  Every planned
+calculation leaves a `MemoryReport` with the predicted and the observed
+peak memory in `reports`, the observed peaks are measured with `tracemalloc`
+in the worker processes.  The in process backends are only measured if
+`trace` is set (or PYIID_MEMORY_TRACE=1), as tracing adds about a
+millisecond to each calculation, otherwise their reports only hold the
+predictions.  A tracer someone else started, eg. a memory profile, is left
+alone and the calculation is not measured.
+
+The budget is set with `set_memory_budget` or the PYIID_MEMORY_BUDGET
+environment variable, in bytes or with a K, M or G suffix.  Without a budget
+80% of the memory available at the start of the calculation is used.  The
+budget covers the arrays the calculation makes, not the interpreter and
+compiled kernels of each worker process.
+"""
+import os
+import functools
+from collections import deque
+from multiprocessing import cpu_count
+import psutil
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__author__ = 'christopher'
+
+_suffixes = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_bytes(value):
+    """
+    Read a number of bytes
+
+    Parameters
+    ----------
+    value: int, float or str
+        The bytes, strings can end in K, M, G or T (powers of 1024)
+
+    Returns
+    -------
+    int:
+        The number of bytes
+
+    >>> parse_bytes('1.5K'), parse_bytes('2G'), parse_bytes(100)
+    (1536, 2147483648, 100)
+    """
+    if isinstance(value, str):
+        value = value.strip().upper().rstrip('B')
+        if value and value[-1] in _suffixes:
+            return int(float(value[:-1]) * _suffixes[value[-1]])
+    return int(float(value))
+
+
+# The memory budget in bytes, None uses 80% of the available memory
+memory_budget = None
+if os.getenv('PYIID_MEMORY_BUDGET'):
+    memory_budget = parse_bytes(os.getenv('PYIID_MEMORY_BUDGET'))
+
+# Measure the observed peak of the in process calculations, off by default
+# as it traces every allocation of the calculation
+trace = os.getenv('PYIID_MEMORY_TRACE', '0') not in ['', '0']
+
+# Room for the python objects of each task, on top of its arrays
+task_bytes = 2 ** 16
+
+# The reports of the last calculations, newest last
+reports = deque(maxlen=100)
+
+
+def set_memory_budget(budget):
+    """
+    Set the memory budget of the CPU calculations
+
+    Parameters
+    ----------
+    budget: int, str or None
+        The budget in bytes (see `parse_bytes`), None to use 80% of the
+        available memory
+    """
+    global memory_budget
+    memory_budget = None if budget is None else parse_bytes(budget)
+
+
+def get_memory_budget():
+    if memory_budget is not None:
+        return memory_budget
+    return int(.8 * psutil.virtual_memory().available)
+
+
+def get_last_report():
+    """
+    The report of the last planned calculation, None if there has not been
+    one
+    """
+    if not reports:
+        return None
+    return reports[-1]
+
+
+def chunk_bytes(kind, n, qmax_bin, k):
+    """
+    The peak bytes of the arrays `atomic_fq` or `atomic_grad_fq` make for a
+    chunk of k pairs, d (kx3), r (k) and the kxQ arrays are all held at once
+
+    Parameters
+    ----------
+    kind: {'fq', 'grad'}
+        The calculation
+    n: int
+        The number of atoms
+    qmax_bin: int
+        The number of Q bins
+    k: int
+        The number of pairs in the chunk
+
+    Returns
+    -------
+    int:
+        The bytes
+
+    >>> chunk_bytes('fq', 10, 250, 45)
+    137720
+    """
+    if kind == 'fq':
+        # d, r, norm, omega and fq, the float64 sum over k
+        return 16 * k + 3 * 4 * k * qmax_bin + 8 * qmax_bin
+    # d, r, norm, omega, grad_omega (kx3xQ), grad (kx3xQ), the Nx3xQ sum
+    return 16 * k + 32 * k * qmax_bin + 12 * n * qmax_bin
+
+
+def result_bytes(kind, n, qmax_bin):
+    # the answer of one chunk, as sent back to the parent
+    if kind == 'fq':
+        return 8 * qmax_bin
+    return 12 * n * qmax_bin
+
+
+def total_bytes(kind, n, qmax_bin):
+    # the float64 running sum in the parent
+    if kind == 'fq':
+        return 8 * qmax_bin
+    return 24 * n * qmax_bin
+
+
+def input_bytes(n, qmax_bin, n_elements):
+    # the positions (Nx3), the element index (N) and the scatter table
+    return 12 * n + 4 * n + 4 * n_elements * qmax_bin
+
+
+def nxn_bytes(kind, n, qmax_bin):
+    """
+    The peak bytes of the nxn backend, which holds every ordered pair at once
+
+    >>> nxn_bytes('grad', 100, 250) // 2 ** 20
+    48
+    """
+    pairs = n * n
+    if kind == 'fq':
+        # d (NxNx3), r and the NxNxQ norm and omega
+        return 16 * pairs + 8 * pairs * qmax_bin
+    # and grad_omega (NxNx3xQ) and its Nx3xQ sum
+    return 16 * pairs + 20 * pairs * qmax_bin + 12 * n * qmax_bin
+
+
+def flat_serial_bytes(kind, n, qmax_bin):
+    """
+    The peak bytes of the flat-serial backend, which holds every pair at once
+
+    >>> flat_serial_bytes('grad', 2000, 250) // 2 ** 30
+    9
+    """
+    k = n * (n - 1) // 2
+    if kind == 'fq':
+        # d (kx3), r and the kxQ norm and omega
+        return 16 * k + 8 * k * qmax_bin
+    # and grad_omega (kx3xQ) and the Nx3xQ sum
+    return 16 * k + 20 * k * qmax_bin + 12 * n * qmax_bin
+
+
+def threaded_bytes(kind, n, qmax_bin, blocks):
+    """
+    The peak bytes of the flat-threaded backend, the accumulators of each
+    block, their sum and the normalization
+    """
+    if kind == 'fq':
+        # four float64 rows of Q per thread and a few more for the sum
+        return 12 * n + 32 * qmax_bin * (blocks + 1)
+    # one Nx3xQ float32 block per thread, then the sum, the normalized
+    # answer and the copy and masks nan_to_num makes
+    return 12 * n + 12 * n * qmax_bin * (blocks + 3) + 3 * n * qmax_bin
+
+
+class MemoryReport(object):
+    """
+    The planned and the measured memory of a calculation
+
+    Attributes
+    ----------
+    predicted_worker, observed_worker: int
+        The peak bytes of one worker, observed is the largest over the chunks
+    predicted_parent, observed_parent: int
+        The peak bytes of the reduction in the parent process, or of the
+        whole calculation if it has no worker processes
+    """
+
+    def __init__(self, plan):
+        self.kind = plan.kind
+        self.n = plan.n
+        self.qmax_bin = plan.qmax_bin
+        self.budget = plan.budget
+        self.processes = plan.processes
+        self.chunk_pairs = plan.chunk_pairs
+        self.n_chunks = len(plan.chunks)
+        self.predicted_worker = plan.worker_bytes
+        self.predicted_parent = plan.parent_bytes
+        self.observed_worker = 0
+        self.observed_parent = 0
+
+    @property
+    def predicted_peak(self):
+        return self.predicted_parent + self.processes * self.predicted_worker
+
+    @property
+    def observed_peak(self):
+        return self.observed_parent + self.processes * self.observed_worker
+
+    def __repr__(self):
+        return ('MemoryReport({0}, n={1}, qmax_bin={2}, budget={3}, '
+                'processes={4}, chunks={5}x{6} pairs, predicted peak={7}, '
+                'observed peak={8})'.format(
+                    self.kind, self.n, self.qmax_bin, self.budget,
+                    self.processes, self.n_chunks, self.chunk_pairs,
+                    self.predicted_peak, self.observed_peak))
+
+
+class MemoryPlan(object):
+    """
+    The chunking of a flat calculation which fits in a memory budget
+
+    The parent holds the running sum and, at worst, one answer from each
+    worker waiting to be added, the rest of the budget is split between the
+    workers.  If a worker cannot fit one pair fewer workers are used.
+
+    Parameters
+    ----------
+    kind: {'fq', 'grad'}
+        The calculation
+    n: int
+        The number of atoms
+    qmax_bin: int
+        The number of Q bins
+    n_elements: int
+        The number of elements in the scatter table
+    budget: int, optional
+        The budget in bytes, defaults to `get_memory_budget()`
+    processes: int, optional
+        The most worker processes, defaults to the number of cores
+
+    Raises
+    ------
+    MemoryError:
+        If not even one pair fits in the budget
+    """
+
+    def __init__(self, kind, n, qmax_bin, n_elements=1, budget=None,
+                 processes=None):
+        if kind not in ['fq', 'grad']:
+            raise ValueError('kind must be fq or grad, not {0}'.format(kind))
+        self.kind = kind
+        self.n = int(n)
+        self.qmax_bin = int(qmax_bin)
+        self.budget = get_memory_budget() if budget is None else \
+            parse_bytes(budget)
+        self.k_max = self.n * (self.n - 1) // 2
+        processes = max(cpu_count() if processes is None else processes, 1)
+        self.input_bytes = input_bytes(self.n, self.qmax_bin, n_elements)
+        fixed = chunk_bytes(kind, self.n, self.qmax_bin, 0) + \
+            self.input_bytes + task_bytes
+        per_pair = chunk_bytes(kind, self.n, self.qmax_bin, 1) - \
+            chunk_bytes(kind, self.n, self.qmax_bin, 0)
+        answer = result_bytes(kind, self.n, self.qmax_bin)
+        total = total_bytes(kind, self.n, self.qmax_bin)
+        for p in range(processes, 0, -1):
+            parent = total + p * answer
+            m = (self.budget - parent) // p - fixed
+            m = m // per_pair if m > 0 else 0
+            if m >= 1:
+                break
+        else:
+            raise MemoryError(
+                'A {0} budget of {1} bytes does not fit one pair of {2} '
+                'atoms and {3} Q bins'.format(kind, self.budget, self.n,
+                                              self.qmax_bin))
+        # an even split, so the last chunk is not a sliver
+        n_chunks = max(-(-self.k_max // m), 1)
+        m = max(-(-self.k_max // n_chunks), 1)
+        self.chunk_pairs = int(m)
+        self.chunks = [(min(m, self.k_max - k_cov), k_cov)
+                       for k_cov in range(0, self.k_max, m)]
+        self.processes = max(min(p, len(self.chunks)), 1)
+        self.worker_bytes = self.input_bytes + task_bytes + chunk_bytes(
+            kind, self.n, self.qmax_bin, self.chunk_pairs)
+        self.parent_bytes = total + self.processes * answer
+        self.report = MemoryReport(self)
+
+    def observe_worker(self, peak):
+        self.report.observed_worker = max(self.report.observed_worker,
+                                          int(peak) + self.input_bytes)
+
+    def observe_parent(self, nbytes):
+        self.report.observed_parent = max(self.report.observed_parent,
+                                          int(nbytes))
+
+
+class InProcessPlan(object):
+    """
+    The memory of a calculation made in this process, from the byte model of
+    its backend
+
+    Parameters
+    ----------
+    kind: {'fq', 'grad'}
+        The calculation
+    n: int
+        The number of atoms
+    qmax_bin: int
+        The number of Q bins
+    nbytes: int
+        The predicted peak bytes
+    budget: int, optional
+        The budget in bytes, defaults to `get_memory_budget()`
+
+    Raises
+    ------
+    MemoryError:
+        If the calculation does not fit in the budget
+    """
+
+    def __init__(self, kind, n, qmax_bin, nbytes, budget=None):
+        self.kind = kind
+        self.n = int(n)
+        self.qmax_bin = int(qmax_bin)
+        self.budget = get_memory_budget() if budget is None else \
+            parse_bytes(budget)
+        if nbytes > self.budget:
+            raise MemoryError(
+                'A {0} of {1} atoms and {2} Q bins needs {3} bytes, over the '
+                'budget of {4} bytes'.format(kind, self.n, self.qmax_bin,
+                                             int(nbytes), self.budget))
+        self.k_max = self.n * (self.n - 1) // 2
+        self.chunk_pairs = self.k_max
+        self.chunks = [(self.k_max, 0)]
+        # no worker processes, the parent holds everything
+        self.processes = 0
+        self.worker_bytes = 0
+        self.parent_bytes = int(nbytes)
+        self.report = MemoryReport(self)
+
+    def run(self, function, *args):
+        """
+        Call a function, measure its peak memory (if `trace` is on) and add
+        the report to `reports`
+
+        Returns
+        -------
+        ans:
+            The answer of the function
+        """
+        if trace:
+            ans, peak = measure_task((lambda a: function(*a), args))
+            self.report.observed_parent = int(peak)
+        else:
+            ans = function(*args)
+        reports.append(self.report)
+        return ans
+
+
+def planned(kind, byte_model):
+    """
+    Plan each call of the `wrap_fq` or `wrap_fq_grad` of an in process
+    backend with an `InProcessPlan` and report its memory
+
+    Parameters
+    ----------
+    kind: {'fq', 'grad'}
+        The calculation
+    byte_model: callable
+        byte_model(kind, n, qmax_bin) gives the peak bytes of the backend
+
+    Returns
+    -------
+    callable:
+        The decorator
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(atoms, qbin=.1, sum_type='fq'):
+            from pyiid.experiments.elasticscatter.atomics import \
+                get_scatter_tables
+            n = len(atoms)
+            qmax_bin = get_scatter_tables(atoms, sum_type)[1].shape[1]
+            plan = InProcessPlan(kind, n, qmax_bin,
+                                 byte_model(kind, n, qmax_bin))
+            return plan.run(f, atoms, qbin, sum_type)
+
+        return wrapper
+
+    return decorator
+
+
+def warm_up(function, args):
+    """
+    Run a small task so the kernels are compiled (or loaded from the cache)
+    before anything is measured, as a pool initializer
+
+    Parameters
+    ----------
+    function: callable
+        The function
+    args: tuple
+        A small argument for it
+    """
+    function(args)
+
+
+def measure_task(task):
+    """
+    Run a task, measuring the peak memory it allocates
+
+    Parameters
+    ----------
+    task: (callable, tuple)
+        The function and its argument
+
+    Returns
+    -------
+    ans:
+        The answer of the function
+    peak: int
+        The peak bytes traced while it ran, 0 without tracemalloc or if it
+        is already tracing, resetting the peak of somebody else's tracer
+        would spoil their measurement
+    """
+    function, args = task
+    if tracemalloc is None or tracemalloc.is_tracing():
+        return function(args), 0
+    tracemalloc.start()
+    try:
+        ans = function(args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return ans, peak
@@ -8,6 +8,7 @@ from pyiid.experiments.elasticscatter.mpi_wrappers.mpi_master import \
     gpu_avail, mpi_fq, mpi_grad_fq
 from pyiid.experiments.elasticscatter.gpu_wrappers.gpu_wrap import \
     gpu_fq_atoms_allocation, atoms_per_gpu_grad_fq
+from pyiid.experiments.elasticscatter.atomics import get_scatter_factors
 __author__ = 'christopher'
 
 
@@ -28,10 +29,8 @@ def wrap_fq(atoms, qbin=.1, sum_type='fq'):
     q = atoms.get_positions()
     q = q.astype(np.float32)
     n = len(q)
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter')
-    else:
-        scatter_array = atoms.get_array('PDF scatter')
+    # the GPU kernels read the per atom scatter factors
+    scatter_array = get_scatter_factors(atoms, sum_type)
     qmax_bin = scatter_array.shape[1]
 
     # get  number of allocated nodes
@@ -79,10 +78,8 @@ def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
     q = atoms.get_positions()
     q = q.astype(np.float32)
     n = len(q)
-    if sum_type == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter')
-    else:
-        scatter_array = atoms.get_array('PDF scatter')
+    # the GPU kernels read the per atom scatter factors
+    scatter_array = get_scatter_factors(atoms, sum_type)
     qmax_bin = scatter_array.shape[1]
 
     n_nodes = count_nodes()
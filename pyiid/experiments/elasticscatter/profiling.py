@@ -0,0 +1,251 @@
+"""
+Opt-in profiling of the scattering calculations.
+
+The backends mark the stages of their calculations with `stage`, eg.
+
+    with stage('get_omega'):
+        get_omega(omega, r, qbin)
+
+When nothing is being profiled `stage` gives back one shared do-nothing
+context, so a mark costs a function call.  `ElasticScatter.profile` makes a
+`Stats` active, which then records the number of calls, the cumulative wall
+time and, if asked, the bytes allocated (traced with `tracemalloc`) of each
+stage, by backend.
+
+>>> stats = Stats()
+>>> with profile(stats):
+...     with backend('CPU/test'):
+...         with stage('sum'):
+...             x = sum(range(10))
+>>> stats.records[('CPU/test', 'sum')].calls
+1
+"""
+from __future__ import print_function
+import time
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__author__ = 'christopher'
+
+# The Stats being recorded into, None when not profiling
+_active = None
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, stats, name, backend=None):
+        self.stats = stats
+        self.name = name
+        self.backend = backend
+
+    def __enter__(self):
+        self.stats._enter(self.name, self.backend)
+        return self
+
+    def __exit__(self, *args):
+        self.stats._exit()
+        return False
+
+
+def stage(name):
+    """
+    Mark a stage of a calculation
+
+    Parameters
+    ----------
+    name: str
+        The name of the stage
+
+    Returns
+    -------
+    context manager:
+        Times the stage if profiling is on
+    """
+    if _active is None:
+        return _null_stage
+    return _Stage(_active, name)
+
+
+def backend(name):
+    """
+    Mark a whole backend call, the stages inside it are recorded under
+    this backend and the call itself as its 'total' stage
+
+    Parameters
+    ----------
+    name: str
+        The backend, as processor/kernel_type
+    """
+    if _active is None:
+        return _null_stage
+    return _Stage(_active, 'total', name)
+
+
+def profiled(name, function):
+    """
+    Wrap a backend function so its calls are marked with `backend`
+
+    Parameters
+    ----------
+    name: str
+        The backend, as processor/kernel_type
+    function: callable
+        The backend function
+
+    Returns
+    -------
+    callable:
+        The wrapped function
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return function(*args, **kwargs)
+        with backend(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+class StageRecord(object):
+    """
+    The totals of one stage
+
+    Attributes
+    ----------
+    calls: int
+        The number of calls
+    time: float
+        The cumulative wall time, in seconds
+    bytes: int
+        The cumulative bytes allocated, the peak above the start of each call
+    peak_bytes: int
+        The most bytes allocated by one call
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.
+        self.bytes = 0
+        self.peak_bytes = 0
+
+    def __repr__(self):
+        return 'StageRecord(calls={0}, time={1:.6f}, bytes={2})'.format(
+            self.calls, self.time, self.bytes)
+
+
+class Stats(object):
+    """
+    The per stage, per backend totals of the profiled calculations
+
+    Parameters
+    ----------
+    memory: bool
+        Also record the bytes allocated by each stage, this traces every
+        allocation while profiling so it slows down python heavy code
+
+    Attributes
+    ----------
+    records: OrderedDict
+        The `StageRecord` of each (backend, stage), in the order the stages
+        were first seen, stages outside of a backend call have the backend ''
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory and tracemalloc is not None and \
+            hasattr(tracemalloc, 'reset_peak')
+        self.records = OrderedDict()
+        # The open stages, [key, backend, start time, start bytes,
+        # peak bytes seen by nested stages]
+        self._stack = []
+
+    def reset(self):
+        self.records.clear()
+
+    def _enter(self, name, backend=None):
+        if backend is None:
+            backend = self._stack[-1][1] if self._stack else ''
+        mem = 0
+        if self.memory:
+            mem, peak = tracemalloc.get_traced_memory()
+            # the peak is reset for this stage, keep the enclosing one's
+            if self._stack:
+                self._stack[-1][4] = max(self._stack[-1][4], peak)
+            tracemalloc.reset_peak()
+        self._stack.append([(backend, name), backend, time.time(), mem, 0])
+
+    def _exit(self):
+        key, backend, t0, mem, nested_peak = self._stack.pop()
+        dt = time.time() - t0
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = StageRecord()
+        record.calls += 1
+        record.time += dt
+        if self.memory:
+            peak = max(tracemalloc.get_traced_memory()[1], nested_peak)
+            record.bytes += peak - mem
+            record.peak_bytes = max(record.peak_bytes, peak - mem)
+            if self._stack:
+                self._stack[-1][4] = max(self._stack[-1][4], peak)
+
+    def report(self):
+        """
+        A table of the records
+
+        Returns
+        -------
+        str:
+            One line per backend and stage
+        """
+        lines = ['{0:<20} {1:<28} {2:>8} {3:>12} {4:>14}'.format(
+            'backend', 'stage', 'calls', 'time (s)', 'bytes')]
+        for (b, name), record in self.records.items():
+            lines.append('{0:<20} {1:<28} {2:>8} {3:>12.6f} {4:>14}'.format(
+                b, name, record.calls, record.time,
+                record.bytes if self.memory else '-'))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return self.report()
+
+
+@contextmanager
+def profile(stats):
+    """
+    Record the marked stages into a `Stats`
+
+    Parameters
+    ----------
+    stats: Stats
+        The stats to record into
+    """
+    global _active
+    old = _active
+    started = False
+    if stats.memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started = True
+    _active = stats
+    try:
+        yield stats
+    finally:
+        _active = old
+        if started:
+            tracemalloc.stop()
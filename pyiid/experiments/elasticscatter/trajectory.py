@@ -0,0 +1,461 @@
+"""
+Stream the F(Q) and PDF of every frame of a trajectory to disk.
+
+`TrajectoryPDF` reads the frames one batch at a time (any format
+`ase.io.iread` reads, eg. ASE .traj, extxyz or LAMMPS dumps), hands the
+batches to a pool of `ElasticScatter` workers, which use the batched
+`get_fq_batch`/`get_pdf_batch`, and appends the results, in frame order, to
+row files in the output directory which are read back as memory maps.  The
+running mean and variance of F(Q) and G(r) over the frames are kept with
+Welford updates.  At most a few batches are in flight, so the memory used
+does not depend on the length of the trajectory.
+
+The progress is checkpointed into the output directory, a pipeline run again
+with the same output directory, experiment and trajectory carries on from the
+last checkpoint.  The trajectory is told apart by a hash of its first frame.
+
+    pdfs = TrajectoryPDF('out', {'qmax': 25, 'rmax': 20})
+    pdfs.run('md.traj')
+    mean, var = pdfs.stats['pdf'].mean, pdfs.stats['pdf'].variance
+    frame_10 = pdfs.get_rows('pdf')[10]
+
+From the command line:
+
+    pyiid pdf md.traj out [--format FORMAT] [--qmax 25] [--rmax 40] ...
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+from collections import deque
+from multiprocessing import cpu_count
+import numpy as np
+
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.shared.pool import Pool
+
+__author__ = 'christopher'
+
+# The quantities written for each frame
+quantities = ['fq', 'pdf']
+# The least time between checkpoints, in seconds
+checkpoint_interval = 60.
+
+
+def read_frames(filename, start=0, format=None):
+    """
+    Read the frames of a trajectory one at a time
+
+    Parameters
+    ----------
+    filename: str
+        The trajectory, any file `ase.io.iread` can read
+    start: int
+        The first frame read
+    format: str, optional
+        The file format, guessed from the file name if not given
+
+    Returns
+    -------
+    generator of ase.Atoms:
+        The frames
+    """
+    from ase.io import iread
+    for atoms in iread(filename, index=slice(start, None), format=format):
+        yield atoms
+
+
+def get_frame_key(atoms):
+    """
+    A hash of a frame, the first frame of a trajectory stands for the
+    trajectory in a checkpoint
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The frame
+
+    Returns
+    -------
+    str:
+        The hash
+    """
+    h = hashlib.sha1()
+    for a in [atoms.numbers, atoms.positions, atoms.cell[:], atoms.pbc]:
+        h.update(np.ascontiguousarray(a, np.float64).tobytes())
+    return h.hexdigest()
+
+
+def get_batches(frames, size):
+    """
+    Group frames into lists of at most `size`
+
+    >>> [len(b) for b in get_batches(range(5), 2)]
+    [2, 2, 1]
+    """
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class RunningStats(object):
+    """
+    The running mean and variance of rows of data, with the batched form of
+    Welford's update (Chan et al.), which is stable for long runs
+
+    Parameters
+    ----------
+    width: int
+        The length of a row
+
+    >>> stats = RunningStats(2)
+    >>> stats.update(np.array([[1., 2.], [3., 2.]]))
+    >>> stats.update(np.array([[5., 2.]]))
+    >>> stats.mean.tolist(), stats.variance.tolist()
+    ([3.0, 2.0], [4.0, 0.0])
+    """
+
+    def __init__(self, width):
+        self.count = 0
+        self.mean = np.zeros(width)
+        self.m2 = np.zeros(width)
+
+    def update(self, rows):
+        """
+        Add rows
+
+        Parameters
+        ----------
+        rows: MxW array
+            The rows
+        """
+        rows = np.asarray(rows, np.float64)
+        m = len(rows)
+        if m == 0:
+            return
+        batch_mean = rows.mean(axis=0)
+        batch_m2 = np.sum((rows - batch_mean) ** 2, axis=0)
+        count = self.count + m
+        delta = batch_mean - self.mean
+        self.mean += delta * m / count
+        self.m2 += batch_m2 + delta ** 2 * self.count * m / count
+        self.count = count
+
+    @property
+    def variance(self):
+        # the sample variance, zero until there are two rows
+        if self.count < 2:
+            return np.zeros(self.m2.shape)
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+# The ElasticScatter of each worker process
+_worker_scatter = None
+
+
+def _init_worker(exp_dict, threads):
+    global _worker_scatter
+    from pyiid.experiments.elasticscatter.cpu_wrappers import \
+        flat_threaded_cpu_wrap
+    # the processes share the cores
+    flat_threaded_cpu_wrap.set_num_threads(threads)
+    _worker_scatter = ElasticScatter(dict(exp_dict))
+    # a worker can not start the process pool of the 'flat' kernel
+    _worker_scatter.set_processor('CPU', 'flat-threaded')
+
+
+def _process_batch(batch):
+    return (_worker_scatter.get_fq_batch(batch),
+            _worker_scatter.get_pdf_batch(batch))
+
+
+class TrajectoryPDF(object):
+    """
+    Stream the F(Q) and PDF of the frames of a trajectory into a directory
+
+    The directory holds fq.dat and pdf.dat, the rows of each frame as
+    float32, and state.npz, the checkpoint.
+
+    Parameters
+    ----------
+    output_dir: str
+        The directory, a checkpoint of the same experiment in it is carried
+        on from
+    exp_dict: dict, optional
+        The experiment, see `ElasticScatter`
+    processes: int, optional
+        The number of worker processes, defaults to the number of cores,
+        with 1 the frames are done in this process
+    batch_size: int
+        The number of frames in a batch
+    interval: float, optional
+        The least time between checkpoints, defaults to
+        `checkpoint_interval`
+
+    Attributes
+    ----------
+    frames: int
+        The number of frames done
+    trajectory: str
+        The `get_frame_key` of the first frame of the trajectory, None
+        until a frame is read
+    stats: dict
+        The `RunningStats` of 'fq' and 'pdf'
+    """
+
+    def __init__(self, output_dir, exp_dict=None, processes=None,
+                 batch_size=32, interval=None):
+        self.output_dir = output_dir
+        self.scatter = ElasticScatter(exp_dict)
+        self.scatter.set_processor('CPU', 'flat-threaded')
+        self.exp = dict(self.scatter.exp)
+        self.processes = max(cpu_count() if processes is None else processes,
+                             1)
+        self.batch_size = int(batch_size)
+        self.interval = checkpoint_interval if interval is None else interval
+        self.widths = {'fq': len(self.scatter.get_scatter_vector()),
+                       'pdf': len(self.scatter.get_r())}
+        self.key = self.get_key()
+        self.frames = 0
+        self.trajectory = None
+        self.stats = dict((q, RunningStats(self.widths[q]))
+                          for q in quantities)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        if os.path.exists(self.get_path('state.npz')):
+            self.load()
+        # drop the rows written after the last checkpoint
+        for q in quantities:
+            with open(self.get_path(q + '.dat'), 'ab') as f:
+                f.truncate(self.frames * self.widths[q] * 4)
+
+    def get_path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def get_key(self):
+        """
+        A hash of the experiment, a checkpoint is only carried on from by a
+        pipeline with the same key
+        """
+        return hashlib.sha1(json.dumps(self.exp, sort_keys=True).encode()
+                            ).hexdigest()
+
+    def save(self):
+        """
+        Write the checkpoint
+        """
+        arrays = {'key': np.array(self.key), 'frames': self.frames,
+                  'trajectory': np.array(self.trajectory or '')}
+        for q, stats in self.stats.items():
+            arrays[q + '_count'] = stats.count
+            arrays[q + '_mean'] = stats.mean
+            arrays[q + '_m2'] = stats.m2
+        # write then move so a stop while writing keeps the old checkpoint
+        tmp = self.get_path('state.{0}.tmp.npz'.format(os.getpid()))
+        np.savez(tmp, **arrays)
+        os.rename(tmp, self.get_path('state.npz'))
+
+    def load(self):
+        """
+        Read the checkpoint
+
+        Raises
+        ------
+        ValueError:
+            If the checkpoint is of a different experiment
+        """
+        with np.load(self.get_path('state.npz')) as f:
+            if str(f['key']) != self.key:
+                raise ValueError('{0} holds a different experiment'.format(
+                    self.output_dir))
+            self.frames = int(f['frames'])
+            self.trajectory = str(f['trajectory']) or None
+            for q, stats in self.stats.items():
+                stats.count = int(f[q + '_count'])
+                stats.mean = f[q + '_mean'].copy()
+                stats.m2 = f[q + '_m2'].copy()
+
+    def check_trajectory(self, atoms):
+        """
+        Check the first frame of the trajectory against the checkpoint
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The first frame
+
+        Raises
+        ------
+        ValueError:
+            If frames of a different trajectory have been done
+        """
+        key = get_frame_key(atoms)
+        if self.frames and self.trajectory not in [None, key]:
+            raise ValueError('{0} holds a different trajectory'.format(
+                self.output_dir))
+        self.trajectory = key
+
+    def get_rows(self, quantity):
+        """
+        The rows written so far
+
+        Parameters
+        ----------
+        quantity: {'fq', 'pdf'}
+            The quantity
+
+        Returns
+        -------
+        FxW memmap:
+            One row per frame
+        """
+        if self.frames == 0:
+            return np.zeros((0, self.widths[quantity]), np.float32)
+        return np.memmap(self.get_path(quantity + '.dat'), np.float32, 'r',
+                         shape=(self.frames, self.widths[quantity]))
+
+    def _write(self, files, results):
+        for q, rows in zip(quantities, results):
+            files[q].write(np.ascontiguousarray(rows, np.float32).tobytes())
+            files[q].flush()
+            self.stats[q].update(rows)
+        self.frames += len(results[0])
+
+    def run(self, frames, max_frames=None, format=None, verbose=False):
+        """
+        Compute the frames
+
+        Parameters
+        ----------
+        frames: iterable of ase.Atoms or str
+            The frames, from the first frame of the trajectory on, the frames
+            already done are skipped.  A file name is read with
+            `read_frames`, which skips them without parsing them where the
+            format allows it.  The first frame must be that of the
+            checkpoint
+        max_frames: int, optional
+            Stop after this many frames in total, the pipeline can be run
+            again to carry on
+        format: str, optional
+            The format of a trajectory file
+        verbose: bool
+            Print the progress at each checkpoint
+
+        Returns
+        -------
+        int:
+            The number of frames done
+
+        Raises
+        ------
+        ValueError:
+            If the checkpoint is of a different trajectory
+        """
+        if isinstance(frames, str):
+            first = next(read_frames(frames, 0, format), None)
+            frames = read_frames(frames, self.frames, format)
+        else:
+            frames = iter(frames)
+            first = next(frames, None)
+            frames = itertools.chain([first] if first is not None else [],
+                                     frames)
+            for i in range(self.frames):
+                next(frames, None)
+        if first is not None:
+            self.check_trajectory(first)
+        if max_frames is not None:
+            frames = (f for i, f in zip(range(max_frames - self.frames),
+                                        frames))
+        batches = get_batches(frames, self.batch_size)
+        from pyiid.experiments.elasticscatter.cpu_wrappers.\
+            flat_threaded_cpu_wrap import get_num_threads
+        files = dict((q, open(self.get_path(q + '.dat'), 'ab'))
+                     for q in quantities)
+        pool = None
+        last_save = time.time()
+        try:
+            if self.processes == 1:
+                results = (self._compute(b) for b in batches)
+            else:
+                threads = max(get_num_threads() // self.processes, 1)
+                # not forked, this process may have run the threaded kernels
+                pool = Pool(self.processes, _init_worker,
+                            (self.exp, threads))
+                results = self._imap_bounded(pool, batches)
+            for result in results:
+                self._write(files, result)
+                if time.time() - last_save >= self.interval:
+                    self.save()
+                    last_save = time.time()
+                    if verbose:
+                        print('{0} frames done'.format(self.frames))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            for f in files.values():
+                f.close()
+            self.save()
+        return self.frames
+
+    def _compute(self, batch):
+        return (self.scatter.get_fq_batch(batch),
+                self.scatter.get_pdf_batch(batch))
+
+    def _imap_bounded(self, pool, batches):
+        # Pool.imap reads all of its input at once, here at most two
+        # batches per worker are read ahead
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(_process_batch, (batch,)))
+            if len(pending) >= 2 * self.processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pyiid pdf',
+        description='Stream the F(Q) and PDF of every frame of a trajectory '
+                    'into a directory, with their running mean and variance')
+    parser.add_argument('trajectory')
+    parser.add_argument('output_dir')
+    parser.add_argument('--format', help='the trajectory format, see '
+                                         'ase.io.iread')
+    for key in ['qmin', 'qmax', 'qbin', 'rmin', 'rmax', 'rstep']:
+        parser.add_argument('--' + key, type=float)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args(argv)
+    exp = dict((k, v) for k, v in vars(args).items()
+               if k in ['qmin', 'qmax', 'qbin', 'rmin', 'rmax', 'rstep'] and
+               v is not None)
+    pipeline = TrajectoryPDF(args.output_dir, exp, args.processes,
+                             args.batch_size)
+    pipeline.run(args.trajectory, format=args.format, verbose=True)
+    np.savez(pipeline.get_path('averages.npz'),
+             q=pipeline.scatter.get_scatter_vector(),
+             r=pipeline.scatter.get_r(),
+             **dict((q + '_' + name, getattr(pipeline.stats[q], name))
+                    for q in quantities for name in ['mean', 'variance']))
+    print('{0} frames, averages in {1}'.format(
+        pipeline.frames, pipeline.get_path('averages.npz')))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,320 @@
+from __future__ import print_function
+
+"""
+The main class in this module `EXAFS` calculates the extended x-ray
+absorption fine structure of a collection of atoms in the single scattering
+approximation,
+
+chi(k) = S0**2 / N_abs sum_{a, j} F_aj(k) / (k r_aj**2)
+         exp(-2 k**2 sigma**2) exp(-2 r_aj / lambda) sin(2 k r_aj + phi_aj(k))
+
+where the sum runs over the absorbing atoms a and their neighbors j inside
+`rmax`.  The pairs come from a `NeighborList`, so the cost is
+O(N_abs neighbors k) and the list is reused while the atoms move less than
+its skin.  F and phi are tables per absorber/scatterer element pair, by
+default F = 1 and phi = 0, real amplitudes and phases (eg. from FEFF) can be
+loaded with `EXAFS.set_path_table`.
+"""
+import math
+import os
+import numpy as np
+from numba import jit, prange
+from ase.data import atomic_numbers
+from pyiid.neighbor_list import NeighborList, get_attached_neighbor_list
+from builtins import range
+
 __author__ = 'christopher'
+
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def get_chi_kernel(chi, r, path_type, amplitude, phase, damping, k, mfp):
+    """
+    Sum the single scattering paths
+
+    Parameters
+    ----------
+    chi: K array
+        Holds chi(k)
+    r: P array
+        The path half lengths (absorber-scatterer distances)
+    path_type: P array
+        The row of the amplitude and phase tables for each path
+    amplitude, phase: TxK arrays
+        The amplitude and phase tables
+    damping: K array
+        The prefactor S0**2 exp(-2 k**2 sigma**2) / k
+    k: K array
+        The photoelectron wavevectors
+    mfp: float
+        The photoelectron mean free path, 0 for no damping
+    """
+    for kx in prange(len(k)):
+        s = 0.
+        for p in range(len(r)):
+            rp = r[p]
+            t = path_type[p]
+            a = amplitude[t, kx] / (rp * rp)
+            if mfp > 0:
+                a *= math.exp(-2. * rp / mfp)
+            s += a * math.sin(2. * k[kx] * rp + phase[t, kx])
+        chi[kx] = s * damping[kx]
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def get_grad_chi_kernel(grad, absorber, scatterer, d, r, path_type,
+                        amplitude, phase, damping, k, mfp):
+    """
+    Calculate the negative gradient of chi(k) with respect to the atomic
+    positions
+
+    Parameters
+    ----------
+    grad: Nx3xK array
+        Holds the negative gradient
+    absorber, scatterer: P arrays
+        The atoms in each path
+    d: Px3 array
+        The path displacements q[scatterer] - q[absorber]
+    r: P array
+        The path half lengths
+    path_type: P array
+        The row of the amplitude and phase tables for each path
+    amplitude, phase: TxK arrays
+        The amplitude and phase tables
+    damping: K array
+        The prefactor S0**2 exp(-2 k**2 sigma**2) / k
+    k: K array
+        The photoelectron wavevectors
+    mfp: float
+        The photoelectron mean free path, 0 for no damping
+    """
+    # each thread owns a k slice so there are no write conflicts
+    for kx in prange(len(k)):
+        kk = k[kx]
+        for p in range(len(r)):
+            rp = r[p]
+            t = path_type[p]
+            a = amplitude[t, kx] / (rp * rp)
+            dadr = -2. / rp
+            if mfp > 0:
+                a *= math.exp(-2. * rp / mfp)
+                dadr -= 2. / mfp
+            x = 2. * kk * rp + phase[t, kx]
+            dchi = damping[kx] * a * (dadr * math.sin(x) +
+                                      2. * kk * math.cos(x))
+            # dr/dq_scatterer = d / r, dr/dq_absorber = -d / r
+            for w in range(3):
+                g = dchi * d[p, w] / rp
+                grad[absorber[p], w, kx] += g
+                grad[scatterer[p], w, kx] -= g
+
+
+class EXAFS(object):
+    """
+    EXAFS contains the methods associated with producing theoretical EXAFS
+    spectra from atomic configurations, with the same interface as
+    `ElasticScatter` so it can be used with `Calc1D`
+
+    Parameters
+    ----------
+    absorber: str or int
+        The absorbing element
+    exp_dict: dict, optional
+        The experimental parameters, 'kmin', 'kmax', 'kbin', 'rmax' (the
+        path cutoff), 'kweight', 's02', 'sigma2' and 'mfp' (the mean free
+        path, 0 for none)
+    skin: float
+        The neighbor list skin
+    verbose: bool
+        Print extra information
+
+    >>> from ase.atoms import Atoms
+    >>> atoms = Atoms('Au4', [[0, 0, 0], [3, 0, 0], [0, 3, 0], [3, 3, 0]])
+    >>> e = EXAFS('Au', {'rmax': 3.5})
+    >>> chi = e.get_chi(atoms)
+    >>> grad_chi = e.get_grad_chi(atoms)
+    >>> grad_chi.shape == (4, 3, len(e.get_scatter_vector()))
+    True
+    """
+
+    def __init__(self, absorber, exp_dict=None, skin=.3, verbose=False):
+        if not isinstance(absorber, int):
+            absorber = atomic_numbers[absorber]
+        self.absorber = absorber
+        self.verbose = verbose
+        self.exp_dict_keys = ['kmin', 'kmax', 'kbin', 'rmax', 'kweight',
+                              's02', 'sigma2', 'mfp']
+        self.default_values = [2., 14., .05, 6., 0, 1., .003, 0.]
+        self.exp = None
+        self.skin = skin
+        self.nl = None
+        # (absorber, scatterer): (k, amplitude, phase)
+        self.path_tables = {}
+        self._tables = {}
+        self.update_experiment(exp_dict)
+
+    def update_experiment(self, exp_dict):
+        """
+        Change the experiment parameters.
+
+        Parameters
+        ----------
+        exp_dict: dict or None
+            Dictionary of parameters to be updated, if None use defaults
+        """
+        if exp_dict is None or bool(exp_dict) is False:
+            exp_dict = {}
+        for key, dv in zip(self.exp_dict_keys, self.default_values):
+            if key not in exp_dict.keys():
+                exp_dict[key] = dv
+        self.exp = exp_dict
+        self._tables = {}
+        if self.nl is not None and self.nl.cutoff != self.exp['rmax']:
+            self.nl = None
+
+    def set_path_table(self, absorber, scatterer, k, amplitude, phase):
+        """
+        Set the scattering amplitude and phase for an element pair
+
+        Parameters
+        ----------
+        absorber, scatterer: str or int
+            The elements
+        k: 1darray
+            The wavevectors the tables are given on
+        amplitude: 1darray
+            The effective scattering amplitude F(k)
+        phase: 1darray
+            The total phase shift phi(k)
+        """
+        pair = tuple(z if isinstance(z, int) else atomic_numbers[z]
+                     for z in (absorber, scatterer))
+        self.path_tables[pair] = (np.asarray(k), np.asarray(amplitude),
+                                  np.asarray(phase))
+        self._tables = {}
+
+    def get_scatter_vector(self):
+        """
+        Calculate the photoelectron wavevectors for the current experiment
+
+        Returns
+        -------
+        1darray:
+            The k range for this experiment
+        """
+        return np.arange(self.exp['kmin'], self.exp['kmax'], self.exp['kbin'])
+
+    def _get_tables(self, scatterers):
+        # Amplitude and phase tables interpolated onto the k grid, one row
+        # per scatterer element
+        key = tuple(scatterers)
+        if key not in self._tables:
+            k = self.get_scatter_vector()
+            amplitude = np.ones((len(scatterers), len(k)))
+            phase = np.zeros((len(scatterers), len(k)))
+            for i, z in enumerate(scatterers):
+                pair = (self.absorber, int(z))
+                if pair in self.path_tables:
+                    kt, at, pt = self.path_tables[pair]
+                    amplitude[i] = np.interp(k, kt, at)
+                    phase[i] = np.interp(k, kt, pt)
+            self._tables[key] = amplitude, phase
+        return self._tables[key]
+
+    def get_paths(self, atoms):
+        """
+        Find the single scattering paths
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+
+        Returns
+        -------
+        absorber, scatterer: arrays
+            The atoms in each path
+        d: Px3 array
+            The path displacements q[scatterer] - q[absorber]
+        r: array
+            The path half lengths
+        path_type: array
+            The row of the amplitude and phase tables for each path
+        scatterers: array
+            The scatterer element of each table row
+        """
+        rmax = self.exp['rmax']
+        nl = get_attached_neighbor_list(atoms, rmax)
+        if nl is None:
+            if self.nl is None:
+                self.nl = NeighborList(rmax, self.skin)
+            nl = self.nl
+        offsets, indices = nl.get_neighbor_arrays(atoms, rmax)
+        i = np.repeat(np.arange(len(atoms)), np.diff(offsets))
+        numbers = atoms.get_atomic_numbers()
+        absorbing = numbers[i] == self.absorber
+        i, j = i[absorbing], indices[absorbing]
+        q = atoms.get_positions()
+        d = q[j] - q[i]
+        r = np.sqrt(np.sum(d ** 2, axis=1))
+        scatterers, path_type = np.unique(numbers[j], return_inverse=True)
+        return i, j, d, r, path_type.astype(np.int64), scatterers
+
+    def _get_damping(self, n_abs):
+        k = self.get_scatter_vector()
+        damping = self.exp['s02'] * np.exp(
+            -2. * k ** 2 * self.exp['sigma2']) / k / max(n_abs, 1)
+        return damping * k ** self.exp['kweight']
+
+    def get_chi(self, atoms):
+        """
+        Calculate the EXAFS, k**kweight chi(k)
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration for which to calculate chi(k)
+
+        Returns
+        -------
+        1darray:
+            The EXAFS
+        """
+        i, j, d, r, path_type, scatterers = self.get_paths(atoms)
+        amplitude, phase = self._get_tables(scatterers)
+        n_abs = np.sum(atoms.numbers == self.absorber)
+        k = self.get_scatter_vector()
+        chi = np.zeros(len(k))
+        get_chi_kernel(chi, r, path_type, amplitude, phase,
+                       self._get_damping(n_abs), k, float(self.exp['mfp']))
+        return chi
+
+    def get_grad_chi(self, atoms):
+        """
+        Calculate the gradient of the EXAFS
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration for which to calculate grad chi(k)
+
+        Returns
+        -------
+        3darray:
+            The gradient of the EXAFS, with the same sign convention as
+            `ElasticScatter` (the negative derivative with respect to the
+            positions) so it can be used with `Calc1D`
+        """
+        i, j, d, r, path_type, scatterers = self.get_paths(atoms)
+        amplitude, phase = self._get_tables(scatterers)
+        n_abs = np.sum(atoms.numbers == self.absorber)
+        k = self.get_scatter_vector()
+        grad = np.zeros((len(atoms), 3, len(k)))
+        get_grad_chi_kernel(grad, i, j, d, r, path_type, amplitude, phase,
+                            self._get_damping(n_abs), k,
+                            float(self.exp['mfp']))
+        return grad
@@ -1 +1,300 @@
+from __future__ import print_function
+
+"""
+The main class in this module `SAXS` calculates the small angle scattering
+of a collection of atoms.  At small Q the Debye sum over all pairs is mostly
+wasted work, instead the scattering amplitude
+A(Q) = sum_j f_j(Q) exp(i Q.r_j)
+is evaluated along M directions on the unit sphere and |A|**2 is averaged
+over them.  This is the quadrature form of the CRYSOL style multipole
+expansion, M directions resolve the spherical harmonics up to degree
+L ~ sqrt(M / 2), and since j_l(Qr) vanishes for l > QR only
+L ~ Q_max R_max + a few is needed.  The cost is O(N M Q) = O(N L**2 Q),
+rather than O(N**2 Q), and the gradient with respect to the atomic positions
+comes from the same amplitudes at the same cost.
+"""
+import math
+import os
+import numpy as np
+from numba import jit, prange
+from pyiid.asa import generate_sphere_points
+from pyiid.experiments.shared.scatter_factors import get_form_factor_table
+from builtins import range
+
 __author__ = 'christopher'
+
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def get_amplitude(re, im, proj, elements, scatter_array, qs):
+    """
+    Calculate the scattering amplitude along each direction
+
+    Parameters
+    ----------
+    re, im: QxM arrays
+        Hold the real and imaginary parts of the amplitude
+    proj: NxM array
+        The atomic positions projected onto each direction
+    elements: N array
+        The row of scatter_array for each atom
+    scatter_array: ExQ array
+        The scatter factors of each element
+    qs: Q array
+        The scatter vector magnitudes
+    """
+    n, m = proj.shape
+    for k in prange(len(qs)):
+        sv = qs[k]
+        for mm in range(m):
+            a = 0.
+            b = 0.
+            for j in range(n):
+                f = scatter_array[elements[j], k]
+                phase = sv * proj[j, mm]
+                a += f * math.cos(phase)
+                b += f * math.sin(phase)
+            re[k, mm] = a
+            im[k, mm] = b
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def get_grad_amplitude(grad, re, im, proj, directions, elements,
+                       scatter_array, qs):
+    """
+    Calculate the negative gradient of the orientationally averaged
+    intensity
+
+    Parameters
+    ----------
+    grad: Nx3xQ array
+        Holds the negative gradient
+    re, im: QxM arrays
+        The real and imaginary parts of the amplitude
+    proj: NxM array
+        The atomic positions projected onto each direction
+    directions: Mx3 array
+        The unit directions
+    elements: N array
+        The row of scatter_array for each atom
+    scatter_array: ExQ array
+        The scatter factors of each element
+    qs: Q array
+        The scatter vector magnitudes
+    """
+    n, m = proj.shape
+    for j in prange(n):
+        for k in range(len(qs)):
+            sv = qs[k]
+            gx = 0.
+            gy = 0.
+            gz = 0.
+            for mm in range(m):
+                phase = sv * proj[j, mm]
+                c = re[k, mm] * math.sin(phase) - im[k, mm] * math.cos(phase)
+                gx += c * directions[mm, 0]
+                gy += c * directions[mm, 1]
+                gz += c * directions[mm, 2]
+            a = 2. * scatter_array[elements[j], k] * sv / m
+            grad[j, 0, k] = a * gx
+            grad[j, 1, k] = a * gy
+            grad[j, 2, k] = a * gz
+
+
+class SAXS(object):
+    """
+    SAXS contains the methods associated with producing theoretical small
+    angle scattering patterns from atomic configurations, with the same
+    interface as `ElasticScatter`
+
+    Parameters
+    ----------
+    exp_dict: dict, optional
+        The experimental parameters, 'qmin', 'qmax' and 'qbin'
+    lmax: int, optional
+        The highest multipole order, if None it is chosen from qmax and the
+        size of the atomic configuration
+    verbose: bool
+        Print extra information
+    seed: int, optional
+        Seed for the noise generator
+
+    >>> from ase.atoms import Atoms
+    >>> atoms = Atoms('Au4', [[0, 0, 0], [3, 0, 0], [0, 3, 0], [3, 3, 0]])
+    >>> s = SAXS({'qmax': .5})
+    >>> iq = s.get_iq(atoms)
+    >>> grad_iq = s.get_grad_iq(atoms)
+    """
+
+    def __init__(self, exp_dict=None, lmax=None, verbose=False, seed=None):
+        self.verbose = verbose
+        if seed is None:
+            self.seed = int(np.random.random() * 2 ** 32)
+        elif isinstance(seed, int):
+            self.seed = seed
+        else:
+            raise ValueError('Expected an integer!')
+        self.rs = np.random.RandomState(self.seed)
+
+        self.exp_dict_keys = ['qmin', 'qmax', 'qbin']
+        self.default_values = [0.0, .5, .005]
+        self.exp = None
+        self.lmax = lmax
+        self._directions = {}
+        self._scatter = {}
+        self.update_experiment(exp_dict)
+
+    def update_experiment(self, exp_dict):
+        """
+        Change the scattering experiment parameters.
+
+        Parameters
+        ----------
+        exp_dict: dict or None
+            Dictionary of parameters to be updated, if None use defaults
+        """
+        if exp_dict is None or bool(exp_dict) is False:
+            exp_dict = {}
+        for key, dv in zip(self.exp_dict_keys, self.default_values):
+            if key not in exp_dict.keys():
+                exp_dict[key] = dv
+        self.exp = exp_dict
+        self._scatter = {}
+
+    def get_qmin_bin(self):
+        """
+        The first Q bin of the experiment, qmin is rounded to the nearest
+        bin so that eg. qmin=.3, qbin=.1 starts at the third bin
+
+        Returns
+        -------
+        int:
+            The index of qmin on the qbin grid
+        """
+        return int(round(self.exp['qmin'] / self.exp['qbin']))
+
+    def get_scatter_vector(self):
+        """
+        Calculate the scatter vector Q for the current experiment
+
+        Returns
+        -------
+        1darray:
+            The Q range for this experiment
+        """
+        qbin = self.exp['qbin']
+        return np.arange(self.get_qmin_bin(),
+                         int(math.floor(self.exp['qmax'] / qbin))) * qbin
+
+    def get_lmax(self, atoms):
+        """
+        The multipole order needed to describe the atoms out to qmax
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+
+        Returns
+        -------
+        int:
+            The highest multipole order
+        """
+        if self.lmax is not None:
+            return self.lmax
+        q = atoms.get_positions()
+        rmax = np.max(np.linalg.norm(q - np.mean(q, axis=0), axis=1))
+        return int(math.ceil(self.exp['qmax'] * rmax)) + 8
+
+    def get_directions(self, lmax):
+        """
+        The quadrature directions for a multipole order
+
+        Parameters
+        ----------
+        lmax: int
+            The highest multipole order
+
+        Returns
+        -------
+        Mx3 array:
+            The unit directions
+        """
+        if lmax not in self._directions:
+            self._directions[lmax] = generate_sphere_points(
+                2 * (lmax + 1) ** 2)
+        return self._directions[lmax]
+
+    def _get_scatter(self, atoms):
+        # Element-wise scatter factors, only the elements present are kept
+        e_list, elements = np.unique(atoms.numbers, return_inverse=True)
+        key = tuple(e_list)
+        if key not in self._scatter:
+            qbin = self.exp['qbin']
+            qmax_bin = int(math.floor(self.exp['qmax'] / qbin))
+            scatter_array = get_form_factor_table(e_list, qbin, qmax_bin)
+            self._scatter[key] = np.ascontiguousarray(
+                scatter_array[:, self.get_qmin_bin():], dtype=np.float64)
+        return elements.astype(np.int64), self._scatter[key]
+
+    def _get_amplitude(self, atoms):
+        qs = self.get_scatter_vector()
+        elements, scatter_array = self._get_scatter(atoms)
+        directions = self.get_directions(self.get_lmax(atoms))
+        q = atoms.get_positions()
+        # The intensity is translation invariant, centering keeps lmax small
+        proj = np.dot(q - np.mean(q, axis=0), directions.T)
+        re = np.zeros((len(qs), len(directions)))
+        im = np.zeros((len(qs), len(directions)))
+        get_amplitude(re, im, proj, elements, scatter_array, qs)
+        return re, im, proj, directions, elements, scatter_array, qs
+
+    def get_iq(self, atoms, iq_std=None, noise_distribution=np.random.normal):
+        """
+        Calculate the scattering intensity, I(Q)
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration for which to calculate I(Q)
+        iq_std: {None, float, ndarray}, optional
+            Add gaussian noise with this standard deviation to I(Q)
+        noise_distribution: distribution function
+            The distribution function to take the scattering pattern
+
+        Returns
+        -------
+        1darray:
+            The scattering intensity
+        """
+        re, im = self._get_amplitude(atoms)[:2]
+        iq = np.mean(re ** 2 + im ** 2, axis=1)
+        if iq_std is not None:
+            iq += self.rs.normal(0, iq_std, iq.shape)
+        return iq
+
+    def get_grad_iq(self, atoms):
+        """
+        Calculate the gradient of the scattering intensity
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration for which to calculate grad I(Q)
+
+        Returns
+        -------
+        3darray:
+            The gradient of the scattering intensity, with the same sign
+            convention as `ElasticScatter` (the negative derivative with
+            respect to the positions) so it can be used with `Calc1D`
+        """
+        re, im, proj, directions, elements, scatter_array, qs = \
+            self._get_amplitude(atoms)
+        grad = np.zeros((len(atoms), 3, len(qs)))
+        get_grad_amplitude(grad, re, im, proj, directions, elements,
+                           scatter_array, qs)
+        return grad
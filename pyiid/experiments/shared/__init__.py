@@ -1 +1,6 @@
+from pyiid.experiments.shared.geometry import GeometryCache, \
+    geometry_cache, get_positions_stamp, get_nxn_geometry, \
+    get_flat_geometry, get_neighbor_geometry
+from pyiid.experiments.shared.cache_dir import get_cache_root
+
 __author__ = 'christopher'
@@ -0,0 +1,17 @@
+import os
+
+__author__ = 'christopher'
+
+
+def get_cache_root():
+    """
+    The directory where pyiid keeps its on disk caches, `$PYIID_CACHE_DIR`
+    or ~/.cache/pyiid
+
+    Returns
+    -------
+    str:
+        The cache directory
+    """
+    return os.getenv('PYIID_CACHE_DIR',
+                     os.path.join(os.path.expanduser('~'), '.cache', 'pyiid'))
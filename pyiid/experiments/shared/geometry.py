@@ -0,0 +1,211 @@
+"""
+A cache of the pair geometry of atomic configurations.
+
+Several calculators evaluated on the same configuration (eg. the parts of a
+`MultiCalc`, or the energy and then the forces of one calculator) all need
+the pair displacements and distances.  Each calculator gets its own copy of
+the atoms, so the cache is keyed on a stamp of the positions rather than the
+atoms object, and holds the geometry of the last few configurations in the
+forms the kernels use:
+
+nxn
+    NxNx3 displacements d[i, j] = q[j] - q[i] and NxN distances, float32,
+    as used by the nxn kernels and the springs
+flat
+    kx3 displacements d[k] = q[i] - q[j] and k distances, float32, in the
+    k_to_ij order of the flat kernels
+neighbor
+    The CSR neighbor arrays of `get_neighbor_arrays` for a cutoff
+
+The cached arrays are shared between the consumers, so they are read only,
+they must be copied before being modified.  The cache holds at most
+`max_cache_bytes` of arrays, geometries bigger than that are not kept, and it
+is emptied when the number of atoms changes, so a simulation does not keep
+the geometries of sizes it has left behind.
+"""
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from pyiid.neighbor_list import get_neighbor_arrays
+
+__author__ = 'christopher'
+
+# The most bytes of arrays the cache holds by default
+max_cache_bytes = 2 ** 28
+
+
+def get_positions_stamp(atoms):
+    """
+    A stamp which changes whenever the positions change
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+
+    Returns
+    -------
+    str:
+        The stamp
+    """
+    q = np.ascontiguousarray(atoms.get_positions(), dtype=np.float64)
+    return hashlib.sha1(q.tobytes()).hexdigest()
+
+
+def get_nbytes(value):
+    # the bytes of the arrays of a cached geometry
+    return sum(a.nbytes for a in value if isinstance(a, np.ndarray))
+
+
+class GeometryCache(object):
+    """
+    Least recently used cache of pair geometries
+
+    Parameters
+    ----------
+    max_entries: int
+        The number of geometries to keep
+    max_bytes: int, optional
+        The most bytes of arrays to keep, defaults to `max_cache_bytes`
+
+    >>> from ase import Atoms
+    >>> atoms = Atoms('Au4', [[0, 0, 0], [3, 0, 0], [0, 3, 0], [3, 3, 0]])
+    >>> cache = GeometryCache()
+    >>> d, r = cache.get_nxn(atoms)
+    >>> d, r = cache.get_nxn(atoms.copy())
+    >>> cache.hits, cache.misses, cache.nbytes
+    (1, 1, 256)
+    >>> r.flags.writeable
+    False
+    """
+
+    def __init__(self, max_entries=4, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_cache_bytes if max_bytes is None else max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.n = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def _pop(self, key):
+        value = self.entries.pop(key)
+        self.nbytes -= get_nbytes(value)
+        return value
+
+    def _get(self, atoms, form, factory):
+        if len(atoms) != self.n:
+            # the geometries of other sizes will not be asked for again soon
+            self.clear()
+            self.n = len(atoms)
+        key = (get_positions_stamp(atoms), form)
+        if key in self.entries:
+            self.hits += 1
+            value = self._pop(key)
+        else:
+            self.misses += 1
+            value = factory(atoms.get_positions())
+            for a in value:
+                a.flags.writeable = False
+        size = get_nbytes(value)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return value
+        while self.entries and (len(self.entries) >= self.max_entries or
+                                self.nbytes + size > self.max_bytes):
+            self._pop(next(iter(self.entries)))
+        self.entries[key] = value
+        self.nbytes += size
+        return value
+
+    def get_nxn(self, atoms):
+        """
+        Get the all pairs displacements and distances
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+
+        Returns
+        -------
+        d: NxNx3 array
+            The displacements, d[i, j] = q[j] - q[i]
+        r: NxN array
+            The distances
+        """
+        def factory(q):
+            q = q.astype(np.float32)
+            d = q[np.newaxis, :, :] - q[:, np.newaxis, :]
+            r = np.sqrt(np.sum(d * d, axis=-1))
+            return d, r
+
+        return self._get(atoms, 'nxn', factory)
+
+    def get_flat(self, atoms):
+        """
+        Get the unique pair displacements and distances
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+
+        Returns
+        -------
+        d: kx3 array
+            The displacements, d[k] = q[i] - q[j] with i, j = k_to_ij(k)
+        r: k array
+            The distances
+        """
+        def factory(q):
+            q = q.astype(np.float32)
+            # k = j + i * (i - 1) / 2 with j < i is the lower triangle in
+            # row major order
+            i, j = np.tril_indices(len(q), -1)
+            d = q[i] - q[j]
+            r = np.sqrt(np.sum(d * d, axis=-1))
+            return d, r
+
+        return self._get(atoms, 'flat', factory)
+
+    def get_neighbor_arrays(self, atoms, cutoff):
+        """
+        Get the neighbors of every atom inside the cutoff
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+        cutoff: float
+            The cutoff distance
+
+        Returns
+        -------
+        offsets: N + 1 array
+            The neighbors of atom i are indices[offsets[i]:offsets[i + 1]]
+        indices: array
+            The neighbor indices
+        """
+        def factory(q):
+            return get_neighbor_arrays(cutoff, q)
+
+        return self._get(atoms, ('neighbor', float(cutoff)), factory)
+
+
+geometry_cache = GeometryCache()
+
+
+def get_nxn_geometry(atoms):
+    return geometry_cache.get_nxn(atoms)
+
+
+def get_flat_geometry(atoms):
+    return geometry_cache.get_flat(atoms)
+
+
+def get_neighbor_geometry(atoms, cutoff):
+    return geometry_cache.get_neighbor_arrays(atoms, cutoff)
@@ -0,0 +1,76 @@
+"""
+Process pools which are safe to start after the thread parallel kernels ran.
+
+Forking a process whose numba threading layer (eg. TBB) already has worker
+threads can leave the child waiting on a lock held by a thread which does
+not exist in the child.  Until the threading layer has started in this
+process the pools are forked, as `multiprocessing.Pool` would.  After that
+they are started from a forkserver, a clean process which never runs the
+threaded kernels, or by spawning where there is no forkserver.  The
+forkserver imports the modules in `preload` once, so the workers it forks
+do not import numba and the kernels again.
+
+Spawned and forkserver workers import the ``__main__`` module, so a script
+which starts a pool after running the threaded kernels ('flat-threaded',
+'stream' or the batched F(Q)) must keep its top level code under
+``if __name__ == '__main__':``.
+"""
+import multiprocessing
+
+__author__ = 'christopher'
+
+# The modules the forkserver imports before it forks any workers
+preload = ['numpy', 'numba',
+           'pyiid.experiments.elasticscatter.atomics.cpu_atomics',
+           'pyiid.experiments.elasticscatter.memory']
+
+_context = None
+
+
+def threads_started():
+    """
+    Whether numba's threading layer has started its threads in this process
+
+    Returns
+    -------
+    bool:
+        True if a parallel kernel has run, or if this can not be told
+    """
+    try:
+        from numba.np.ufunc import parallel
+    except ImportError:
+        return True
+    return getattr(parallel, '_is_initialized', True)
+
+
+def get_context():
+    """
+    The multiprocessing context the pools are made with
+
+    Returns
+    -------
+    multiprocessing.context.BaseContext:
+        The fork context if no threads have been started, otherwise the
+        forkserver context, or spawn where there is no forkserver
+    """
+    global _context
+    methods = multiprocessing.get_all_start_methods()
+    if 'fork' in methods and not threads_started():
+        return multiprocessing.get_context('fork')
+    if _context is None:
+        if 'forkserver' in methods:
+            _context = multiprocessing.get_context('forkserver')
+            _context.set_forkserver_preload(preload)
+        else:
+            _context = multiprocessing.get_context('spawn')
+    return _context
+
+
+def Pool(processes=None, initializer=None, initargs=(),
+         maxtasksperchild=None):
+    """
+    A `multiprocessing.Pool` from `get_context`, the arguments are those of
+    `multiprocessing.Pool`
+    """
+    return get_context().Pool(processes, initializer, initargs,
+                              maxtasksperchild)
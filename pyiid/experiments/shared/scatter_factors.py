@@ -0,0 +1,124 @@
+"""
+Tables of the atomic x-ray form factors.
+
+The form factors come from xraylib, but only once for each element and Q
+grid, after that they are served from memory or from an on disk cache so
+re-wrapping atoms (eg. on every GCMC insertion or deletion) is nearly free.
+The on disk cache lives in `$PYIID_CACHE_DIR` (default ~/.cache/pyiid) and
+can be switched off by setting `disk_cache = False`.
+"""
+import os
+import numpy as np
+from pyiid.experiments.shared.cache_dir import get_cache_root
+
+__author__ = 'christopher'
+
+disk_cache = True
+_memory_cache = {}
+
+
+def get_cache_dir():
+    return os.path.join(get_cache_root(), 'form_factors')
+
+
+def _cache_file(key):
+    z, qbin, qmax_bin = key
+    return os.path.join(get_cache_dir(),
+                        'ff_{0}_{1!r}_{2}.npy'.format(z, qbin, qmax_bin))
+
+
+def calculate_form_factor(z, q):
+    """
+    Calculate the form factor of an element with xraylib
+
+    Parameters
+    ----------
+    z: int
+        The atomic number
+    q: 1darray
+        The scatter vector magnitudes
+
+    Returns
+    -------
+    1darray:
+        The form factor
+    """
+    # note xraylib uses q = sin(th/2)
+    # as opposed to our q = 4pi sin(th/2)
+    x = np.asarray(q, dtype=np.float64) / 4. / np.pi
+    try:
+        import xraylib_np
+        return np.asarray(xraylib_np.FF_Rayl(np.asarray([z]), x))[0]
+    except ImportError:
+        import xraylib
+        return np.asarray([xraylib.FF_Rayl(int(z), float(xx)) for xx in x])
+
+
+def get_form_factor(z, qbin, qmax_bin):
+    """
+    Get the form factor of an element on the grid q = arange(qmax_bin) * qbin
+
+    Parameters
+    ----------
+    z: int
+        The atomic number
+    qbin: float
+        The Q grid spacing
+    qmax_bin: int
+        The number of Q points
+
+    Returns
+    -------
+    1darray:
+        The form factor, float32, this is shared and must not be modified
+    """
+    key = (int(z), float(qbin), int(qmax_bin))
+    if key in _memory_cache:
+        return _memory_cache[key]
+    ff = None
+    f_name = _cache_file(key)
+    if disk_cache and os.path.exists(f_name):
+        try:
+            ff = np.load(f_name)
+        except (IOError, ValueError):
+            ff = None
+        if ff is not None and ff.shape != (key[2],):
+            ff = None
+    if ff is None:
+        ff = calculate_form_factor(
+            key[0], np.arange(key[2]) * key[1]).astype(np.float32)
+        if disk_cache:
+            try:
+                if not os.path.exists(get_cache_dir()):
+                    os.makedirs(get_cache_dir())
+                # write then move so readers never see a partial file
+                tmp = f_name + '.{0}.tmp.npy'.format(os.getpid())
+                np.save(tmp, ff)
+                os.rename(tmp, f_name)
+            except (IOError, OSError):
+                pass
+    _memory_cache[key] = ff
+    return ff
+
+
+def get_form_factor_table(numbers, qbin, qmax_bin):
+    """
+    Get the form factors of several elements
+
+    Parameters
+    ----------
+    numbers: array
+        The atomic numbers
+    qbin: float
+        The Q grid spacing
+    qmax_bin: int
+        The number of Q points
+
+    Returns
+    -------
+    2darray:
+        The form factors, one row per entry in numbers
+    """
+    if len(numbers) == 0:
+        return np.zeros((0, qmax_bin), np.float32)
+    return np.stack([get_form_factor(z, qbin, qmax_bin) for z in numbers])
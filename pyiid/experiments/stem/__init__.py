@@ -11,68 +11,529 @@ simplistic, they make the following assumptions.
 
 Thus we can compute the electron density for an atomic system by treating
 each atom as a gaussian with intensity = f(0) and sigma = covalent radius
+
+A three dimensional gaussian is the product of three one dimensional
+gaussians, so each atom is described by three short 1D kernels which only
+extend `cutoff` sigma from the atom.  The kernels are splatted onto the grid
+in parallel over the grid planes, so the cost is O(N w^3) for a kernel
+width of w voxels rather than O(N V) for the whole grid of V voxels.
+
+For refinement the image is instead modeled as the projected atomic
+positions, deposited onto the image pixels by bilinear (cloud in cell)
+weights, convolved with a gaussian probe by FFT.  This costs O(N + P log P)
+for P pixels and the gradient of any function of the image with respect to
+the atomic positions is the adjoint convolution followed by a gather over
+the same bilinear stencil.  The FFT makes the image periodic, so the cell
+should have some vacuum around the atoms.
 """
+import os
 import numpy as np
-from scipy.stats import norm
+from numba import jit, prange
 from ase.data import covalent_radii
 from builtins import range
 
+__author__ = 'christopher'
+
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
+
+
+def get_voxel_shape(atoms, resolution):
+    """
+    The number of voxels needed to cover the unit cell
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    resolution: 3 array
+        The voxel size along each axis
+
+    Returns
+    -------
+    tuple:
+        The grid shape
+    """
+    c = np.diagonal(atoms.get_cell())
+    return tuple(int(x) for x in np.ceil(c / resolution))
+
+
+def get_1d_kernels(q, sigma, resolution, cutoff=3.):
+    """
+    Evaluate the 1D gaussian of every atom on the voxel centers along each
+    axis, out to `cutoff` sigma
+
+    Parameters
+    ----------
+    q: Nx3 array
+        The atomic positions
+    sigma: N array
+        The gaussian width of each atom
+    resolution: 3 array
+        The voxel size along each axis
+    cutoff: float
+        The number of sigma to include
+
+    Returns
+    -------
+    starts: Nx3 int array
+        The index of the first voxel covered by each kernel
+    kernels: list of 3 Nxw arrays
+        The kernel values along each axis, the kernels are normalized so that
+        their product integrates to one
+    """
+    resolution = np.asarray(resolution, dtype=np.float64)
+    starts = np.zeros((len(q), 3), np.int64)
+    kernels = []
+    for w in range(3):
+        half = int(np.ceil(cutoff * np.max(sigma) / resolution[w])) + 1
+        # the voxel whose center is closest to the atom
+        center = np.int64(np.floor(q[:, w] / resolution[w]))
+        starts[:, w] = center - half
+        idx = starts[:, w][:, np.newaxis] + np.arange(2 * half + 1)
+        x = (idx + .5) * resolution[w] - q[:, w][:, np.newaxis]
+        s = sigma[:, np.newaxis]
+        g = np.exp(-.5 * (x / s) ** 2) / (np.sqrt(2 * np.pi) * s)
+        g[np.abs(x) > cutoff * s] = 0.
+        kernels.append(g)
+    return starts, kernels
+
+
+def _plane_atoms(starts, width, n):
+    # Atoms sorted by where their kernel starts along the first axis and, for
+    # each plane, the range of sorted atoms whose kernel touches it
+    order = np.argsort(starts, kind='mergesort')
+    s = starts[order]
+    planes = np.arange(n)
+    first = np.searchsorted(s, planes - width + 1, 'left')
+    last = np.searchsorted(s, planes, 'right')
+    return order, first, last
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def splat_3d_kernel(grid, weights, starts, gx, gy, gz, order, first, last):
+    """
+    Accumulate the separable kernels of all the atoms onto the grid
+
+    Parameters
+    ----------
+    grid: 3d array
+        The grid to accumulate into
+    weights: N array
+        The weight of each atom
+    starts: Nx3 array
+        The index of the first voxel covered by each kernel
+    gx, gy, gz: Nxw arrays
+        The 1D kernels along each axis
+    order: N array
+        The atoms sorted by their first index along x
+    first, last: arrays
+        The range in `order` of the atoms touching each x plane
+    """
+    nx, ny, nz = grid.shape
+    wy = gy.shape[1]
+    wz = gz.shape[1]
+    # each thread owns whole x planes so there are no write conflicts
+    for i in prange(nx):
+        for m in range(first[i], last[i]):
+            a = order[m]
+            vx = weights[a] * gx[a, i - starts[a, 0]]
+            if vx == 0.:
+                continue
+            for jj in range(wy):
+                j = starts[a, 1] + jj
+                if j < 0 or j >= ny:
+                    continue
+                vxy = vx * gy[a, jj]
+                if vxy == 0.:
+                    continue
+                for kk in range(wz):
+                    k = starts[a, 2] + kk
+                    if k < 0 or k >= nz:
+                        continue
+                    grid[i, j, k] += vxy * gz[a, kk]
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def splat_2d_kernel(grid, weights, starts, gx, gy, order, first, last):
+    """
+    Accumulate the separable kernels of all the atoms onto a 2D grid
+
+    Parameters
+    ----------
+    grid: 2d array
+        The grid to accumulate into
+    weights: N array
+        The weight of each atom
+    starts: Nx2 array
+        The index of the first pixel covered by each kernel
+    gx, gy: Nxw arrays
+        The 1D kernels along each axis
+    order: N array
+        The atoms sorted by their first index along x
+    first, last: arrays
+        The range in `order` of the atoms touching each x row
+    """
+    nx, ny = grid.shape
+    wy = gy.shape[1]
+    for i in prange(nx):
+        for m in range(first[i], last[i]):
+            a = order[m]
+            vx = weights[a] * gx[a, i - starts[a, 0]]
+            if vx == 0.:
+                continue
+            for jj in range(wy):
+                j = starts[a, 1] + jj
+                if j < 0 or j >= ny:
+                    continue
+                grid[i, j] += vx * gy[a, jj]
+
+
+@jit(nopython=True, cache=cache)
+def deposit_kernel(grid, weights, u, v):
+    """
+    Deposit the atoms onto a periodic 2D grid with bilinear weights
+
+    Parameters
+    ----------
+    grid: 2d array
+        The grid to accumulate into
+    weights: N array
+        The weight of each atom
+    u, v: N arrays
+        The atomic positions in units of pixels, measured from the center
+        of the first pixel
+    """
+    nx, ny = grid.shape
+    for a in range(len(weights)):
+        i0 = int(np.floor(u[a]))
+        j0 = int(np.floor(v[a]))
+        fx = u[a] - i0
+        fy = v[a] - j0
+        i0 %= nx
+        j0 %= ny
+        i1 = (i0 + 1) % nx
+        j1 = (j0 + 1) % ny
+        w = weights[a]
+        grid[i0, j0] += w * (1 - fx) * (1 - fy)
+        grid[i1, j0] += w * fx * (1 - fy)
+        grid[i0, j1] += w * (1 - fx) * fy
+        grid[i1, j1] += w * fx * fy
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def gather_grad_kernel(grad, adjoint, weights, u, v):
+    """
+    Gather the gradient of each atom's bilinear deposit against the adjoint
+    image
+
+    Parameters
+    ----------
+    grad: Nx2 array
+        The gradient with respect to u and v
+    adjoint: 2d array
+        The gradient with respect to the deposited grid
+    weights: N array
+        The weight of each atom
+    u, v: N arrays
+        The atomic positions in units of pixels
+    """
+    nx, ny = adjoint.shape
+    for a in prange(len(weights)):
+        i0 = int(np.floor(u[a]))
+        j0 = int(np.floor(v[a]))
+        fx = u[a] - i0
+        fy = v[a] - j0
+        i0 %= nx
+        j0 %= ny
+        i1 = (i0 + 1) % nx
+        j1 = (j0 + 1) % ny
+        g00 = adjoint[i0, j0]
+        g10 = adjoint[i1, j0]
+        g01 = adjoint[i0, j1]
+        g11 = adjoint[i1, j1]
+        grad[a, 0] = weights[a] * ((g10 - g00) * (1 - fy) +
+                                   (g11 - g01) * fy)
+        grad[a, 1] = weights[a] * ((g01 - g00) * (1 - fx) +
+                                   (g11 - g10) * fx)
+
+
+def get_probe_transfer(shape, resolution, sigma):
+    """
+    The Fourier transform of a normalized gaussian probe on the rfft grid
+
+    Parameters
+    ----------
+    shape: tuple
+        The image shape
+    resolution: 2 array
+        The pixel size along each axis
+    sigma: float
+        The probe width
+
+    Returns
+    -------
+    2darray:
+        The transfer function, shaped for `np.fft.rfft2`
+    """
+    kx = 2 * np.pi * np.fft.fftfreq(shape[0], resolution[0])
+    ky = 2 * np.pi * np.fft.rfftfreq(shape[1], resolution[1])
+    k2 = kx[:, np.newaxis] ** 2 + ky[np.newaxis, :] ** 2
+    return np.exp(-.5 * sigma ** 2 * k2)
+
+
+def get_electron_density(atoms, shape, resolution, cutoff=3.):
+    """
+    Calculate the electron density of the atoms on a voxel grid
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    shape: tuple
+        The number of voxels along each axis
+    resolution: 3 array
+        The voxel size along each axis
+    cutoff: float
+        The number of sigma to include for each atom
+
+    Returns
+    -------
+    3darray:
+        The electron density, in electrons per cubic Angstrom
+    """
+    resolution = np.asarray(resolution, dtype=np.float64)
+    grid = np.zeros(shape)
+    if len(atoms) == 0:
+        return grid
+    sigma = covalent_radii[atoms.numbers]
+    starts, (gx, gy, gz) = get_1d_kernels(atoms.get_positions(), sigma,
+                                         resolution, cutoff)
+    order, first, last = _plane_atoms(starts[:, 0], gx.shape[1], shape[0])
+    weights = atoms.numbers.astype(np.float64)
+    splat_3d_kernel(grid, weights, starts, gx, gy, gz, order, first, last)
+    return grid
+
 
 def get_atomic_electron_density(atom, voxels, resolution):
-    # make var/covar matrix
-    sigma = np.zeros((3, 3))
-    for i in range(3):
-        sigma[i, i] = covalent_radii[atom.number]
-
-    # make gaussian distribution centered on atom
-    r = np.zeros(voxels.shape)
-    q = atom.position
-    im, jm, km, = voxels.shape
-    for i in range(im):
-        x = (i + .5) * resolution[0]
-        for j in range(jm):
-            y = (j + .5) * resolution[1]
-            for k in range(km):
-                z = (k + .5) * resolution[2]
-                r[i, j, k] = 0
-                for l, w in zip(range(3), [x, y, z]):
-                    r[i, j, k] += (w - q[l]) ** 2
-
-    # make gaussian
-    # put gaussian on voxel grid
-    voxel_gaussian = norm.pdf(r)
-
-    # put e density in voxel
-    ed = voxel_gaussian * atom.number
-    return ed
+    """
+    Calculate the electron density of a single atom
+
+    Parameters
+    ----------
+    atom: ase.Atom
+        The atom
+    voxels: 3darray
+        The voxel grid, only its shape is used
+    resolution: 3 array
+        The voxel size along each axis
+
+    Returns
+    -------
+    3darray:
+        The electron density of the atom
+    """
+    sigma = np.asarray([covalent_radii[atom.number]])
+    shape = voxels.shape
+    axes = []
+    for w in range(3):
+        x = (np.arange(shape[w]) + .5) * resolution[w] - atom.position[w]
+        axes.append(np.exp(-.5 * (x / sigma) ** 2) /
+                    (np.sqrt(2 * np.pi) * sigma))
+    return atom.number * np.einsum('i,j,k->ijk', *axes)
+
+
+class STEM(object):
+    """
+    Simple STEM image simulator
+
+    Parameters
+    ----------
+    resolution: float or 3 array
+        The voxel size along each axis in Angstrom
+    cutoff: float
+        The number of sigma each atom's gaussian extends to
+    probe_sigma: float
+        The width of the gaussian probe used by the FFT image model
+    exponent: float
+        The FFT image model weights each atom by Z ** exponent, 1 for
+        electron density like contrast, about 1.7 for HAADF
+
+    >>> from ase import Atoms
+    >>> atoms = Atoms('Au', [[5.1, 5.1, 5.1]], cell=[10, 10, 10])
+    >>> stem = STEM(resolution=.25)
+    >>> image = stem.get_image(atoms)
+    >>> image.shape
+    (40, 40)
+    >>> i, j = np.unravel_index(np.argmax(image), image.shape)
+    >>> print(int(i), int(j))
+    20 20
+    """
+
+    def __init__(self, resolution=.3, cutoff=3., probe_sigma=.5,
+                 exponent=1.):
+        self.resolution = np.ones(3) * resolution
+        self.cutoff = cutoff
+        self.probe_sigma = probe_sigma
+        self.exponent = exponent
+        self._transfer = {}
+
+    def get_shape(self, atoms):
+        return get_voxel_shape(atoms, self.resolution)
+
+    def get_density(self, atoms, shape=None):
+        """
+        Calculate the electron density on the voxel grid
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+        shape: tuple, optional
+            The grid shape, defaults to covering the unit cell
+
+        Returns
+        -------
+        3darray:
+            The electron density
+        """
+        if shape is None:
+            shape = self.get_shape(atoms)
+        return get_electron_density(atoms, shape, self.resolution,
+                                    self.cutoff)
+
+    def get_image(self, atoms, axis=2, shape=None):
+        """
+        Calculate the projected electron density, this is the same as
+        integrating `get_density` along the axis but the atoms are splatted
+        directly onto the 2D image
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+        axis: int
+            The axis of projection (the beam direction)
+        shape: tuple, optional
+            The 3D grid shape, defaults to covering the unit cell
+
+        Returns
+        -------
+        2darray:
+            The projected electron density, in electrons per square
+            Angstrom
+        """
+        if shape is None:
+            shape = self.get_shape(atoms)
+        keep = [w for w in range(3) if w != axis]
+        image = np.zeros(tuple(shape[w] for w in keep))
+        if len(atoms) == 0:
+            return image
+        sigma = covalent_radii[atoms.numbers]
+        starts, kernels = get_1d_kernels(atoms.get_positions(), sigma,
+                                         self.resolution, self.cutoff)
+        # Integrate the kernel along the beam, only over the grid
+        kz = kernels[axis]
+        idx = starts[:, axis][:, np.newaxis] + np.arange(kz.shape[1])
+        inside = (idx >= 0) & (idx < shape[axis])
+        weights = atoms.numbers * np.sum(kz * inside, axis=1) * \
+            self.resolution[axis]
+
+        gx, gy = kernels[keep[0]], kernels[keep[1]]
+        s = np.ascontiguousarray(starts[:, keep])
+        order, first, last = _plane_atoms(s[:, 0], gx.shape[1],
+                                          image.shape[0])
+        splat_2d_kernel(image, weights, s, gx, gy, order, first, last)
+        return image
+
+    # FFT image model ---------------------------------------------------------
+    def _image_setup(self, atoms, axis, shape):
+        keep = [w for w in range(3) if w != axis]
+        if shape is None:
+            shape3 = self.get_shape(atoms)
+            shape = tuple(shape3[w] for w in keep)
+        res = self.resolution[keep]
+        q = atoms.get_positions()
+        u = q[:, keep[0]] / res[0] - .5
+        v = q[:, keep[1]] / res[1] - .5
+        weights = atoms.numbers.astype(np.float64) ** self.exponent
+        # the images are in counts per square Angstrom
+        weights /= res[0] * res[1]
+        key = (tuple(shape), tuple(res))
+        if key not in self._transfer:
+            self._transfer[key] = get_probe_transfer(shape, res,
+                                                     self.probe_sigma)
+        return keep, tuple(shape), res, u, v, weights, self._transfer[key]
+
+    def get_fft_image(self, atoms, axis=2, shape=None):
+        """
+        Calculate the probe convolved image of the projected atoms
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+        axis: int
+            The axis of projection (the beam direction)
+        shape: tuple, optional
+            The image shape, defaults to covering the unit cell
+
+        Returns
+        -------
+        2darray:
+            The image
+        """
+        keep, shape, res, u, v, weights, transfer = self._image_setup(
+            atoms, axis, shape)
+        grid = np.zeros(shape)
+        deposit_kernel(grid, weights, u, v)
+        return np.fft.irfft2(np.fft.rfft2(grid) * transfer, shape)
+
+    def get_grad_fft_image(self, atoms, image_grad, axis=2):
+        """
+        Calculate the gradient of a scalar function of the image with
+        respect to the atomic positions, given its gradient with respect to
+        the image
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+        image_grad: 2darray
+            The gradient of the function with respect to each pixel of
+            `get_fft_image`
+        axis: int
+            The axis of projection (the beam direction)
+
+        Returns
+        -------
+        Nx3 array:
+            The gradient with respect to the atomic positions, the component
+            along the beam is zero
+        """
+        keep, shape, res, u, v, weights, transfer = self._image_setup(
+            atoms, axis, image_grad.shape)
+        # the probe is real and symmetric so the adjoint of the convolution
+        # is the convolution itself
+        adjoint = np.fft.irfft2(np.fft.rfft2(image_grad) * transfer, shape)
+        grad_uv = np.zeros((len(atoms), 2))
+        gather_grad_kernel(grad_uv, adjoint, weights, u, v)
+        grad = np.zeros((len(atoms), 3))
+        grad[:, keep[0]] = grad_uv[:, 0] / res[0]
+        grad[:, keep[1]] = grad_uv[:, 1] / res[1]
+        return grad
 
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
-    from ase import Atoms
-    from ase.visualize import view
     from ase.cluster import FaceCenteredCubic
-    import ase.io as aseio
 
-    # atoms = Atoms('Pt', [(0, 0, 0)])
-    atoms = Atoms(
-        FaceCenteredCubic('Pt', [[1, 0, 0], [1, 1, 0], [1, 1, 1]], (2, 3, 2)))
-    # atoms = atoms[[atom.index for atom in atoms if atom.position[2]< 1.5]]
-    view(atoms)
+    atoms = FaceCenteredCubic('Pt', [[1, 0, 0], [1, 1, 0], [1, 1, 1]],
+                              (2, 3, 2))
     atoms.set_cell(atoms.get_cell() * 1.2)
     atoms.center()
-    cell = atoms.get_cell()
-    print(cell, len(atoms))
-    resolution = .3 * np.ones(3)
-    c = np.diagonal(cell)
-    v = tuple(np.int32(np.ceil(c / resolution)))
-    voxels = np.zeros(v)
-    ed = np.zeros(v)
-    i = 0
-    for atom in atoms:
-        print(i)
-        ed += get_atomic_electron_density(atom, voxels, resolution)
-        i += 1
-    print(ed[:, :, 0])
-    plt.imshow(np.sum(ed, axis=2), cmap='viridis')
+    print(atoms.get_cell(), len(atoms))
+    stem = STEM(resolution=.3)
+    plt.imshow(stem.get_image(atoms), cmap='viridis')
     plt.show()
@@ -0,0 +1,383 @@
+from __future__ import print_function
+
+"""
+Verlet neighbor lists built from cell lists.  The list is built with a
+cutoff of `cutoff + skin` and only rebuilt once some atom has moved more than
+half the skin from where it was at the last build, so that during dynamics
+the same list can be reused for many steps.  A list can be attached to an
+`ase.Atoms`, copies of the atoms share the list, and the spring calculator,
+the surface area code and the analysis utilities will pick it up.  The atoms
+only carry a key to the list in their info, so they can still be written to
+trajectories, the lists are kept here.
+"""
+import os
+import uuid
+from collections import OrderedDict
+import numpy as np
+from numba import jit, prange
+from builtins import range
+
+__author__ = 'christopher'
+
+cache = True
+if bool(os.getenv('NUMBA_DISABLE_JIT')):
+    cache = False
+
+# The most neighbor lists kept attached, the oldest are dropped first and
+# their atoms go back to the paths without a list
+max_attached = 16
+# The attached lists by their key in atoms.info
+_attached = OrderedDict()
+
+
+@jit(nopython=True, cache=cache)
+def _cell_index(q, qmin, cut, dims):
+    c = 0
+    for w in range(3):
+        cw = int((q[w] - qmin[w]) / cut)
+        if cw >= dims[w]:
+            cw = dims[w] - 1
+        c = c * dims[w] + cw
+    return c
+
+
+@jit(nopython=True, cache=cache)
+def _build_cells(q, qmin, cut, dims, head, nxt):
+    """
+    Bin the atoms into cells as linked lists
+
+    Parameters
+    ----------
+    q: Nx3 array
+        The atomic positions
+    qmin: 3 array
+        The lower corner of the grid
+    cut: float
+        The cell size
+    dims: 3 array
+        The number of cells along each axis
+    head: array
+        The first atom in each cell, -1 for an empty cell
+    nxt: N array
+        The next atom in the same cell, -1 for the end of the list
+    """
+    for i in range(len(q)):
+        c = _cell_index(q[i], qmin, cut, dims)
+        nxt[i] = head[c]
+        head[c] = i
+
+
+@jit(nopython=True, parallel=True, cache=cache)
+def _neighbor_kernel(q, qmin, cut, dims, head, nxt, offsets, indices,
+                     fill):
+    """
+    Count (fill=False) or record (fill=True) the neighbors of each atom
+    by looking through the 27 cells around it
+
+    Parameters
+    ----------
+    q: Nx3 array
+        The atomic positions
+    qmin: 3 array
+        The lower corner of the grid
+    cut: float
+        The cutoff distance
+    dims: 3 array
+        The number of cells along each axis
+    head: array
+        The first atom in each cell
+    nxt: N array
+        The next atom in the same cell
+    offsets: N + 1 array
+        If counting the number of neighbors are written to offsets[i + 1],
+        if filling the start of each atom's neighbors
+    indices: array
+        The neighbor indices, only written when filling
+    fill: bool
+        Whether to count or fill
+    """
+    cut2 = cut * cut
+    for i in prange(len(q)):
+        ci = np.empty(3, np.int64)
+        for w in range(3):
+            cw = int((q[i, w] - qmin[w]) / cut)
+            if cw >= dims[w]:
+                cw = dims[w] - 1
+            ci[w] = cw
+        m = 0
+        for dx in range(-1, 2):
+            cx = ci[0] + dx
+            if cx < 0 or cx >= dims[0]:
+                continue
+            for dy in range(-1, 2):
+                cy = ci[1] + dy
+                if cy < 0 or cy >= dims[1]:
+                    continue
+                for dz in range(-1, 2):
+                    cz = ci[2] + dz
+                    if cz < 0 or cz >= dims[2]:
+                        continue
+                    j = head[(cx * dims[1] + cy) * dims[2] + cz]
+                    while j != -1:
+                        r2 = 0.
+                        for w in range(3):
+                            r2 += (q[j, w] - q[i, w]) ** 2
+                        if 0. < r2 < cut2:
+                            if fill:
+                                indices[offsets[i] + m] = j
+                            m += 1
+                        j = nxt[j]
+        if fill:
+            indices[offsets[i]:offsets[i] + m] = np.sort(
+                indices[offsets[i]:offsets[i] + m])
+        else:
+            offsets[i + 1] = m
+
+
+def get_neighbor_arrays(cut, q):
+    """
+    Find all the pairs closer than the cutoff using a cell list, this is
+    O(N) in both time and memory
+
+    Parameters
+    ----------
+    cut: float
+        The cutoff distance
+    q: Nx3 array
+        The atomic positions
+
+    Returns
+    -------
+    offsets: N + 1 array
+        The neighbors of atom i are indices[offsets[i]:offsets[i + 1]]
+    indices: array
+        The neighbor indices
+    """
+    q = np.ascontiguousarray(q, dtype=np.float64)
+    n = len(q)
+    offsets = np.zeros(n + 1, np.int64)
+    if n == 0:
+        return offsets, np.zeros(0, np.int64)
+    qmin = q.min(axis=0)
+    dims = np.maximum(
+        np.int64(np.floor((q.max(axis=0) - qmin) / cut)) + 1, 1)
+    head = -1 * np.ones(int(np.prod(dims)), np.int64)
+    nxt = -1 * np.ones(n, np.int64)
+    _build_cells(q, qmin, float(cut), dims, head, nxt)
+
+    indices = np.zeros(0, np.int64)
+    _neighbor_kernel(q, qmin, float(cut), dims, head, nxt, offsets, indices,
+                     False)
+    np.cumsum(offsets, out=offsets)
+    indices = np.zeros(offsets[-1], np.int64)
+    _neighbor_kernel(q, qmin, float(cut), dims, head, nxt, offsets, indices,
+                     True)
+    return offsets, indices
+
+
+class NeighborList(object):
+    """
+    Verlet neighbor list with a skin
+
+    Parameters
+    ----------
+    cutoff: float
+        The largest distance of interest
+    skin: float
+        The extra distance included in the list, the list is valid until an
+        atom moves more than half of this
+
+    >>> from ase import Atoms
+    >>> atoms = Atoms('Au4', [[0, 0, 0], [3, 0, 0], [0, 3, 0], [3, 3, 0]])
+    >>> nl = attach_neighbor_list(atoms, 3.5)
+    >>> nl.get_neighbor_list(atoms)[0]
+    array([1, 2])
+    """
+
+    def __init__(self, cutoff, skin=.3):
+        self.cutoff = float(cutoff)
+        self.skin = float(skin)
+        self.positions = None
+        self.numbers = None
+        self.offsets = None
+        self.indices = None
+        self.builds = 0
+
+    def build(self, atoms):
+        self.positions = atoms.get_positions().copy()
+        self.numbers = atoms.get_atomic_numbers().copy()
+        self.offsets, self.indices = get_neighbor_arrays(
+            self.cutoff + self.skin, self.positions)
+        self.builds += 1
+
+    def needs_update(self, atoms):
+        """
+        Check if the list is still valid for these atoms
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+
+        Returns
+        -------
+        bool:
+            True if the list needs to be rebuilt
+        """
+        if self.positions is None or len(atoms) != len(self.positions):
+            return True
+        if np.any(atoms.get_atomic_numbers() != self.numbers):
+            return True
+        disp = np.sum((atoms.get_positions() - self.positions) ** 2, axis=1)
+        return np.max(disp) > (self.skin / 2.) ** 2
+
+    def update(self, atoms):
+        """
+        Rebuild the list if needed
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+
+        Returns
+        -------
+        bool:
+            True if the list was rebuilt
+        """
+        if self.needs_update(atoms):
+            self.build(atoms)
+            return True
+        return False
+
+    def get_pairs(self, atoms, cutoff=None):
+        """
+        Get the unique pairs which are inside the cutoff
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+        cutoff: float, optional
+            The cutoff, must not be larger than the list's cutoff, defaults
+            to the list's cutoff
+
+        Returns
+        -------
+        i, j: arrays
+            The pair indices, i < j
+        d: kx3 array
+            The pair displacements q[j] - q[i]
+        r: k array
+            The pair distances
+        """
+        if cutoff is None:
+            cutoff = self.cutoff
+        if cutoff > self.cutoff:
+            raise ValueError('The cutoff is larger than the neighbor list '
+                             'cutoff')
+        self.update(atoms)
+        i = np.repeat(np.arange(len(atoms)), np.diff(self.offsets))
+        j = self.indices
+        upper = i < j
+        i, j = i[upper], j[upper]
+        q = atoms.get_positions()
+        d = q[j] - q[i]
+        r = np.sqrt(np.sum(d ** 2, axis=1))
+        inside = r < cutoff
+        return i[inside], j[inside], d[inside], r[inside]
+
+    def get_neighbor_arrays(self, atoms, cutoff=None):
+        """
+        Get every atom's neighbors inside the cutoff, in the same form as
+        `get_neighbor_arrays`
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The atomic configuration
+        cutoff: float, optional
+            The cutoff, must not be larger than the list's cutoff, defaults
+            to the list's cutoff
+
+        Returns
+        -------
+        offsets: N + 1 array
+            The neighbors of atom i are indices[offsets[i]:offsets[i + 1]]
+        indices: array
+            The neighbor indices
+        """
+        if cutoff is None:
+            cutoff = self.cutoff
+        if cutoff > self.cutoff:
+            raise ValueError('The cutoff is larger than the neighbor list '
+                             'cutoff')
+        self.update(atoms)
+        n = len(atoms)
+        i = np.repeat(np.arange(n), np.diff(self.offsets))
+        q = atoms.get_positions()
+        r2 = np.sum((q[self.indices] - q[i]) ** 2, axis=1)
+        inside = r2 < cutoff * cutoff
+        offsets = np.zeros(n + 1, np.int64)
+        offsets[1:] = np.cumsum(np.bincount(i[inside], minlength=n))
+        return offsets, self.indices[inside]
+
+    def get_neighbor_list(self, atoms, cutoff=None):
+        offsets, indices = self.get_neighbor_arrays(atoms, cutoff)
+        return [indices[offsets[i]:offsets[i + 1]] for i in range(len(atoms))]
+
+
+def attach_neighbor_list(atoms, cutoff, skin=.3):
+    """
+    Attach a neighbor list to the atoms, it will be used by anything which
+    needs pairs inside its cutoff.  The atoms hold the key of the list in
+    their info, copies of the atoms share the list, update checks the
+    positions so sharing is always safe
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    cutoff: float
+        The largest distance of interest
+    skin: float
+        The list skin
+
+    Returns
+    -------
+    NeighborList:
+        The attached list
+    """
+    nl = NeighborList(cutoff, skin)
+    nl.build(atoms)
+    # unique across processes, atoms read back from a file written by another
+    # process do not pick up a list of this one
+    key = uuid.uuid4().hex
+    _attached[key] = nl
+    while len(_attached) > max_attached:
+        _attached.popitem(last=False)
+    atoms.info['neighbor_list'] = key
+    return nl
+
+
+def get_attached_neighbor_list(atoms, cutoff):
+    """
+    Get the neighbor list attached to the atoms, if it covers the cutoff
+
+    Parameters
+    ----------
+    atoms: ase.Atoms
+        The atomic configuration
+    cutoff: float
+        The distance of interest
+
+    Returns
+    -------
+    NeighborList or None:
+        The attached list, None if there is no list, it has been dropped or
+        its cutoff is too small
+    """
+    nl = _attached.get(atoms.info.get('neighbor_list', None), None)
+    if nl is not None and nl.cutoff >= cutoff:
+        return nl
+    return None
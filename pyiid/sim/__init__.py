@@ -5,10 +5,11 @@ import numpy as np
 from numpy.random import RandomState
 from builtins import range
 from ase.io.trajectory import Trajectory
+from pyiid.sim.telemetry import Telemetry, timed
 __author__ = 'christopher'
 
 
-def leapfrog(atoms, step, center=True):
+def leapfrog(atoms, step, center=True, telemetry=None):
     """
     Propagate the dynamics of the system via the leapfrog algorithm one step
 
@@ -21,19 +22,26 @@ def leapfrog(atoms, step, center=True):
         the force
     center: bool
         If true, center the atoms in the cell after moving them
+    telemetry: Telemetry, optional
+        If given record the time spent copying and computing forces
 
     Returns
     -------
     ase.Atoms
         The new atomic positions and velocities
     """
-    latoms = dc(atoms)
+    with timed(telemetry, 'copy'):
+        latoms = dc(atoms)
 
-    latoms.set_momenta(latoms.get_momenta() + 0.5 * step * latoms.get_forces())
+    with timed(telemetry, 'force'):
+        f = latoms.get_forces()
+    latoms.set_momenta(latoms.get_momenta() + 0.5 * step * f)
 
     latoms.positions += step * latoms.get_velocities()
 
-    latoms.set_momenta(latoms.get_momenta() + 0.5 * step * latoms.get_forces())
+    with timed(telemetry, 'force'):
+        f = latoms.get_forces()
+    latoms.set_momenta(latoms.get_momenta() + 0.5 * step * f)
     if center:
         latoms.center()
     return latoms
@@ -42,7 +50,7 @@ def leapfrog(atoms, step, center=True):
 class Ensemble(Optimizer):
     def __init__(self, atoms, restart=None, logfile=None, trajectory=None,
                  seed=None,
-                 verbose=False):
+                 verbose=False, telemetry_file=None):
         Optimizer.__init__(self, atoms, restart, logfile, trajectory=None)
         atoms.get_forces()
         atoms.get_potential_energy()
@@ -53,11 +61,22 @@ class Ensemble(Optimizer):
         self.starting_atoms = dc(atoms)
         self.pe = []
         self.metadata = {'seed': seed}
+        self.telemetry = Telemetry()
+        # number of proposals made in the last step, steps which make more
+        # than one proposal count for more than one iteration
+        self.step_proposals = 1
+        # The cost models of the calculator, see `calibrate_cost`
+        self.cost_models = None
+        if telemetry_file is not None:
+            self.telemetry_file = open(telemetry_file, 'a')
+        else:
+            self.telemetry_file = None
         self.traj = [dc(atoms)]
         print(self.traj[0].get_momenta())
         if trajectory is not None:
             self.trajectory = Trajectory(trajectory, mode='w')
-            self.trajectory.write(self.traj[-1])
+            with self.telemetry.timer('io'):
+                self.trajectory.write(self.traj[-1])
             if self.verbose:
                 print('Trajectory written', len(self.traj))
         else:
@@ -66,10 +85,25 @@ class Ensemble(Optimizer):
             print('trajectory file', self.trajectory)
 
     def check_eq(self, eq_steps, tol):
-        ret = np.cumsum(self.pe, dtype=float)
-        ret[eq_steps:] = ret[eq_steps:] - ret[:-eq_steps]
-        ret = ret[eq_steps - 1:] / eq_steps
-        return np.sum(np.gradient(ret[eq_steps:])) < tol
+        """
+        Check if the moving average of the potential energy has stopped
+        drifting
+
+        Parameters
+        ----------
+        eq_steps: int
+            The size of the moving average window
+        tol: float
+            The drift below which the system is considered at equilibrium
+
+        Returns
+        -------
+        bool:
+            True if the system is at equilibrium
+        """
+        if self.telemetry.eq_steps != eq_steps:
+            self.telemetry.reset_equilibrium(eq_steps, self.pe)
+        return self.telemetry.at_equilibrium(tol)
 
     def run(self, steps=100000000, eq_steps=None, eq_tol=None, **kwargs):
         self.metadata['planned iterations'] = steps
@@ -83,19 +117,167 @@ class Ensemble(Optimizer):
             if self.verbose:
                 print('iteration number', i)
             try:
-                self.step()
-                i += 1
+                self.telemetry.start_step()
+                new_configurations = self.step()
+                self._record_step(new_configurations is not None)
+                i += self.step_proposals
             # If we blow up, write the last structure down and exit gracefully
             except KeyboardInterrupt:
                 print('Interupted, returning data')
-                return self.traj, self.metadata
+                break
 
         if self.trajectory is not None:
             self.trajectory.close()
+        if self.telemetry_file is not None:
+            self.telemetry_file.close()
+        self.metadata['telemetry'] = self.telemetry.summary()
         return self.traj, self.metadata
 
+    def _record_step(self, accepted):
+        """
+        Update the telemetry after a step
+
+        Parameters
+        ----------
+        accepted: bool
+            Whether the step produced a new configuration
+        """
+        # Rejected steps leave the chain where it was, so we don't need to
+        # go back to the calculator for the energy
+        if accepted or len(self.pe) == 0:
+            pe = self.traj[-1].get_potential_energy()
+        else:
+            pe = self.pe[-1]
+        self.pe.append(pe)
+        self.telemetry.end_step(pe, accepted, self.step_proposals)
+        if self.telemetry_file is not None:
+            with self.telemetry.timer('io'):
+                self.telemetry.write(self.telemetry_file)
+
     def step(self):
         pass
 
+    def calibrate_cost(self, sizes=None, repeats=1):
+        """
+        Fit the cost of the energy and forces of the calculator from a few
+        probes on subsets of the starting atoms, see `pyiid.cost`
+
+        Parameters
+        ----------
+        sizes: list of int, optional
+            The numbers of atoms probed, defaults to a quarter, half and all
+            of the starting atoms
+        repeats: int
+            The best of this many calls is used for each probe
+
+        Returns
+        -------
+        dict:
+            The `CostModel` of the 'energy' and 'force' calls
+        """
+        from pyiid.cost import CostModel, measure, calculator_features
+        atoms = self.starting_atoms
+        calc = atoms.get_calculator()
+        n = len(atoms)
+        if sizes is None:
+            sizes = sorted(set([max(n // 4, 2), max(n // 2, 2), n]))
+        rs = np.random.RandomState(0)
+        probes = dict((s, ([], [], [])) for s in ['energy', 'force'])
+        for m in sizes:
+            sub = atoms[:m]
+
+            # move the atoms for each call so nothing is served from cache
+            def setup():
+                a = sub.copy()
+                a.positions += rs.normal(0, .001, a.positions.shape)
+                a.set_calculator(calc)
+                return a
+
+            for s, f in [('energy', lambda a: a.get_potential_energy()),
+                         ('force', lambda a: a.get_forces())]:
+                t, peak = measure(f, setup, repeats)
+                probes[s][0].append({'n': m})
+                probes[s][1].append(t)
+                probes[s][2].append(peak)
+        self.cost_models = dict(
+            (s, CostModel(calculator_features).fit(*probe))
+            for s, probe in probes.items())
+        return self.cost_models
+
+    def calls_per_step(self):
+        """
+        The number of energy and force calls of one step, measured by the
+        telemetry once the ensemble has run
+
+        Returns
+        -------
+        dict:
+            The calls of each of the 'energy' and 'force' stages
+        """
+        t = self.telemetry
+        if t.steps == 0:
+            return {'energy': 1., 'force': 1.}
+        return dict((s, t.stage_calls[s] / float(t.steps))
+                    for s in ['energy', 'force'])
+
+    def estimate_step_cost(self, n=None):
+        """
+        Predict the time and peak memory of one step, the calculator calls
+        from the cost model plus, once the ensemble has run, the measured
+        time of the rest of the step (copies, io, bookkeeping)
+
+        Parameters
+        ----------
+        n: int, optional
+            The number of atoms, defaults to the current configuration
+
+        Returns
+        -------
+        seconds: float
+            The predicted time
+        nbytes: int
+            The predicted peak bytes of a calculator call
+        """
+        if self.cost_models is None:
+            self.calibrate_cost()
+        if n is None:
+            n = len(self.traj[-1])
+        seconds, nbytes = 0., 0
+        for s, calls in self.calls_per_step().items():
+            t, b = self.cost_models[s].predict(n=n)
+            seconds += calls * t
+            nbytes = max(nbytes, b)
+        return seconds + self.get_step_overhead(), nbytes
+
+    def get_step_overhead(self):
+        # the measured time per step which is not spent in the calculator
+        t = self.telemetry
+        if t.steps == 0:
+            return 0.
+        calc_time = t.stage_time['energy'] + t.stage_time['force']
+        return max(t.step_time - calc_time, 0.) / t.steps
+
+    def get_proposals_per_step(self):
+        t = self.telemetry
+        if t.steps == 0:
+            return 1.
+        return t.proposals / float(t.steps)
+
     def estimate_simulation_duration(self, atoms, iterations):
-        pass
+        """
+        Predict the time of a run
+
+        Parameters
+        ----------
+        atoms: ase.Atoms
+            The configuration the run starts from
+        iterations: int
+            The number of iterations, as counted by `run`
+
+        Returns
+        -------
+        float:
+            The predicted time, in seconds
+        """
+        steps = iterations / self.get_proposals_per_step()
+        return steps * self.estimate_step_cost(len(atoms))[0]
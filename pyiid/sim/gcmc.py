@@ -1,18 +1,129 @@
 from __future__ import print_function
 from copy import deepcopy as dc
-from time import time
+from multiprocessing import cpu_count
 import numpy as np
 from ase.atom import Atom
 from ase.units import *
 from pyiid.sim import Ensemble
+from pyiid.sim.telemetry import timed
+from pyiid.experiments.shared.pool import Pool
 from builtins import range
 
 __author__ = 'christopher'
 
 
-def add_atom(atoms, chem_potentials, beta, random_state, resolution=None):
+class OccupancyGrid(object):
     """
-    Perform a GCMC atomic addition
+    Voxel occupancy grid for cavity biased insertions.  Each voxel holds the
+    number of atoms whose exclusion sphere covers the voxel center, voxels
+    with a count of zero are cavities.  The grid is updated incrementally by
+    only touching the voxels around the added/removed atom.
+
+    Parameters
+    ----------
+    atoms: ase.Atoms object
+        The atomic configuration, the grid spans the diagonal of the cell
+    resolution: float
+        The voxel edge length
+    radius: float
+        The exclusion radius around each atom
+    """
+
+    def __init__(self, atoms, resolution, radius):
+        self.resolution = float(resolution)
+        self.radius = float(radius)
+        self.shape = tuple(np.int32(np.ceil(
+            np.diagonal(atoms.get_cell()) / self.resolution)))
+        self.counts = np.zeros(self.shape, np.int32)
+        self.voxel_volume = self.resolution ** 3
+        for position in atoms.get_positions():
+            self.add(position)
+
+    def _stencil(self, position):
+        """
+        Find the voxels whose centers are inside the exclusion sphere
+
+        Parameters
+        ----------
+        position: ndarray
+            The atomic position
+
+        Returns
+        -------
+        tuple of ndarrays:
+            The index arrays for the covered voxels
+        """
+        lo = np.floor((position - self.radius) / self.resolution)
+        hi = np.floor((position + self.radius) / self.resolution) + 1
+        lo = np.int64(np.clip(lo, 0, self.shape))
+        hi = np.int64(np.clip(hi, 0, self.shape))
+        axes = [np.arange(lo[w], hi[w]) for w in range(3)]
+        dist2 = np.zeros([len(a) for a in axes])
+        for w in range(3):
+            c = (axes[w] + .5) * self.resolution - position[w]
+            dist2 += (c ** 2).reshape([-1 if w == x else 1
+                                       for x in range(3)])
+        i, j, k = np.nonzero(dist2 < self.radius ** 2)
+        return i + lo[0], j + lo[1], k + lo[2]
+
+    def add(self, position):
+        self.counts[self._stencil(position)] += 1
+
+    def remove(self, position):
+        self.counts[self._stencil(position)] -= 1
+
+    def voxel(self, position):
+        """
+        The voxel index of a position
+
+        Parameters
+        ----------
+        position: ndarray
+            The position
+
+        Returns
+        -------
+        tuple:
+            The voxel index, None if the position is off the grid
+        """
+        idx = np.int64(np.floor(position / self.resolution))
+        if np.any(idx < 0) or np.any(idx >= self.shape):
+            return None
+        return tuple(idx)
+
+    def is_cavity(self, position):
+        idx = self.voxel(position)
+        return idx is not None and self.counts[idx] == 0
+
+    def cavity_fraction(self):
+        return np.count_nonzero(self.counts == 0) / float(self.counts.size)
+
+    def sample_cavity(self, random_state):
+        """
+        Draw a position uniformly from the cavity voxels
+
+        Parameters
+        ----------
+        random_state: np.random.RandomState object
+            The random state to be used
+
+        Returns
+        -------
+        ndarray or None:
+            The new position, None if there are no cavities
+        """
+        cavities = np.flatnonzero(self.counts == 0)
+        if len(cavities) == 0:
+            return None
+        qv = np.asarray(np.unravel_index(random_state.choice(cavities),
+                                         self.shape))
+        return (qv + random_state.uniform(0, 1, 3)) * self.resolution
+
+
+def propose_addition(atoms, chem_potentials, beta, random_state,
+                     resolution=None, telemetry=None, grid=None):
+    """
+    Make a GCMC atomic addition proposal, without evaluating it
 
     Parameters
     ----------
@@ -27,25 +138,38 @@ def add_atom(atoms, chem_potentials, beta, random_state, resolution=None):
         The random state to be used
     resolution: float or ndarray, optional
         If used denote the resolution for the voxels
+    telemetry: Telemetry, optional
+        If given record the time spent copying
+    grid: OccupancyGrid, optional
+        If given only insert into cavities
 
     Returns
     -------
-    atoms or None:
-        If the new configuration is accepted then the new atomic configuration
-        is returned, else None
-
+    tuple or None:
+        The proposed configuration, the log of the acceptance factors which
+        do not depend on the energy and the new atom's position.  None if no
+        proposal could be made.
     """
+    # bias factor for the proposal, the fraction of the volume in cavities
+    p_cav = 1.
+    if grid is not None:
+        p_cav = grid.cavity_fraction()
+        if p_cav == 0.:
+            return None
+
     # make the proposed system
-    atoms_prime = dc(atoms)
+    with timed(telemetry, 'copy'):
+        atoms_prime = dc(atoms)
 
     # make new atom
-    new_symbol = np.random.choice(list(chem_potentials.keys()))
-    e0 = atoms.get_potential_energy()
-    if resolution is None:
-        new_position = np.random.uniform(0, np.max(atoms.get_cell(), 0))
+    new_symbol = random_state.choice(list(chem_potentials.keys()))
+    if grid is not None:
+        new_position = grid.sample_cavity(random_state)
+    elif resolution is None:
+        new_position = random_state.uniform(0, np.max(atoms.get_cell(), 0))
     else:
         c = np.int32(np.ceil(np.diagonal(atoms.get_cell()) / resolution))
-        qvr = np.random.choice(np.product(c))
+        qvr = random_state.choice(np.prod(c))
         qv = np.asarray(np.unravel_index(qvr, c))
         new_position = (qv + random_state.uniform(0, 1, 3)) * resolution
     new_atom = Atom(new_symbol, np.asarray(new_position))
@@ -53,20 +177,146 @@ def add_atom(atoms, chem_potentials, beta, random_state, resolution=None):
     # append new atom to system
     atoms_prime.append(new_atom)
 
-    # get new energy
-    delta_energy = atoms_prime.get_potential_energy() - e0
     # get chemical potential
     mu = chem_potentials[new_symbol]
+    return atoms_prime, beta * mu + np.log(p_cav), new_position
+
+
+def propose_removal(atoms, chem_potentials, beta, random_state,
+                    telemetry=None, grid=None):
+    """
+    Make a GCMC atomic removal proposal, without evaluating it
+
+    Parameters
+    ----------
+    atoms: ase.Atoms object
+        The atomic configuration
+    chem_potentials: dict
+        A dictionary of {"Chemical Symbol": mu} where mu is a float denoting
+        the chemical potential
+    beta: float
+        The thermodynamic beta
+    random_state: np.random.RandomState object
+        The random state to be used
+    telemetry: Telemetry, optional
+        If given record the time spent copying
+    grid: OccupancyGrid, optional
+        If given correct for cavity biased insertions
+
+    Returns
+    -------
+    tuple or None:
+        The proposed configuration, the log of the acceptance factors which
+        do not depend on the energy and the removed atom's position.  None if
+        no proposal could be made.
+    """
+    if len(atoms) <= 1:
+        return None
+    del_atom_index = random_state.choice(range(len(atoms)))
+    del_symbol = atoms[del_atom_index].symbol
+    del_position = atoms[del_atom_index].position.copy()
+
+    # The reverse move is a cavity biased insertion into the system without
+    # this atom, so the atom must sit in a cavity of that system
+    p_cav = 1.
+    if grid is not None:
+        grid.remove(del_position)
+        p_cav = grid.cavity_fraction()
+        in_cavity = grid.is_cavity(del_position)
+        grid.add(del_position)
+        if not in_cavity:
+            return None
+
+    # make the proposed system
+    with timed(telemetry, 'copy'):
+        atoms_prime = dc(atoms)
+    del atoms_prime[del_atom_index]
+
+    # get chemical potential
+    mu = chem_potentials[del_symbol]
+    return atoms_prime, -1. * beta * mu - np.log(p_cav), del_position
+
+
+def accept(delta_energy, ln_bias, beta, u):
+    """
+    The Metropolis test of a proposal
+
+    Parameters
+    ----------
+    delta_energy: float
+        The change in the potential energy
+    ln_bias: float
+        The log of the acceptance factors which do not depend on the energy
+    beta: float
+        The thermodynamic beta
+    u: float
+        A uniform random number in [0, 1)
+
+    Returns
+    -------
+    bool:
+        True if the proposal is accepted
+    """
+    return not np.isnan(delta_energy) and u < np.exp(
+        min([0, -1. * beta * delta_energy + ln_bias]))
+
+
+def add_atom(atoms, chem_potentials, beta, random_state, resolution=None,
+             telemetry=None, grid=None):
+    """
+    Perform a GCMC atomic addition
+
+    Parameters
+    ----------
+    atoms: ase.Atoms object
+        The atomic configuration
+    chem_potentials: dict
+        A dictionary of {"Chemical Symbol": mu} where mu is a float denoting
+        the chemical potential
+    beta: float
+        The thermodynamic beta
+    random_state: np.random.RandomState object
+        The random state to be used
+    resolution: float or ndarray, optional
+        If used denote the resolution for the voxels
+    telemetry: Telemetry, optional
+        If given record the time spent copying and computing energies
+    grid: OccupancyGrid, optional
+        If given only insert into cavities, correcting the acceptance for the
+        biased proposal.  The grid is updated if the insertion is accepted.
+
+    Returns
+    -------
+    atoms or None:
+        If the new configuration is accepted then the new atomic configuration
+        is returned, else None
+
+    """
+    proposal = propose_addition(atoms, chem_potentials, beta, random_state,
+                                resolution, telemetry, grid)
+    if proposal is None:
+        return None
+    atoms_prime, ln_bias, new_position = proposal
+    # drawn with the proposal, see `GrandCanonicalEnsemble.speculative_step`
+    u = random_state.uniform()
+
+    # get new energy
+    with timed(telemetry, 'energy'):
+        delta_energy = atoms_prime.get_potential_energy() - \
+                       atoms.get_potential_energy()
     # calculate acceptance
-    if np.random.random() < np.exp(
-            min([0, -1. * beta * delta_energy + beta * mu])):
+    if accept(delta_energy, ln_bias, beta, u):
+        if grid is not None:
+            grid.add(new_position)
         return atoms_prime
     else:
         return None
 
 
-def del_atom(atoms, chem_potentials, beta, random_state):
+def del_atom(atoms, chem_potentials, beta, random_state, telemetry=None,
+             grid=None):
     """
+    Perform a GCMC atomic removal
 
     Parameters
     ----------
@@ -79,6 +329,11 @@ def del_atom(atoms, chem_potentials, beta, random_state):
         The thermodynamic beta
     random_state: np.random.RandomState object
         The random state to be used
+    telemetry: Telemetry, optional
+        If given record the time spent copying and computing energies
+    grid: OccupancyGrid, optional
+        If given correct the acceptance for cavity biased insertions, the
+        grid is updated if the removal is accepted.
 
     Returns
     -------
@@ -88,32 +343,53 @@ def del_atom(atoms, chem_potentials, beta, random_state):
 
 
     """
-    if len(atoms) <= 1:
+    proposal = propose_removal(atoms, chem_potentials, beta, random_state,
+                               telemetry, grid)
+    if proposal is None:
         return None
-    print(len(atoms))
-    # make the proposed system
-    atoms_prime = dc(atoms)
-    e0 = atoms.get_potential_energy()
-    del_atom_index = random_state.choice(range(len(atoms)))
-    del_symbol = atoms_prime[del_atom_index].symbol
-
-    # append new atom to system
-    del atoms_prime[del_atom_index]
+    atoms_prime, ln_bias, del_position = proposal
+    # drawn with the proposal, see `GrandCanonicalEnsemble.speculative_step`
+    u = random_state.uniform()
 
     # get new energy
-    delta_energy = atoms_prime.get_potential_energy() - e0
-    # get chemical potential
-    # print delta_energy
-    mu = chem_potentials[del_symbol]
+    with timed(telemetry, 'energy'):
+        delta_energy = atoms_prime.get_potential_energy() - \
+                       atoms.get_potential_energy()
     # calculate acceptance
-    if np.random.random() < np.exp(
-            min([0, -1. * beta * delta_energy - beta * mu
-                 ])) and not np.isnan(delta_energy):
+    if accept(delta_energy, ln_bias, beta, u):
+        if grid is not None:
+            grid.remove(del_position)
         return atoms_prime
     else:
         return None
 
 
+def _proposal_energy(atoms):
+    """
+    Pool worker which evaluates the potential energy of a proposal, it
+    returns the energy and everything the calculator computed so the
+    proposal does not have to be evaluated again if it is accepted
+    """
+    energy = atoms.get_potential_energy()
+    return energy, dict(atoms.calc.results)
+
+
+def set_results(atoms, results):
+    """
+    Give the calculator of the atoms results computed for the same
+    configuration elsewhere, eg. in a pool worker
+
+    Parameters
+    ----------
+    atoms: ase.Atoms object
+        The atomic configuration, with its own calculator
+    results: dict
+        The calculator results, eg. {'energy': e, 'forces': f}
+    """
+    atoms.calc.atoms = atoms.copy()
+    atoms.calc.results = dict(results)
+
+
 class GrandCanonicalEnsemble(Ensemble):
     """
     Grand Canonical Monte Carlo simulation
@@ -126,58 +402,191 @@ class GrandCanonicalEnsemble(Ensemble):
     >>> atoms.set_calculator(calc)
     >>> gc = GrandCanonicalEnsemble(atoms, {'Au': 0.0}, 3000)
     >>> traj = gc.run(10000)
+
+    Passing ``cavity_radius`` keeps an `OccupancyGrid` of the system and
+    only proposes insertions into cavities, which is much more efficient
+    for dense particles
+    >>> gc = GrandCanonicalEnsemble(atoms, {'Au': 0.0}, 3000, resolution=.5,
+    ...                             cavity_radius=2.)
+
+    Passing ``speculative`` evaluates that many proposals at once on a
+    process pool, which pays off when most proposals are rejected.  The
+    pool lives until `close` (or the end of `run`), the ensemble is also a
+    context manager which closes it
+    >>> with GrandCanonicalEnsemble(atoms, {'Au': 0.0}, 3000,
+    ...                             speculative=8) as gc:
+    ...     traj = gc.run(100)
     """
 
     def __init__(self, atoms, chemical_potentials, temperature=100,
                  restart=None, logfile=None, trajectory=None, seed=None,
-                 verbose=False, resolution=None):
+                 verbose=False, resolution=None, telemetry_file=None,
+                 cavity_radius=None, speculative=None, processes=None):
         Ensemble.__init__(self, atoms, restart, logfile, trajectory, seed,
-                          verbose)
+                          verbose, telemetry_file)
         self.beta = 1. / (temperature * kB)
         self.chem_pot = chemical_potentials
         self.metadata = {'rejected_additions': 0, 'accepted_removals': 0,
                          'accepted_additions': 0, 'rejected_removals': 0}
         self.resolution = resolution
+        self.grid = None
+        if cavity_radius is not None:
+            if resolution is None:
+                resolution = cavity_radius / 4.
+            self.grid = OccupancyGrid(atoms, resolution, cavity_radius)
+
+        # Speculative execution, evaluate batches of proposals on a pool
+        self.speculative = speculative
+        self.processes = processes
+        self.pool = None
+
+    def _tally(self, mv, accepted, n):
+        if accepted:
+            if self.verbose:
+                print('\t' + mv + ' atom accepted', n)
+            self.metadata['accepted_' + mv] += 1
+        else:
+            if self.verbose:
+                print('\t' + mv + ' atom rejected', n)
+            self.metadata['rejected_' + mv] += 1
 
     def step(self):
+        if self.speculative:
+            return self.speculative_step()
         if self.random_state.uniform() >= .5:
-            mv = 'remove'
+            mv = 'removals'
             new_atoms = del_atom(self.traj[-1], self.chem_pot, self.beta,
-                                 self.random_state
+                                 self.random_state, telemetry=self.telemetry,
+                                 grid=self.grid
                                  )
         else:
-            mv = 'add'
+            mv = 'additions'
             new_atoms = add_atom(self.traj[-1], self.chem_pot, self.beta,
-                                 self.random_state, resolution=self.resolution
+                                 self.random_state, resolution=self.resolution,
+                                 telemetry=self.telemetry, grid=self.grid
                                  )
         if new_atoms is not None:
-            if self.verbose:
-                print('\t' + mv + ' atom accepted', len(new_atoms))
-
-            if mv == 'add':
-                self.metadata['accepted_additions'] += 1
-            elif mv == 'remove':
-                self.metadata['accepted_removals'] += 1
-
+            self._tally(mv, True, len(new_atoms))
             self.traj.append(new_atoms)
             return [new_atoms]
         else:
-            if self.verbose:
-                print('\t' + mv + ' atom rejected', len(self.traj[-1]))
+            self._tally(mv, False, len(self.traj[-1]))
+            return None
 
-            if mv == 'add':
-                self.metadata['rejected_additions'] += 1
-            elif mv == 'remove':
-                self.metadata['rejected_removals'] += 1
+    def speculative_step(self):
+        """
+        Generate a batch of proposals from the current state and evaluate
+        their energies in parallel.  The proposals are then checked in
+        order and the first accepted one is committed, the rest are thrown
+        away.  Since a rejected proposal leaves the state unchanged every
+        proposal up to the first accepted one would have been made from
+        the same state in a serial run.  Each proposal is made, with its
+        acceptance draw, exactly as `step` makes it and the random state is
+        rewound to just after the accepted proposal, so a seed gives the
+        same chain with and without speculation.
 
-            return None
+        Returns
+        -------
+        list of ase.Atoms or None:
+            The new configuration if any proposal was accepted
+        """
+        if self.pool is None:
+            self.pool = Pool(self.processes or cpu_count())
+        atoms = self.traj[-1]
+        with self.telemetry.timer('energy'):
+            e0 = atoms.get_potential_energy()
+
+        proposals = []
+        for i in range(self.speculative):
+            if self.random_state.uniform() >= .5:
+                mv, p = 'removals', propose_removal(
+                    atoms, self.chem_pot, self.beta, self.random_state,
+                    telemetry=self.telemetry, grid=self.grid)
+            else:
+                mv, p = 'additions', propose_addition(
+                    atoms, self.chem_pot, self.beta, self.random_state,
+                    resolution=self.resolution, telemetry=self.telemetry,
+                    grid=self.grid)
+            u = self.random_state.uniform() if p is not None else None
+            proposals.append((mv, p, u, self.random_state.get_state()))
+
+        with self.telemetry.timer('energy'):
+            results = iter(self.pool.map(
+                _proposal_energy,
+                [p[0] for mv, p, u, state in proposals if p is not None]))
+
+        self.step_proposals = 0
+        for mv, p, u, state in proposals:
+            self.step_proposals += 1
+            if p is None:
+                self._tally(mv, False, len(atoms))
+                continue
+            atoms_prime, ln_bias, position = p
+            energy, calc_results = next(results)
+            if accept(energy - e0, ln_bias, self.beta, u):
+                if self.grid is not None:
+                    if mv == 'additions':
+                        self.grid.add(position)
+                    else:
+                        self.grid.remove(position)
+                # the calculator keeps the worker's results for the next
+                # step and the random state carries on as the serial chain
+                set_results(atoms_prime, calc_results)
+                self.random_state.set_state(state)
+                self._tally(mv, True, len(atoms_prime))
+                self.traj.append(atoms_prime)
+                return [atoms_prime]
+            self._tally(mv, False, len(atoms))
+        return None
+
+    def close(self):
+        """
+        Stop the speculative proposal pool, it is started again if needed
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            if self.pool is not None:
+                self.pool.terminate()
+        except Exception:
+            pass
+
+    def run(self, steps=100000000, eq_steps=None, eq_tol=None, **kwargs):
+        try:
+            return Ensemble.run(self, steps, eq_steps, eq_tol, **kwargs)
+        finally:
+            self.close()
+
+    def calls_per_step(self):
+        if self.telemetry.steps > 0:
+            return Ensemble.calls_per_step(self)
+        if self.speculative:
+            # the current energy, the proposals in parallel rounds on the
+            # pool and the accepted configuration
+            rounds = -(-self.speculative // (self.processes or cpu_count()))
+            return {'energy': 2. + rounds, 'force': 0.}
+        return {'energy': 1., 'force': 0.}
 
     def estimate_simulation_duration(self, atoms, iterations):
-        t2 = time()
-        e = atoms.get_potential_energy()
-        te = time() - t2
-
-        total_time = 0.
-        for i in range(iterations):
-            total_time += te
-        return total_time
+        # The number of atoms drifts at the rate measured so far, the cost
+        # is quadratic in the number of atoms so Simpson's rule is exact
+        steps = iterations / self.get_proposals_per_step()
+        rate = 0.
+        if self.telemetry.steps > 0:
+            rate = (len(self.traj[-1]) - len(self.traj[0])) / float(
+                self.telemetry.steps)
+        n0 = len(atoms)
+        n1 = max(n0 + rate * steps, 1)
+        return steps * (self.estimate_step_cost(n0)[0] +
+                        4 * self.estimate_step_cost((n0 + n1) / 2.)[0] +
+                        self.estimate_step_cost(n1)[0]) / 6.
@@ -5,14 +5,14 @@ import numpy as np
 from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
 from pyiid.sim import leapfrog
 from pyiid.sim import Ensemble
+from pyiid.sim.telemetry import timed
 from ase.units import kB
-from time import time
 
 __author__ = 'christopher'
 Emax = 200
 
 
-def buildtree(input_atoms, u, v, j, e, e0, rs, beta=1):
+def buildtree(input_atoms, u, v, j, e, e0, rs, beta=1, telemetry=None):
     """
     Build the tree of samples for NUTS, recursively
 
@@ -37,13 +37,17 @@ def buildtree(input_atoms, u, v, j, e, e0, rs, beta=1):
         generate reproducible simulations
     beta: float
         Thermodynamic beta, a proxy for thermal energy
+    telemetry: Telemetry, optional
+        If given record the time spent in the energy and force calls
     Returns
     -------
     Many things
     """
     if j == 0:
-        atoms_prime = leapfrog(input_atoms, v * e)
-        neg_delta_energy = e0 - atoms_prime.get_total_energy()
+        atoms_prime = leapfrog(input_atoms, v * e, telemetry=telemetry)
+        with timed(telemetry, 'energy'):
+            e_prime = atoms_prime.get_total_energy()
+        neg_delta_energy = e0 - e_prime
         try:
             exp1 = np.exp(neg_delta_energy)
             exp2 = np.exp(Emax + neg_delta_energy)
@@ -56,20 +60,20 @@ def buildtree(input_atoms, u, v, j, e, e0, rs, beta=1):
         n_prime = int(u <= exp1)
         s_prime = int(u < exp2)
         return (atoms_prime, atoms_prime, atoms_prime, n_prime, s_prime,
-                min(1, np.exp(-atoms_prime.get_total_energy() +
-                              input_atoms.get_total_energy())), 1)
+                min(1, np.exp(-e_prime + input_atoms.get_total_energy())), 1)
     else:
         (neg_atoms, pos_atoms, atoms_prime, n_prime, s_prime, a_prime,
-         na_prime) = buildtree(input_atoms, u, v, j - 1, e, e0, rs, beta)
+         na_prime) = buildtree(input_atoms, u, v, j - 1, e, e0, rs, beta,
+                               telemetry)
         if s_prime == 1:
             if v == -1:
                 (neg_atoms, _, atoms_prime_prime, n_prime_prime, s_prime_prime,
                  app, napp) = buildtree(neg_atoms, u, v, j - 1, e, e0, rs,
-                                        beta)
+                                        beta, telemetry)
             else:
                 (_, pos_atoms, atoms_prime_prime, n_prime_prime, s_prime_prime,
                  app, napp) = buildtree(pos_atoms, u, v, j - 1, e, e0, rs,
-                                        beta)
+                                        beta, telemetry)
 
             if rs.uniform() < float(n_prime_prime / (
                     max(n_prime + n_prime_prime, 1))):
@@ -92,9 +96,9 @@ class NUTSCanonicalEnsemble(Ensemble):
     def __init__(self, atoms, restart=None, logfile=None, trajectory=None,
                  temperature=100, escape_level=13, accept_target=.65,
                  momentum=None,
-                 seed=None, verbose=False):
+                 seed=None, verbose=False, telemetry_file=None):
         Ensemble.__init__(self, atoms, restart, logfile, trajectory, seed,
-                          verbose)
+                          verbose, telemetry_file)
         self.accept_target = accept_target
         self.temp = temperature
         self.thermal_nrg = self.temp * kB
@@ -216,7 +220,9 @@ class NUTSCanonicalEnsemble(Ensemble):
         return step_size
 
     def step(self):
-        atoms = dc(self.traj[-1])
+        telemetry = self.telemetry
+        with telemetry.timer('copy'):
+            atoms = dc(self.traj[-1])
         new_configurations = []
         if self.verbose:
             print('\ttime step size', self.step_size / fs, 'fs')
@@ -235,29 +241,32 @@ class NUTSCanonicalEnsemble(Ensemble):
         # Note that because we need to calculate the difference between the
         # proposed energy and the current energy we declare it here,
         # preventing the need for multiple calls to the energy function
-        e0 = atoms.get_total_energy()
+        with telemetry.timer('energy'):
+            e0 = atoms.get_total_energy()
 
         e = self.step_size
         n, s, j = 1, 1, 0
-        neg_atoms = dc(atoms)
-        pos_atoms = dc(atoms)
+        with telemetry.timer('copy'):
+            neg_atoms = dc(atoms)
+            pos_atoms = dc(atoms)
         while s == 1:
             v = self.random_state.choice([-1, 1])
             if v == -1:
                 (neg_atoms, _, atoms_prime, n_prime, s_prime, a,
                  na) = buildtree(neg_atoms, u, v, j, e, e0, self.random_state,
-                                 1 / self.thermal_nrg)
+                                 1 / self.thermal_nrg, telemetry)
             else:
                 (_, pos_atoms, atoms_prime, n_prime, s_prime, a,
                  na) = buildtree(pos_atoms, u, v, j, e, e0, self.random_state,
-                                 1 / self.thermal_nrg)
+                                 1 / self.thermal_nrg, telemetry)
 
             if s_prime == 1 and self.random_state.uniform() < min(
                     1, n_prime * 1. / n):
                 self.traj += [atoms_prime]
                 if self.trajectory is not None:
                     atoms_prime.get_forces()
-                    self.trajectory.write(atoms_prime)
+                    with telemetry.timer('io'):
+                        self.trajectory.write(atoms_prime)
                     if self.verbose:
                         print('\t\t\tTrajectory written', len(self.traj))
                 if self.verbose:
@@ -305,14 +314,10 @@ class NUTSCanonicalEnsemble(Ensemble):
         else:
             return None
 
-    def estimate_simulation_duration(self, atoms, iterations):
-        t0 = time()
-        f = atoms.get_forces() * 2
-        tf = time() - t0
-        t2 = time()
-        e = atoms.get_potential_energy() * 2
-        te = time() - t2
-
-        time_one_step = tf * 2 + te
-        total_time = iterations * time_one_step * 2 ** self.escape_level
-        return total_time
+    def calls_per_step(self):
+        if self.telemetry.steps > 0:
+            return Ensemble.calls_per_step(self)
+        # At worst the tree grows to 2 ** escape_level leapfrog steps, each
+        # with two force calls and an energy call
+        leaps = 2. ** self.escape_level
+        return {'energy': leaps, 'force': 2 * leaps}
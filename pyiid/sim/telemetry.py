@@ -0,0 +1,312 @@
+from __future__ import print_function
+
+"""
+Streaming telemetry for the samplers.  Everything in here is updated in
+constant time per step so that it can stay switched on for production runs,
+the statistics can be dumped as JSON lines and read back by a scheduler
+without having to touch the trajectories.
+"""
+import json
+from collections import deque
+from contextlib import contextmanager
+from time import time
+import numpy as np
+from builtins import range
+
+__author__ = 'christopher'
+
+stages = ['force', 'energy', 'copy', 'io']
+
+
+class Telemetry(object):
+    """
+    Running statistics for an `Ensemble`
+
+    Parameters
+    ----------
+    max_lag: int
+        The largest lag used for the autocorrelation/ESS estimates
+    eq_steps: int, optional
+        The moving average window used for the equilibrium check, if None
+        the equilibrium detector is not run
+
+    >>> t = Telemetry(max_lag=10)
+    >>> t.start_step()
+    >>> with t.timer('force'):
+    ...     pass
+    >>> t.end_step(1.0, True)
+    >>> t.steps
+    1
+    """
+
+    def __init__(self, max_lag=50, eq_steps=None):
+        self.max_lag = int(max_lag)
+        self.t0 = time()
+        self.step_t0 = None
+
+        # wall time and number of calls per stage
+        self.stage_time = dict([(s, 0.) for s in stages])
+        self.stage_calls = dict([(s, 0) for s in stages])
+        self.step_time = 0.
+
+        # acceptance
+        self.steps = 0
+        self.accepted = 0
+        self.proposals = 0
+
+        # Welford moments of the potential energy
+        self.pe_mean = 0.
+        self.pe_m2 = 0.
+
+        # lagged products for the autocorrelation, the ring buffer holds the
+        # last max_lag energies, newest last
+        self._buffer = deque(maxlen=self.max_lag)
+        self._lag_sum = np.zeros(self.max_lag + 1)
+        self._lag_n = np.zeros(self.max_lag + 1, dtype=np.int64)
+        self._sum = 0.
+
+        self.eq_steps = None
+        self.reset_equilibrium(eq_steps)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time a block of code and attribute it to a stage
+
+        Parameters
+        ----------
+        stage: {'force', 'energy', 'copy', 'io'}
+            The stage to attribute the time to
+        """
+        t = time()
+        try:
+            yield
+        finally:
+            self.stage_time[stage] += time() - t
+            self.stage_calls[stage] += 1
+
+    def start_step(self):
+        self.step_t0 = time()
+
+    def end_step(self, pe, accepted, proposals=1):
+        """
+        Record the outcome of one sampler step
+
+        Parameters
+        ----------
+        pe: float
+            The potential energy of the current state of the chain
+        accepted: bool
+            Whether the step produced a new configuration
+        proposals: int
+            Number of proposals made during this step
+        """
+        if self.step_t0 is not None:
+            self.step_time += time() - self.step_t0
+            self.step_t0 = None
+        self.steps += 1
+        self.proposals += proposals
+        if accepted:
+            self.accepted += 1
+        pe = float(pe)
+        self._update_moments(pe)
+        self._update_equilibrium(pe)
+
+    def _update_moments(self, x):
+        n = self.steps
+        delta = x - self.pe_mean
+        self.pe_mean += delta / n
+        self.pe_m2 += delta * (x - self.pe_mean)
+
+        self._sum += x
+        self._lag_sum[0] += x * x
+        self._lag_n[0] += 1
+        # newest first so that buffer[k - 1] is x_{t - k}
+        for k, xk in enumerate(reversed(self._buffer)):
+            self._lag_sum[k + 1] += x * xk
+            self._lag_n[k + 1] += 1
+        self._buffer.append(x)
+
+    # Equilibrium -------------------------------------------------------------
+    def reset_equilibrium(self, eq_steps, history=None):
+        """
+        Restart the equilibrium detector with a new moving average window
+
+        Parameters
+        ----------
+        eq_steps: int or None
+            The moving average window
+        history: list of floats, optional
+            Previous potential energies to replay into the detector
+        """
+        self.eq_steps = eq_steps
+        if eq_steps is None:
+            return
+        self._window = deque(maxlen=eq_steps)
+        self._window_sum = 0.
+        # the first two and last two moving averages past the burn in window
+        self._ma_head = []
+        self._ma_tail = deque(maxlen=2)
+        self._ma_seen = 0
+        if history is not None:
+            for x in history:
+                self._update_equilibrium(x)
+
+    def _update_equilibrium(self, x):
+        if self.eq_steps is None:
+            return
+        if len(self._window) == self.eq_steps:
+            self._window_sum -= self._window[0]
+        self._window.append(x)
+        self._window_sum += x
+        if len(self._window) < self.eq_steps:
+            return
+        self._ma_seen += 1
+        # the batch version discards the first eq_steps moving averages
+        if self._ma_seen <= self.eq_steps:
+            return
+        ma = self._window_sum / self.eq_steps
+        if len(self._ma_head) < 2:
+            self._ma_head.append(ma)
+        self._ma_tail.append(ma)
+
+    def equilibrium_drift(self):
+        """
+        The summed gradient of the moving average energy.  This is the same
+        quantity as ``np.sum(np.gradient(ma))`` over the whole history, but
+        the sum telescopes so only the first and last two moving averages
+        are needed.
+
+        Returns
+        -------
+        float or None:
+            The drift, None if there is not enough history yet
+        """
+        if self.eq_steps is None or len(self._ma_head) < 2:
+            return None
+        y0, y1 = self._ma_head
+        yl2, yl1 = self._ma_tail
+        return 1.5 * yl1 - .5 * yl2 + .5 * y1 - 1.5 * y0
+
+    def at_equilibrium(self, tol):
+        drift = self.equilibrium_drift()
+        if drift is None:
+            return False
+        return drift < tol
+
+    # Derived statistics ------------------------------------------------------
+    def autocorrelation(self):
+        """
+        Estimate the normalized autocorrelation of the potential energy
+
+        Returns
+        -------
+        1darray:
+            The autocorrelation for lags 0 to max_lag, lags which have not
+            been seen yet are nan
+        """
+        rho = np.empty(self.max_lag + 1)
+        rho[:] = np.nan
+        if self.steps < 2:
+            return rho
+        mean = self._sum / self.steps
+        seen = self._lag_n > 0
+        gamma = self._lag_sum[seen] / self._lag_n[seen] - mean * mean
+        if gamma[0] <= 0:
+            return rho
+        rho[seen] = gamma / gamma[0]
+        return rho
+
+    def ess(self):
+        """
+        Estimate the effective sample size of the potential energy using the
+        initial positive sequence of the autocorrelation
+
+        Returns
+        -------
+        float:
+            The effective sample size
+        """
+        rho = self.autocorrelation()
+        if np.isnan(rho[0]):
+            return float(self.steps)
+        tau = 1.
+        for k in range(1, len(rho)):
+            if np.isnan(rho[k]) or rho[k] <= 0:
+                break
+            tau += 2 * rho[k]
+        return float(self.steps / tau)
+
+    def elapsed(self):
+        return time() - self.t0
+
+    def summary(self):
+        """
+        Collect the current statistics
+
+        Returns
+        -------
+        dict:
+            The statistics, all values are JSON serializable
+        """
+        wall = self.elapsed()
+        evaluations = self.stage_calls['force'] + self.stage_calls['energy']
+        if self.steps > 1:
+            pe_var = self.pe_m2 / (self.steps - 1)
+        else:
+            pe_var = 0.
+        ret = {
+            'steps': self.steps,
+            'wall_time': wall,
+            'step_time': self.step_time,
+            'stage_time': dict(self.stage_time),
+            'stage_calls': dict(self.stage_calls),
+            'evaluations': evaluations,
+            'evaluations_per_second': evaluations / wall if wall else 0.,
+            'steps_per_second': self.steps / wall if wall else 0.,
+            'accepted': self.accepted,
+            'proposals': self.proposals,
+            'acceptance': self.accepted / float(self.proposals)
+            if self.proposals else 0.,
+            'pe_mean': self.pe_mean,
+            'pe_var': pe_var,
+            'ess': self.ess(),
+            'equilibrium_drift': self.equilibrium_drift(),
+        }
+        return ret
+
+    def to_json(self):
+        return json.dumps(self.summary(), sort_keys=True)
+
+    def write(self, f):
+        """
+        Append the current statistics as one JSON line
+
+        Parameters
+        ----------
+        f: file
+            An open, writable file object
+        """
+        f.write(self.to_json() + '\n')
+        f.flush()
+
+
+@contextmanager
+def _null_timer():
+    yield
+
+
+def timed(telemetry, stage):
+    """
+    Time a block if telemetry is attached, otherwise do nothing
+
+    Parameters
+    ----------
+    telemetry: Telemetry or None
+        The telemetry to record into
+    stage: {'force', 'energy', 'copy', 'io'}
+        The stage to attribute the time to
+    """
+    if telemetry is None:
+        return _null_timer()
+    return telemetry.timer(stage)
@@ -245,12 +245,14 @@ elif os.getenv('SHORT_TEST'):
     proc_alg_pairs = [('CPU', 'nxn'),
                       ('CPU', 'flat'),
                       ('CPU', 'flat-serial'),
+                      ('CPU', 'flat-threaded'),
                       ('Multi-GPU', 'flat'),
                       ]
     comparison_pro_alg_pairs = [
         # (('CPU', 'nxn'), ('CPU', 'flat-serial')),
         # (('CPU', 'flat-serial'), ('CPU', 'flat')),
         (('CPU', 'nxn'), ('CPU', 'flat')),
+        (('CPU', 'nxn'), ('CPU', 'flat-threaded')),
         (('CPU', 'flat'), ('Multi-GPU', 'flat')),
 
     ]
@@ -265,11 +267,14 @@ else:
     proc_alg_pairs = [('CPU', 'nxn'),
                       ('CPU', 'flat-serial'),
                       ('CPU', 'flat'),
+                      ('CPU', 'flat-threaded'),
                       ('Multi-GPU', 'flat'),
                       ]
     comparison_pro_alg_pairs = [
         (('CPU', 'nxn'), ('CPU', 'flat-serial')),
         (('CPU', 'flat-serial'), ('CPU', 'flat')),
+        (('CPU', 'flat-serial'), ('CPU', 'flat-threaded')),
+        (('CPU', 'flat-threaded'), ('CPU', 'stream')),
         # (('CPU', 'nxn'), ('CPU', 'flat')),
         (('CPU', 'flat'), ('Multi-GPU', 'flat')),
         # (('CPU', 'nxn'), ('Multi-GPU', 'flat'))
@@ -0,0 +1,132 @@
+from __future__ import print_function
+import math
+import tempfile
+import shutil
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter import backends
+from pyiid.experiments.elasticscatter.backends import register_backend, \
+    Autotuner
+
+__author__ = 'christopher'
+
+calls = []
+
+
+# A backend which records its calls, registered by the tests below
+def wrap_fq(atoms, qbin=.1, sum_type='fq'):
+    calls.append(('fq', len(atoms)))
+    return np.ones(int(math.floor(atoms.info['exp']['qmax'] / qbin)),
+                   np.float32)
+
+
+def wrap_fq_grad(atoms, qbin=.1, sum_type='fq'):
+    calls.append(('grad', len(atoms)))
+    return np.ones((len(atoms), 3,
+                    int(math.floor(atoms.info['exp']['qmax'] / qbin))),
+                   np.float32)
+
+
+def test_register_backend():
+    register_backend('Test', 'recorder', __name__)
+    try:
+        s = ElasticScatter()
+        assert 'Test' in backends.get_processors()
+        assert s.set_processor('Test', 'recorder')
+        assert s.alg == 'recorder'
+        del calls[:]
+        atoms = setup_atoms(10)
+        s.get_fq(atoms)
+        s.get_grad_fq(atoms)
+        assert calls == [('fq', 10), ('grad', 10)]
+    finally:
+        del backends.backends[('Test', 'recorder')]
+
+
+def test_default_processor():
+    # the autotuner is opt in, by default the flat CPU backend is used
+    s = ElasticScatter()
+    s.get_fq(setup_atoms(10))
+    assert (s.processor, s.alg) == ('CPU', 'flat')
+
+
+def test_autotune():
+    cache_dir = tempfile.mkdtemp()
+    old_tuner = backends.autotuner
+    backends.autotuner = Autotuner(os.path.join(cache_dir, 'autotune.json'))
+    register_backend('Test', 'a', __name__)
+    register_backend('Test', 'b', __name__)
+    try:
+        s = ElasticScatter()
+        assert s.set_processor('Test', 'auto')
+        assert s.alg == 'auto'
+        atoms = setup_atoms(10)
+        del calls[:]
+        s.get_fq(atoms)
+        # both candidates were timed, after a compile run on 4 atoms
+        assert calls == [('fq', 4), ('fq', 10), ('fq', 4), ('fq', 10)]
+        del calls[:]
+        s.get_fq(atoms)
+        assert calls == [('fq', 10)]
+        # the choice was written to disk
+        key = backends.autotuner.get_key(
+            'fq', ['Test/a', 'Test/b'], 10,
+            int(math.floor(s.exp['qmax'] / s.exp['qbin'])))
+        assert Autotuner(backends.autotuner.cache_file).lookup(key) in [
+            'Test/a', 'Test/b']
+    finally:
+        del backends.backends[('Test', 'a')]
+        del backends.backends[('Test', 'b')]
+        backends.autotuner = old_tuner
+        shutil.rmtree(cache_dir)
+
+
+def test_autotune_max_work():
+    # too big to time, the calculation runs once on the preferred backend
+    old_tuner, old_untuned = backends.autotuner, backends.untuned
+    backends.autotuner = Autotuner(persist=False, max_work=1)
+    backends.untuned = ['Test/b']
+    register_backend('Test', 'a', __name__)
+    register_backend('Test', 'b', __name__)
+    try:
+        s = ElasticScatter()
+        assert s.set_processor('Test', 'auto')
+        del calls[:]
+        s.get_fq(setup_atoms(10))
+        assert calls == [('fq', 10)]
+        assert backends.autotuner.table == {}
+    finally:
+        del backends.backends[('Test', 'a')]
+        del backends.backends[('Test', 'b')]
+        backends.autotuner = old_tuner
+        backends.untuned = old_untuned
+
+
+def test_fits_budget():
+    from pyiid.experiments.elasticscatter import memory
+    old = memory.memory_budget
+    memory.set_memory_budget('1G')
+    try:
+        serial = backends.get_backend('CPU', 'flat-serial')
+        assert serial.fits('fq', 100, 250)
+        # the full kx3xQ arrays of 2000 atoms are about 10G
+        assert not serial.fits('grad', 2000, 250)
+        assert not backends.get_backend('CPU', 'nxn').fits('grad', 2000, 250)
+        # the flat backend chunks them
+        assert backends.get_backend('CPU', 'flat').fits('grad', 2000, 250)
+    finally:
+        memory.memory_budget = old
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,88 @@
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.kernels.master_kernel import \
+    get_pdf_at_qmin, get_pdf_at_qmin_batch
+
+__author__ = 'christopher'
+
+
+def setup_frames(n, m):
+    atoms = setup_atoms(n)
+    frames = []
+    for i in range(m):
+        a = atoms.copy()
+        a.rattle(.1, seed=i)
+        frames.append(a)
+    return frames
+
+
+def test_fq_batch():
+    s = ElasticScatter({'qmin': 1.})
+    frames = setup_frames(30, 4)
+    fq = s.get_fq_batch(frames)
+    assert fq.shape == (4, len(s.get_scatter_vector()))
+    for f, atoms in zip(fq, frames):
+        stats_check(f, s.get_fq(atoms), rtol=1e-4, atol=1e-5)
+    # the same positions as an array with shared numbers
+    positions = np.asarray([a.positions for a in frames])
+    stats_check(s.get_fq_batch(positions, frames[0].numbers), fq)
+
+
+def test_fq_batch_mixed():
+    # configurations of different atoms are batched separately
+    s = ElasticScatter()
+    frames = setup_frames(20, 2) + setup_frames(25, 2)
+    frames.insert(1, frames.pop())
+    fq = s.get_fq_batch(frames)
+    for f, atoms in zip(fq, frames):
+        stats_check(f, s.get_fq(atoms), rtol=1e-4, atol=1e-5)
+
+
+def test_fq_batch_backend():
+    # the batch runs on the chosen backend
+    frames = setup_frames(20, 3)
+    for kernel in ['nxn', 'flat-threaded']:
+        s = ElasticScatter()
+        s.set_processor('CPU', kernel)
+        with s.profile() as stats:
+            fq = s.get_fq_batch(frames)
+        batched = [r.calls for (b, st), r in stats.records.items()
+                   if st == 'get_fq_batch_blocks']
+        if kernel == 'nxn':
+            assert not batched
+            assert stats.records[('CPU/nxn', 'total')].calls == 3
+        else:
+            assert batched == [1]
+        for f, atoms in zip(fq, frames):
+            stats_check(f, s.get_fq(atoms), rtol=1e-4, atol=1e-5)
+
+
+def test_pdf_batch():
+    s = ElasticScatter({'qmin': 1.5, 'rmax': 20.})
+    frames = setup_frames(30, 3)
+    pdf = s.get_pdf_batch(iter(frames))
+    assert pdf.shape == (3, len(s.get_r()))
+    for p, atoms in zip(pdf, frames):
+        stats_check(p, s.get_pdf(atoms), rtol=1e-4, atol=1e-5)
+
+
+def test_pdf_at_qmin_batch():
+    fq = rs.random_sample((3, 250))
+    r = np.arange(0, 20, .01)
+    pdf = get_pdf_at_qmin_batch(fq, .01, .1, r, .5)
+    for p, f in zip(pdf, fq):
+        assert_allclose(p, get_pdf_at_qmin(f.copy(), .01, .1, r, .5))
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,70 @@
+from __future__ import print_function
+from pyiid.tests import *
+from ase.cluster import Octahedron
+from pyiid.calc.stem_calc import STEMCalc
+from pyiid.calc.multi_calc import MultiCalc
+from pyiid.experiments.stem import STEM
+
+__author__ = 'christopher'
+
+atoms = Octahedron('Au', 3)
+atoms.set_cell(np.ptp(atoms.positions, axis=0) + 8)
+atoms.center()
+stem = STEM(resolution=.2, probe_sigma=.6)
+target = stem.get_fft_image(atoms)
+
+
+def check_forces(potential):
+    atoms2 = dc(atoms)
+    atoms2.rattle(.1, seed=42)
+    atoms2.set_calculator(STEMCalc(target_data=target, stem=stem,
+                                   potential=potential))
+    forces = atoms2.get_forces()
+    h = 1e-5
+    num_forces = np.zeros(forces.shape)
+    for i in range(len(atoms2)):
+        for w in range(3):
+            atoms2.positions[i, w] += h
+            ep = atoms2.get_potential_energy()
+            atoms2.positions[i, w] -= 2 * h
+            em = atoms2.get_potential_energy()
+            atoms2.positions[i, w] += h
+            num_forces[i, w] = -(ep - em) / (2 * h)
+    assert_allclose(forces, num_forces, atol=1e-6 * np.max(np.abs(forces)))
+
+
+def test_forces():
+    for potential in ['rw', 'chi_sq']:
+        yield check_forces, potential
+
+
+def test_target_is_minimum():
+    atoms2 = dc(atoms)
+    atoms2.set_calculator(STEMCalc(target_data=target, stem=stem))
+    assert atoms2.get_potential_energy() < 1e-10
+
+
+def test_multi_calc():
+    atoms2 = dc(atoms)
+    atoms2.rattle(.1, seed=42)
+    calc = STEMCalc(target_data=target, stem=stem)
+    atoms2.set_calculator(MultiCalc(calc_list=[calc, Spring(k=10, rt=2.5)]))
+    e = atoms2.get_potential_energy()
+    f = atoms2.get_forces()
+    atoms2.set_calculator(calc)
+    assert e >= atoms2.get_potential_energy()
+    assert f.shape == (len(atoms2), 3)
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,103 @@
+from time import time
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.memory import flat_serial_bytes
+from pyiid.cost import CostModel, ScatterCostModel, pair_features, \
+    get_fft_length, _probe_atoms
+
+__author__ = 'christopher'
+
+
+def test_fit():
+    sizes = [{'n': n, 'qmax_bin': 100} for n in [4, 8, 16, 32]]
+    x = np.array([pair_features(**s) for s in sizes])
+    seconds = x.dot([1e-3, 1e-7, 1e-8])
+    nbytes = x.dot([100., 12., 0.])
+    model = CostModel(pair_features).fit(sizes, seconds, nbytes)
+    assert_allclose(model.predict(n=64, qmax_bin=100)[0],
+                    np.dot(pair_features(64, 100), [1e-3, 1e-7, 1e-8]))
+    assert np.all(model.byte_coef >= 0)
+    # the fit can be stored and read back
+    d = model.to_dict()
+    model2 = CostModel(pair_features, d['time'], d['bytes'])
+    assert model2.predict(n=64, qmax_bin=100) == \
+        model.predict(n=64, qmax_bin=100)
+
+
+def test_fft_length():
+    s = ElasticScatter()
+    qmax_bin = int(s.exp['qmax'] / s.pdf_qbin)
+    fq = np.zeros(qmax_bin)
+    from pyiid.experiments.elasticscatter.kernels import master_kernel
+    lengths = []
+    fft = master_kernel.fft_gr_to_fq
+
+    def spy(g, rstep, rmin):
+        lengths.append(len(g))
+        return fft(g, rstep, rmin)
+
+    master_kernel.fft_gr_to_fq = spy
+    try:
+        master_kernel.get_pdf_at_qmin(fq, s.exp['rstep'], s.pdf_qbin,
+                                      s.get_r(), s.exp['qmin'])
+    finally:
+        master_kernel.fft_gr_to_fq = fft
+    n = lengths[0]
+    npad2 = (1 << int(np.ceil(np.log2(n)))) * 2
+    assert get_fft_length(qmax_bin, s.exp['rstep'], s.pdf_qbin,
+                          s.exp['qmin']) == 4 * npad2
+
+
+def test_scatter_model():
+    model = ScatterCostModel(persist=False, probe_time=.05)
+    name = 'CPU/flat-serial'
+    small = model.predict(name, 'get_fq', 50, 250)
+    big = model.predict(name, 'get_fq', 600, 250)
+    assert 0 < small[0] < big[0]
+    # the bytes are those the memory plan of the backend uses
+    assert big[1] == flat_serial_bytes('fq', 600, 250)
+    grad = model.predict(name, 'get_grad_fq', 600, 250)
+    assert grad[1] == flat_serial_bytes('grad', 600, 250)
+    # the model is only fitted once
+    assert len(model.models) == 2
+    model.predict(name, 'get_fq', 100, 250)
+    assert len(model.models) == 2
+    # the time extrapolates past the probes, which stop well below 600 atoms
+    s = ElasticScatter({'qmax': 25., 'qbin': .1})
+    s.set_processor('CPU', 'flat-serial')
+    atoms = _probe_atoms(600)
+    s.get_fq(atoms)
+    t0 = time()
+    s.get_fq(atoms)
+    t = time() - t0
+    assert t / 2.5 < big[0] < t * 2.5
+
+
+def test_estimate_cost():
+    s = ElasticScatter()
+    s.set_processor('CPU', 'flat-serial')
+    atoms = setup_atoms(40)
+    seconds, nbytes = s.estimate_cost('get_fq', len(atoms))
+    assert seconds > 0 and nbytes > 0
+    s.get_fq(atoms)
+    t0 = time()
+    s.get_fq(atoms)
+    t = time() - t0
+    # a rough prediction, the timings of small calls are noisy
+    assert t / 20. < seconds < t * 20. + .01
+    for method in ['get_grad_fq', 'get_pdf', 'get_grad_pdf']:
+        assert s.estimate_cost(method, len(atoms))[0] > 0
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
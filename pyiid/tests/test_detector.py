@@ -0,0 +1,72 @@
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.detector import DetectorMap, \
+    detector_map_cache
+
+__author__ = 'christopher'
+
+
+def loop_2d_scatter(iq, s, qb, pixel_array):
+    # the projection one Q bin at a time
+    fp = pixel_array.ravel()
+    img = np.zeros(fp.shape)
+    for sub_s, i in zip(s, iq):
+        c = np.intersect1d(np.where(sub_s - qb / 2. < fp)[0],
+                           np.where(sub_s + qb / 2. > fp)[0])
+        img[c] = i
+    return img.reshape(pixel_array.shape)
+
+
+def test_detector_map():
+    s = np.arange(.5, 10., .1)
+    iq = rs.random_sample(len(s))
+    pixels = rs.uniform(0, 12., (40, 30))
+    # pixels on the bin edges are in no bin
+    pixels[0, :5] = s[:5] + .05
+    m = DetectorMap(pixels, s, .1)
+    assert_allclose(m.project(iq), loop_2d_scatter(iq, s, .1, pixels))
+
+
+def test_detector_interpolate():
+    s = np.arange(.5, 10., .1)
+    iq = np.sin(s)
+    pixels = rs.uniform(.3, 10.2, (20, 20))
+    img = DetectorMap(pixels, s, .1, True).project(iq)
+    inside = (pixels > s[0] - .05) & (pixels < s[-1] + .05)
+    # the weights are float32
+    assert_allclose(img[inside], np.interp(pixels[inside], s, iq),
+                    rtol=1e-5, atol=1e-7)
+    assert np.all(img[~inside] == 0)
+
+
+def test_2d_scatter():
+    atoms = setup_atoms(10)
+    s = ElasticScatter({'qmax': 8., 'qmin': .5})
+    q = s.get_scatter_vector()
+    i, j = np.indices((60, 60))
+    pixels = np.sqrt(i ** 2 + j ** 2)
+    pixels *= np.max(q) / np.max(pixels)
+    detector_map_cache.clear()
+    img = s.get_2d_scatter(atoms, pixels)
+    assert_allclose(img, loop_2d_scatter(s.get_iq(atoms), q,
+                                         s.exp['qbin'], pixels))
+    # the map is reused for the next frame on the same detector
+    atoms.rattle(.1)
+    s.get_2d_scatter(atoms, pixels)
+    assert detector_map_cache.hits == 1
+    assert s.get_2d_scatter(atoms, pixels, interpolate=True).shape == \
+        pixels.shape
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,68 @@
+from __future__ import print_function
+from pyiid.tests import *
+from ase.cluster import Octahedron
+from pyiid.experiments.exafs import EXAFS
+
+__author__ = 'christopher'
+
+atoms = Octahedron('Au', 4)
+atoms.rattle(.05, seed=42)
+atoms.numbers[::4] = 46
+k = np.linspace(0, 20, 50)
+
+
+def get_exafs():
+    e = EXAFS('Au', {'rmax': 4.5, 'mfp': 8., 'kweight': 2})
+    e.set_path_table('Au', 'Pd', k, np.exp(-k / 10.), -.3 * k)
+    return e
+
+
+def test_chi():
+    e = get_exafs()
+    ans = e.get_chi(atoms)
+    ks = e.get_scatter_vector()
+    r = atoms.get_all_distances()
+    chi = np.zeros(len(ks))
+    for i in np.where(atoms.numbers == 79)[0]:
+        for j in range(len(atoms)):
+            if i == j or r[i, j] >= 4.5:
+                continue
+            amp, phase = 1., 0.
+            if atoms.numbers[j] == 46:
+                amp = np.interp(ks, k, np.exp(-k / 10.))
+                phase = np.interp(ks, k, -.3 * k)
+            chi += amp / (ks * r[i, j] ** 2) * np.exp(-2 * ks ** 2 * .003) \
+                * np.exp(-2 * r[i, j] / 8.) * np.sin(2 * ks * r[i, j] + phase)
+    chi *= ks ** 2 / np.sum(atoms.numbers == 79)
+    assert_allclose(ans, chi, atol=1e-10 * np.max(np.abs(chi)))
+
+
+def test_grad_chi():
+    e = get_exafs()
+    atoms2 = dc(atoms)
+    ans = e.get_grad_chi(atoms2)
+    h = 1e-6
+    grad = np.zeros(ans.shape)
+    for i in range(len(atoms2)):
+        for w in range(3):
+            atoms2.positions[i, w] += h
+            cp = e.get_chi(atoms2)
+            atoms2.positions[i, w] -= 2 * h
+            cm = e.get_chi(atoms2)
+            atoms2.positions[i, w] += h
+            grad[i, w] = -(cp - cm) / (2 * h)
+    assert_allclose(ans, grad, atol=1e-6 * np.max(np.abs(ans)))
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,117 @@
+import subprocess
+import sys
+import tempfile
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+
+__author__ = 'christopher'
+
+
+def test_tiles():
+    from pyiid.experiments.elasticscatter.kernels.cpu_threaded import \
+        get_tiles, get_tile_pairs, get_tile_blocks
+    for n, tile_size, n_blocks in [(10, 3, 4), (10, 16, 4), (37, 5, 7),
+                                   (2, 1, 3)]:
+        tiles = get_tiles(n, tile_size)
+        # every pair is covered exactly once
+        pairs = set()
+        for i0, i1, j0, j1 in tiles:
+            for i in range(i0, i1):
+                for j in range(j0, min(j1, i)):
+                    assert (i, j) not in pairs
+                    pairs.add((i, j))
+        assert len(pairs) == n * (n - 1) // 2
+        assert np.sum(get_tile_pairs(tiles)) == len(pairs)
+        starts = get_tile_blocks(tiles, n_blocks)
+        assert starts[0] == 0
+        assert starts[-1] == len(tiles)
+        assert np.all(np.diff(starts) > 0)
+        assert len(starts) - 1 <= n_blocks
+
+
+def test_pair_histogram():
+    from pyiid.experiments.elasticscatter.cpu_wrappers.flat_threaded_cpu_wrap \
+        import get_pair_histogram
+    atoms = setup_atoms(30)
+    atoms.numbers[::3] = 26
+    elements, hist = get_pair_histogram(atoms, rstep=.1, rmax=100.)
+    assert np.sum(hist) == 30 * 29 // 2
+    r = np.linalg.norm(atoms.positions[:, None] - atoms.positions[None],
+                       axis=-1)
+    i, j = np.tril_indices(30, -1)
+    fe = atoms.numbers == 26
+    assert_allclose(np.sum(hist[0, 0]), np.sum(fe[i] & fe[j]))
+    assert_allclose(np.sum(hist[1, 1]), np.sum(~fe[i] & ~fe[j]))
+    assert_allclose(np.sum(hist, axis=(0, 1)),
+                    np.bincount((r[i, j] / .1).astype(int), minlength=1000))
+
+
+def test_thread_count_independent():
+    # The blocks are reduced in a fixed order, so the answer does not depend
+    # on the number of threads
+    from pyiid.experiments.elasticscatter.cpu_wrappers import \
+        flat_threaded_cpu_wrap as wrap
+    atoms = setup_atoms(20)
+    s = ElasticScatter()
+    s.set_processor('CPU', 'flat-threaded')
+    old = wrap.num_threads
+    try:
+        wrap.set_num_threads(1)
+        fq1 = s.get_fq(atoms)
+        grad1 = s.get_grad_fq(atoms)
+        wrap.set_num_threads(None)
+        fq2 = s.get_fq(atoms)
+        grad2 = s.get_grad_fq(atoms)
+    finally:
+        wrap.set_num_threads(old)
+    assert stats_check(fq1, fq2, rtol=1e-6, atol=1e-7)
+    assert stats_check(grad1, grad2, rtol=1e-6, atol=1e-7)
+
+
+def test_threaded_then_flat():
+    # The flat pool must start after the threading layer has threads, a
+    # forked pool can deadlock under TBB
+    from pyiid.experiments.shared.pool import get_context
+    assert get_context().get_start_method() != 'fork'
+    atoms = setup_atoms(20)
+    s = ElasticScatter()
+    s.set_processor('CPU', 'flat-threaded')
+    fq1 = s.get_fq(atoms)
+    grad1 = s.get_grad_fq(atoms)
+    s.set_processor('CPU', 'flat')
+    fq2 = s.get_fq(atoms)
+    grad2 = s.get_grad_fq(atoms)
+    assert stats_check(fq1, fq2, rtol=1e-5, atol=1e-6)
+    assert stats_check(grad1, grad2, rtol=1e-5, atol=1e-6)
+
+
+def test_unguarded_script():
+    # Until the threaded kernels run the pools are forked, so a script
+    # without a __main__ guard can still use the flat backend
+    script = tempfile.NamedTemporaryFile('w', suffix='.py', delete=False)
+    try:
+        script.write('\n'.join([
+            'from ase.cluster import Octahedron',
+            'from pyiid.experiments.elasticscatter import ElasticScatter',
+            's = ElasticScatter()',
+            "s.set_processor('CPU', 'flat')",
+            'print(len(s.get_pdf(Octahedron("Au", 3))))', '']))
+        script.close()
+        out = subprocess.check_output([sys.executable, script.name])
+        assert int(out.decode().split()[-1]) == len(ElasticScatter().get_r())
+    finally:
+        os.remove(script.name)
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
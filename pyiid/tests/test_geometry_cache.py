@@ -0,0 +1,93 @@
+from __future__ import print_function
+from numpy.testing import assert_raises
+from pyiid.tests import *
+from ase.cluster import Octahedron
+from pyiid.experiments.elasticscatter.kernels import k_to_ij
+from pyiid.experiments.shared import GeometryCache
+
+__author__ = 'christopher'
+
+atoms = Octahedron('Au', 3)
+atoms.rattle(.1, seed=42)
+
+
+def test_nxn():
+    cache = GeometryCache()
+    d, r = cache.get_nxn(atoms)
+    q = atoms.get_positions()
+    assert_allclose(d, q[np.newaxis, :, :] - q[:, np.newaxis, :], atol=1e-5)
+    assert_allclose(r, atoms.get_all_distances(), atol=1e-5)
+
+
+def test_flat():
+    cache = GeometryCache()
+    d, r = cache.get_flat(atoms)
+    q = atoms.get_positions()
+    for k in range(len(r)):
+        i, j = k_to_ij(k)
+        assert_allclose(d[k], q[i] - q[j], atol=1e-5)
+
+
+def test_stamp():
+    cache = GeometryCache(max_entries=2)
+    cache.get_nxn(atoms)
+    cache.get_nxn(dc(atoms))
+    assert cache.hits == 1
+    atoms2 = dc(atoms)
+    atoms2.positions[0, 0] += 1e-3
+    d, r = cache.get_nxn(atoms2)
+    assert cache.misses == 2
+    assert_allclose(r, atoms2.get_all_distances(), atol=1e-5)
+
+
+def test_max_bytes():
+    n = len(atoms)
+    nxn_bytes = 16 * n * n
+    cache = GeometryCache(max_bytes=nxn_bytes + 1)
+    cache.get_nxn(atoms)
+    assert cache.nbytes == nxn_bytes
+    # the oldest geometry is dropped to make room
+    atoms2 = dc(atoms)
+    atoms2.positions[0, 0] += 1e-3
+    cache.get_nxn(atoms2)
+    assert len(cache.entries) == 1
+    assert cache.nbytes == nxn_bytes
+    # a geometry bigger than the cache is not kept
+    cache = GeometryCache(max_bytes=nxn_bytes - 1)
+    cache.get_nxn(atoms)
+    assert len(cache.entries) == 0
+    assert cache.nbytes == 0
+
+
+def test_atom_count():
+    cache = GeometryCache()
+    cache.get_nxn(atoms)
+    cache.get_flat(atoms)
+    smaller = atoms[:-1]
+    cache.get_nxn(smaller)
+    assert len(cache.entries) == 1
+    assert cache.nbytes == 16 * len(smaller) ** 2
+
+
+
+def test_read_only():
+    # the consumers share the arrays, a write would reach all of them
+    cache = GeometryCache()
+    for value in [cache.get_nxn(atoms), cache.get_flat(atoms),
+                  cache.get_neighbor_arrays(atoms, 3.)]:
+        for a in value:
+            assert_raises(ValueError, a.__setitem__, 0, 0)
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,34 @@
+from __future__ import print_function
+import subprocess
+import sys
+from pyiid.tests import *
+
+__author__ = 'christopher'
+
+
+def test_lazy_backends():
+    # Use a fresh interpreter, the test suite itself loads the backends
+    code = '\n'.join([
+        'import sys',
+        'from pyiid.experiments.elasticscatter import ElasticScatter',
+        's = ElasticScatter()',
+        'print(",".join(m for m in {0!r} if m in sys.modules))'.format(
+            ['accelerate', 'mkl', 'xraylib', 'numba.cuda',
+             'scipy.interpolate']),
+    ])
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == ''
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
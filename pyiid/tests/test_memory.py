@@ -0,0 +1,154 @@
+from numpy.testing import assert_raises
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.atomics import get_scatter_tables
+from pyiid.experiments.elasticscatter.atomics.cpu_atomics import atomic_fq, \
+    atomic_grad_fq
+from pyiid.experiments.elasticscatter import memory
+from pyiid.experiments.elasticscatter.memory import MemoryPlan, \
+    chunk_bytes, measure_task, parse_bytes, nxn_bytes, flat_serial_bytes
+
+__author__ = 'christopher'
+
+
+def test_parse_bytes():
+    assert parse_bytes('4G') == 4 * 2 ** 30
+    assert parse_bytes('512mb') == 512 * 2 ** 20
+    assert parse_bytes(1000.) == 1000
+
+
+def test_plan():
+    n, qmax_bin = 200, 250
+    for kind in ['fq', 'grad']:
+        for budget in ['4M', '20M', '200M']:
+            plan = MemoryPlan(kind, n, qmax_bin, 2, budget, processes=4)
+            assert plan.report.predicted_peak <= parse_bytes(budget)
+            assert sum(size for size, k_cov in plan.chunks) == plan.k_max
+            for (s0, k0), (s1, k1) in zip(plan.chunks[:-1], plan.chunks[1:]):
+                assert k1 == k0 + s0
+        assert_raises(MemoryError, MemoryPlan, kind, n, qmax_bin, 2, 1000)
+    # a small budget uses fewer processes rather than failing
+    plan = MemoryPlan('grad', n, qmax_bin, 2, '4M', processes=4)
+    assert plan.processes < 4
+
+
+def test_model():
+    # the byte model against the memory the chunks allocate
+    atoms = setup_atoms(40)
+    s = ElasticScatter()
+    s._wrap_atoms(atoms)
+    index, table = get_scatter_tables(atoms, 'fq')
+    q = atoms.get_positions().astype(np.float32)
+    qmax_bin = table.shape[1]
+    for kind, f in [('fq', atomic_fq), ('grad', atomic_grad_fq)]:
+        # compile the kernels first
+        f((q, None, index, table, s.exp['qbin'], 1, 0))
+        for k in [100, 700]:
+            task = (q, None, index, table, s.exp['qbin'], k, 10)
+            ans, peak = measure_task((f, task))
+            predicted = chunk_bytes(kind, 40, qmax_bin, k)
+            assert abs(predicted - peak) < .05 * peak + 2 ** 12
+
+
+def test_report():
+    atoms = setup_atoms(60)
+    s = ElasticScatter()
+    s.set_processor('CPU', 'flat')
+    old_budget = memory.memory_budget
+    try:
+        for budget in ['2M', '6M']:
+            memory.set_memory_budget(budget)
+            for f in [s.get_fq, s.get_grad_fq]:
+                f(atoms)
+                report = memory.get_last_report()
+                assert report.predicted_peak <= parse_bytes(budget)
+                assert 0 < report.observed_peak <= report.predicted_peak
+                assert report.predicted_peak < 1.1 * report.observed_peak
+    finally:
+        memory.memory_budget = old_budget
+
+
+def test_report_in_process():
+    # the backends which run in this process plan and report as well
+    atoms = setup_atoms(60)
+    s = ElasticScatter()
+    old_budget, old_trace = memory.memory_budget, memory.trace
+    memory.trace = True
+    try:
+        for kernel in ['nxn', 'flat-serial', 'flat-threaded', 'stream']:
+            s.set_processor('CPU', kernel)
+            for f in [s.get_fq, s.get_grad_fq]:
+                # the first call compiles the kernels
+                f(atoms)
+                last = memory.get_last_report()
+                f(atoms)
+                report = memory.get_last_report()
+                assert report is not last
+                assert report.processes == 0
+                assert 0 < report.observed_peak
+                assert report.observed_peak < 1.1 * report.predicted_peak
+        # a budget the arrays do not fit in is refused before they are made
+        memory.set_memory_budget('1M')
+        s.set_processor('CPU', 'nxn')
+        assert_raises(MemoryError, s.get_grad_fq, atoms)
+    finally:
+        memory.memory_budget = old_budget
+        memory.trace = old_trace
+
+
+def test_in_process_budget():
+    # nxn and flat-serial hold every pair at once, they refuse a budget one
+    # byte short of their arrays and run at exactly that budget
+    atoms = setup_atoms(60)
+    s = ElasticScatter()
+    s._wrap_atoms(atoms)
+    qmax_bin = get_scatter_tables(atoms, 'fq')[1].shape[1]
+    old_budget = memory.memory_budget
+    try:
+        for kernel, model in [('nxn', nxn_bytes),
+                              ('flat-serial', flat_serial_bytes)]:
+            s.set_processor('CPU', kernel)
+            for kind, f in [('fq', s.get_fq), ('grad', s.get_grad_fq)]:
+                memory.memory_budget = old_budget
+                ans = f(atoms)
+                need = model(kind, len(atoms), qmax_bin)
+                memory.set_memory_budget(need - 1)
+                assert_raises(MemoryError, f, atoms)
+                memory.set_memory_budget(need)
+                stats_check(f(atoms), ans)
+    finally:
+        memory.memory_budget = old_budget
+
+
+def test_outer_tracer():
+    # a tracer started by the caller keeps its peak
+    import tracemalloc
+    atoms = setup_atoms(20)
+    s = ElasticScatter()
+    s.set_processor('CPU', 'nxn')
+    old_trace = memory.trace
+    memory.trace = True
+    tracemalloc.start()
+    try:
+        big = np.ones(2 ** 20)
+        del big
+        s.get_fq(atoms)
+        assert tracemalloc.get_traced_memory()[1] >= 8 * 2 ** 20
+        assert memory.get_last_report().observed_peak == 0
+    finally:
+        tracemalloc.stop()
+        memory.trace = old_trace
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
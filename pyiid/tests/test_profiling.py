@@ -0,0 +1,77 @@
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter import profiling
+
+__author__ = 'christopher'
+
+
+def test_disabled():
+    # without a profile the marks are one shared do-nothing context
+    assert profiling.stage('a') is profiling.stage('b')
+    s = ElasticScatter()
+    s.set_processor('CPU', 'nxn')
+    s.get_fq(setup_atoms(10))
+    assert s.stats is None
+
+
+def test_profile():
+    atoms = setup_atoms(20)
+    for kernel, stages in [('nxn', ['get_omega', 'sum']),
+                           ('flat-serial', ['get_flat_geometry', 'get_omega',
+                                            'get_grad_omega', 'sum']),
+                           ('flat-threaded', ['get_fq_blocks',
+                                              'get_grad_fq_blocks'])]:
+        s = ElasticScatter()
+        s.set_processor('CPU', kernel)
+        name = 'CPU/' + kernel
+        with s.profile() as stats:
+            s.get_fq(atoms)
+            s.get_pdf(atoms)
+            s.get_grad_fq(atoms)
+        records = stats.records
+        assert records[(name, 'total')].calls == 3
+        for stage in stages:
+            assert (name, stage) in records
+        assert records[('', 'get_pdf_at_qmin')].calls == 1
+        # the stages are inside the backend call
+        inner = sum(r.time for (b, st), r in records.items()
+                    if b == name and st != 'total')
+        assert inner <= records[(name, 'total')].time
+        # nothing is recorded after the block
+        s.get_fq(atoms)
+        assert records[(name, 'total')].calls == 3
+        # the stats add up over profile blocks
+        with s.profile():
+            s.get_fq(atoms)
+        assert s.stats.records[(name, 'total')].calls == 4
+        assert name in s.stats.report()
+
+
+def test_profile_memory():
+    atoms = setup_atoms(30)
+    s = ElasticScatter()
+    s.set_processor('CPU', 'flat-serial')
+    s.get_fq(atoms)
+    with s.profile(memory=True) as stats:
+        s.get_fq(atoms)
+    k_max = 30 * 29 // 2
+    qmax_bin = int(s.exp['qmax'] / s.exp['qbin'])
+    omega = stats.records[('CPU/flat-serial', 'get_omega')]
+    assert omega.bytes >= k_max * qmax_bin * 4
+    # the whole call holds the norm and omega arrays
+    total = stats.records[('CPU/flat-serial', 'total')]
+    assert total.peak_bytes >= 2 * k_max * qmax_bin * 4
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,65 @@
+from __future__ import print_function
+from pyiid.tests import *
+from ase.cluster import Octahedron
+from pyiid.experiments.saxs import SAXS
+
+__author__ = 'christopher'
+
+atoms = Octahedron('Au', 5)
+atoms.rattle(.05, seed=42)
+atoms.numbers[::3] = 46
+
+
+def test_iq_against_debye():
+    s = SAXS({'qmax': .8, 'qbin': .02})
+    ans = s.get_iq(atoms)
+    elements, scatter_array = s._get_scatter(atoms)
+    f = scatter_array[elements]
+    r = atoms.get_all_distances()
+    iq = np.zeros(ans.shape)
+    for k, sv in enumerate(s.get_scatter_vector()):
+        iq[k] = np.sum(f[:, k][:, np.newaxis] * f[:, k][np.newaxis, :] *
+                       np.sinc(sv * r / np.pi))
+    assert_allclose(ans, iq, rtol=1e-4)
+
+
+def test_qmin():
+    # qmin / qbin is just under 3, the form factors must start at Q=qmin
+    s = SAXS({'qmin': .3, 'qmax': .8, 'qbin': .1})
+    sv = s.get_scatter_vector()
+    assert_allclose(sv[0], .3)
+    assert len(s.get_iq(atoms)) == len(sv)
+    elements, scatter_array = s._get_scatter(atoms)
+    elements, full = SAXS({'qmax': .8, 'qbin': .1})._get_scatter(atoms)
+    assert_allclose(scatter_array, full[:, 3:])
+
+
+def test_grad_iq():
+    s = SAXS({'qmax': .8, 'qbin': .02})
+    atoms2 = dc(atoms[:20])
+    ans = s.get_grad_iq(atoms2)
+    h = 1e-5
+    grad = np.zeros(ans.shape)
+    for i in range(len(atoms2)):
+        for w in range(3):
+            atoms2.positions[i, w] += h
+            ip = s.get_iq(atoms2)
+            atoms2.positions[i, w] -= 2 * h
+            im = s.get_iq(atoms2)
+            atoms2.positions[i, w] += h
+            grad[i, w] = -(ip - im) / (2 * h)
+    assert_allclose(ans, grad, atol=1e-6 * np.max(np.abs(ans)))
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
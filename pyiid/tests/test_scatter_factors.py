@@ -0,0 +1,52 @@
+from __future__ import print_function
+import tempfile
+import shutil
+from pyiid.tests import *
+from pyiid.experiments.shared import scatter_factors
+from pyiid.experiments.shared.scatter_factors import get_form_factor, \
+    get_form_factor_table, calculate_form_factor
+
+__author__ = 'christopher'
+
+
+def test_form_factor_cache():
+    cache_dir = tempfile.mkdtemp()
+    old_env = os.environ.get('PYIID_CACHE_DIR')
+    os.environ['PYIID_CACHE_DIR'] = cache_dir
+    try:
+        scatter_factors._memory_cache.clear()
+        ff = get_form_factor(79, .1, 250)
+        assert_allclose(ff, calculate_form_factor(79, np.arange(250) * .1),
+                        rtol=1e-6)
+        assert os.path.exists(scatter_factors._cache_file((79, .1, 250)))
+        # served from memory
+        assert get_form_factor(79, .1, 250) is ff
+        # served from disk
+        scatter_factors._memory_cache.clear()
+        assert_allclose(get_form_factor(79, .1, 250), ff)
+    finally:
+        if old_env is None:
+            del os.environ['PYIID_CACHE_DIR']
+        else:
+            os.environ['PYIID_CACHE_DIR'] = old_env
+        shutil.rmtree(cache_dir)
+
+
+def test_form_factor_table():
+    table = get_form_factor_table([46, 79], .1, 250)
+    assert table.shape == (2, 250)
+    assert_allclose(table[1], get_form_factor(79, .1, 250))
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
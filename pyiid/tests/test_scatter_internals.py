@@ -1,6 +1,7 @@
 from __future__ import print_function
 from pyiid.tests import *
 from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.atomics import get_scatter_factors
 from pyiid.experiments.elasticscatter.kernels import (antisymmetric_reshape,
                                                       symmetric_reshape)
 from pyiid.experiments.elasticscatter.kernels.cpu_nxn import \
@@ -26,10 +27,7 @@ def start(value):
     e = ElasticScatter(exp)
     e._wrap_atoms(atoms)
     q = atoms.get_positions().astype(np.float32)
-    if value[2] == 'fq':
-        scatter_array = atoms.get_array('F(Q) scatter')
-    else:
-        scatter_array = atoms.get_array('PDF scatter')
+    scatter_array = get_scatter_factors(atoms, value[2])
 
     n, qmax_bin = scatter_array.shape
     k_max = int(n * (n - 1) / 2.)
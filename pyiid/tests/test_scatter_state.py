@@ -24,7 +24,8 @@ def check_add_atom(value):
     assert np.any(ans1)
 
     atoms2 = atoms + Atom('Au', [0, 0, 0])
-    assert scat._check_wrap_atoms_state(atoms2) == False
+    # The scatter factors are stored per element, so no new ones are needed
+    assert scat._check_wrap_atoms_state(atoms2) == True
     ans2 = scat.get_fq(atoms2)
     assert scat._check_wrap_atoms_state(atoms2) == True
     # Check that Scatter gave back something
@@ -56,7 +57,7 @@ def check_del_atom(value):
 
     atoms2 = dc(atoms)
     del atoms2[np.random.choice(len(atoms2))]
-    assert scat._check_wrap_atoms_state(atoms2) == False
+    assert scat._check_wrap_atoms_state(atoms2) == True
     ans2 = scat.get_fq(atoms2)
     assert scat._check_wrap_atoms_state(atoms2) == True
     # Check that Scatter gave back something
@@ -71,9 +72,33 @@ def check_del_atom(value):
     return
 
 
+def check_add_element(value):
+    atoms, exp = value[0:2]
+    proc, alg = value[-1]
+
+    scat = ElasticScatter(exp_dict=exp, verbose=True)
+    scat.set_processor(proc, alg)
+
+    ans1 = scat.get_fq(atoms)
+    assert scat._check_wrap_atoms_state(atoms) == True
+    assert 'F(Q) scatter' not in atoms.arrays.keys()
+
+    atoms2 = atoms + Atom('Pt', [0, 0, 0])
+    # A new element needs new scatter factors
+    assert scat._check_wrap_atoms_state(atoms2) == False
+    assert scat._check_wrap_atoms_state(atoms2) == True
+    ans2 = scat.get_fq(atoms2)
+    assert ans2 is not None
+    assert np.any(ans2)
+    assert not np.allclose(ans1, ans2)
+    del atoms, exp, proc, alg, scat, ans1
+    return
+
+
 tests = [
     check_add_atom,
-    check_del_atom
+    check_del_atom,
+    check_add_element
 ]
 test_data = list(product(
     tests,
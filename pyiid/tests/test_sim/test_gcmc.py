@@ -1,7 +1,7 @@
 from __future__ import print_function
 from pyiid.calc.calc_1d import Calc1D
 from pyiid.experiments.elasticscatter import ElasticScatter
-from pyiid.sim.gcmc import GrandCanonicalEnsemble
+from pyiid.sim.gcmc import GrandCanonicalEnsemble, OccupancyGrid
 from pyiid.tests import *
 from pyiid.calc.spring_calc import Spring
 
@@ -48,6 +48,124 @@ def check_nuts(value):
     assert np.max(n) > n0
 
 
+def test_speculative_gcmc():
+    ideal_atoms, _ = dc(test_atom_squares[0])
+    del ideal_atoms[-2:]
+    n0 = len(ideal_atoms)
+    ideal_atoms.set_calculator(Spring(k=10, rt=2.5))
+
+    dyn = GrandCanonicalEnsemble(ideal_atoms, {'Au': 100.0}, temperature=1000,
+                                 seed=seed, speculative=4, processes=2)
+    traj, metadata = dyn.run(10)
+    n_proposals = sum([metadata[k] for k in ['rejected_additions',
+                                             'accepted_additions',
+                                             'rejected_removals',
+                                             'accepted_removals']])
+    # every proposal up to the accepted one is counted as an iteration
+    assert n_proposals >= 10
+    assert len(traj) - 1 == metadata['accepted_additions'] + \
+                            metadata['accepted_removals']
+    assert np.max([len(a) for a in traj]) > n0
+
+
+def test_cavity_bias():
+    # The cavity bias only changes where insertions are proposed, not the
+    # equilibrium, so biased and unbiased runs give the same mean number of
+    # atoms.  Closer than the cavity radius the springs cost beta * E ~ 100
+    # so the states the biased run never proposes carry no weight.
+    steps = 1000 if travis or os.getenv('SHORT_TEST') else 2000
+    mean_n = []
+    for cavity_radius in [None, 2.]:
+        atoms = Atoms('Au', [[3, 3, 3]], cell=[6, 6, 6])
+        atoms.set_calculator(Spring(k=100, rt=2.5))
+        dyn = GrandCanonicalEnsemble(atoms, {'Au': 0.0}, temperature=1000,
+                                     seed=seed, cavity_radius=cavity_radius)
+        n = []
+        for i in range(steps):
+            dyn.step()
+            n.append(len(dyn.traj[-1]))
+        mean_n.append(np.mean(n[steps // 10:]))
+    # without the cavity fraction in the acceptance the biased run
+    # overfills the cell by almost an atom, the difference of the means of
+    # two correct runs has a spread of about .15 at 2000 steps, going as
+    # 1 / sqrt(steps)
+    assert abs(mean_n[0] - mean_n[1]) < .5 * np.sqrt(2000. / steps)
+
+
+def test_speculative_chain():
+    # the same seed gives the same chain with and without speculation
+    ideal_atoms, _ = dc(test_atom_squares[0])
+    del ideal_atoms[-2:]
+    trajs = []
+    for speculative in [None, 4]:
+        atoms = dc(ideal_atoms)
+        atoms.set_calculator(Spring(k=10, rt=2.5))
+        with GrandCanonicalEnsemble(atoms, {'Au': 100.0}, temperature=1000,
+                                    seed=seed, speculative=speculative,
+                                    processes=1) as dyn:
+            traj, metadata = dyn.run(20)
+        assert dyn.pool is None
+        trajs.append(traj)
+    serial, speculative = trajs
+    # the speculative run may go a few proposals past the last step
+    assert len(serial) > 1
+    assert len(speculative) >= len(serial)
+    for a, b in zip(serial, speculative):
+        assert a.get_chemical_symbols() == b.get_chemical_symbols()
+        assert_allclose(a.positions, b.positions)
+    # the accepted proposals keep the energies computed in the workers
+    for atoms in speculative[1:]:
+        assert 'energy' in atoms.calc.results
+        assert not atoms.calc.check_state(atoms)
+        e = atoms.get_potential_energy()
+        check = dc(atoms)
+        check.set_calculator(Spring(k=10, rt=2.5))
+        assert_allclose(e, check.get_potential_energy(), rtol=1e-6)
+
+
+def test_estimate_duration():
+    ideal_atoms, _ = dc(test_atom_squares[0])
+    ideal_atoms.set_calculator(Spring(k=10, rt=2.5))
+    dyn = GrandCanonicalEnsemble(ideal_atoms, {'Au': 100.0}, temperature=1000,
+                                 seed=seed)
+    models = dyn.calibrate_cost()
+    assert set(models) == {'energy', 'force'}
+    assert dyn.calls_per_step() == {'energy': 1., 'force': 0.}
+    assert dyn.estimate_simulation_duration(ideal_atoms, 10) > 0
+    dyn.run(10)
+    # after a run the measured calls and overhead are used
+    t = dyn.telemetry
+    assert dyn.calls_per_step()['energy'] == \
+        t.stage_calls['energy'] / float(t.steps)
+    seconds = dyn.estimate_step_cost()[0]
+    assert seconds >= dyn.get_step_overhead()
+    assert t.step_time / t.steps / 20. < seconds
+
+
+def test_occupancy_grid():
+    atoms, _ = setup_atomic_square()
+    atoms.center(3)
+    grid = OccupancyGrid(atoms, .5, 2.)
+
+    # brute force the coverage of every voxel center
+    idx = np.indices(grid.shape).reshape(3, -1).T
+    centers = (idx + .5) * grid.resolution
+    r = np.sqrt(np.sum((centers[:, None, :] -
+                        atoms.positions[None, :, :]) ** 2, axis=-1))
+    counts = np.sum(r < grid.radius, axis=1).reshape(grid.shape)
+    assert_allclose(grid.counts, counts)
+
+    # adding then removing an atom should leave the grid unchanged
+    pos = atoms.positions[0] + 1.
+    grid.add(pos)
+    assert not grid.is_cavity(pos)
+    grid.remove(pos)
+    assert_allclose(grid.counts, counts)
+
+    new_pos = grid.sample_cavity(rs)
+    assert grid.is_cavity(new_pos)
+
+
 if __name__ == '__main__':
     import nose
 
@@ -0,0 +1,111 @@
+from __future__ import print_function
+import json
+import shutil
+import tempfile
+from pyiid.tests import *
+from pyiid.sim import Ensemble
+from pyiid.sim.telemetry import Telemetry
+from pyiid.calc.spring_calc import Spring
+
+__author__ = 'christopher'
+
+
+def batch_drift(pe, eq_steps):
+    ret = np.cumsum(pe, dtype=float)
+    ret[eq_steps:] = ret[eq_steps:] - ret[:-eq_steps]
+    ret = ret[eq_steps - 1:] / eq_steps
+    return np.sum(np.gradient(ret[eq_steps:]))
+
+
+def test_equilibrium_drift():
+    eq_steps = 5
+    pe = rs.normal(0, 1, 50) + np.exp(-np.arange(50) / 10.)
+    t = Telemetry(eq_steps=eq_steps)
+    for i, x in enumerate(pe):
+        t.end_step(x, True)
+        if i + 1 < 2 * eq_steps + 1:
+            assert t.equilibrium_drift() is None
+        else:
+            assert_allclose(t.equilibrium_drift(),
+                            batch_drift(pe[:i + 1], eq_steps))
+
+
+def test_equilibrium_replay():
+    eq_steps = 4
+    pe = rs.normal(0, 1, 30)
+    t = Telemetry()
+    for x in pe:
+        t.end_step(x, False)
+    t.reset_equilibrium(eq_steps, pe)
+    assert_allclose(t.equilibrium_drift(), batch_drift(pe, eq_steps))
+
+
+def test_ess():
+    t = Telemetry(max_lag=20)
+    for x in rs.normal(0, 1, 2000):
+        t.end_step(x, True)
+    # independent samples should be nearly all effective
+    assert t.ess() > 1000
+
+    t2 = Telemetry(max_lag=20)
+    x = 0.
+    for e in rs.normal(0, 1, 2000):
+        x = .95 * x + e
+        t2.end_step(x, True)
+    # a strongly correlated chain should not be
+    assert t2.ess() < t.ess() / 4
+
+
+def test_json():
+    t = Telemetry()
+    t.start_step()
+    with t.timer('force'):
+        pass
+    t.end_step(1., True)
+    t.start_step()
+    with t.timer('energy'):
+        pass
+    t.end_step(1., False)
+    s = json.loads(t.to_json())
+    assert s['steps'] == 2
+    assert s['accepted'] == 1
+    assert s['acceptance'] == .5
+    assert s['evaluations'] == 2
+    assert s['stage_calls']['force'] == 1
+
+
+class InterruptedEnsemble(Ensemble):
+    # stops like a ctrl-c on the third step
+    def step(self):
+        if self.telemetry.steps == 2:
+            raise KeyboardInterrupt
+        self.traj.append(dc(self.traj[-1]))
+        return [self.traj[-1]]
+
+
+def test_interrupt():
+    d = tempfile.mkdtemp()
+    try:
+        atoms, _ = setup_atomic_square()
+        atoms.set_calculator(Spring(k=10, rt=2.5))
+        f_name = os.path.join(d, 'telemetry.jsonl')
+        dyn = InterruptedEnsemble(atoms, seed=seed, telemetry_file=f_name)
+        traj, metadata = dyn.run(10)
+        # an interrupted run closes the telemetry file and summarizes
+        assert dyn.telemetry_file.closed
+        assert metadata['telemetry']['steps'] == 2
+        with open(f_name) as f:
+            assert len(f.readlines()) == 2
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=['--with-doctest',
+                         # '--nocapture',
+                         '-v',
+                         '-x'
+                         ],
+                   exit=False)
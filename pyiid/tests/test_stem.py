@@ -0,0 +1,44 @@
+from __future__ import print_function
+from pyiid.tests import *
+from ase.cluster import Octahedron
+from pyiid.experiments.stem import STEM, get_atomic_electron_density
+
+__author__ = 'christopher'
+
+atoms = Octahedron('Au', 3)
+atoms.rattle(.1, seed=42)
+atoms.set_cell(np.ptp(atoms.positions, axis=0) + 8)
+atoms.center()
+
+
+def test_density():
+    stem = STEM(resolution=.3, cutoff=6.)
+    shape = stem.get_shape(atoms)
+    ans = stem.get_density(atoms)
+    voxels = np.zeros(shape)
+    ref = np.zeros(shape)
+    for atom in atoms:
+        ref += get_atomic_electron_density(atom, voxels, stem.resolution)
+    assert_allclose(ans, ref, atol=1e-6 * ref.max())
+
+
+def test_image():
+    stem = STEM(resolution=.3)
+    density = stem.get_density(atoms)
+    for axis in range(3):
+        assert_allclose(stem.get_image(atoms, axis),
+                        np.sum(density, axis=axis) * stem.resolution[axis])
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
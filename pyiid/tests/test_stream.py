@@ -0,0 +1,89 @@
+import tempfile
+import shutil
+from numpy.testing import assert_raises
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.kernels import k_to_ij, ij_to_k
+from pyiid.experiments.elasticscatter.cpu_wrappers.stream_cpu_wrap import \
+    PairStream, get_row_blocks
+
+__author__ = 'christopher'
+
+
+def test_k_to_ij_64_bit():
+    # k_max passes 2 ** 31 at 65536 atoms
+    for n in [65536, 65537, 10 ** 6, 10 ** 7]:
+        k_max = n * (n - 1) // 2
+        assert k_to_ij(k_max - 1) == (n - 1, n - 2)
+        for i in [n - 1, n - 2, n // 2 + 1]:
+            for j in [0, 1, i - 1]:
+                k = ij_to_k(i, j)
+                assert k_to_ij(k) == (i, j)
+        assert ij_to_k(n - 1, n - 2) == k_max - 1
+
+
+def test_row_blocks():
+    for n, max_pairs in [(1, 5), (10, 1), (10, 10), (100, 333)]:
+        blocks = get_row_blocks(n, max_pairs)
+        assert blocks[0][0] == 0
+        assert blocks[-1][1] == n
+        for (a0, a1), (b0, b1) in zip(blocks[:-1], blocks[1:]):
+            assert a1 == b0
+        for i0, i1 in blocks:
+            pairs = (i1 * (i1 - 1) - i0 * (i0 - 1)) // 2
+            assert pairs <= max_pairs or i1 == i0 + 1
+
+
+def test_stream():
+    atoms = setup_atoms(30)
+    s = ElasticScatter()
+    s.set_processor('CPU', 'flat-threaded')
+    fq = s.get_fq(atoms)
+    grad = s.get_grad_fq(atoms)
+    s._wrap_atoms(atoms)
+    for kind, ans in [('fq', fq), ('grad', grad)]:
+        stream = PairStream(atoms, s.exp['qbin'], 'fq', kind, max_pairs=50)
+        assert len(stream.blocks) > 1
+        assert stream.run()
+        assert stats_check(stream.get_result(), ans, rtol=1e-6, atol=1e-6)
+
+
+def test_stream_checkpoint():
+    atoms = setup_atoms(30)
+    s = ElasticScatter()
+    s._wrap_atoms(atoms)
+    qbin = s.exp['qbin']
+    d = tempfile.mkdtemp()
+    try:
+        f_name = os.path.join(d, 'fq.npz')
+        ans = PairStream(atoms, qbin, max_pairs=50)
+        ans.run()
+        stream = PairStream(atoms, qbin, max_pairs=50, checkpoint=f_name)
+        assert not stream.run(max_blocks=3)
+        assert_raises(RuntimeError, stream.get_result)
+        # a new stream picks up from the checkpoint
+        resumed = PairStream(atoms, qbin, max_pairs=50, checkpoint=f_name)
+        assert resumed.next_block == 3
+        assert resumed.run()
+        assert_allclose(resumed.get_result(), ans.get_result())
+        # a checkpoint of different atoms is not used
+        atoms2 = atoms.copy()
+        atoms2.positions[0] += 1.
+        assert_raises(ValueError, PairStream, atoms2, qbin, max_pairs=50,
+                      checkpoint=f_name)
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+import ase.io
+from pyiid.tests import *
+from pyiid.experiments.elasticscatter import ElasticScatter
+from pyiid.experiments.elasticscatter.trajectory import TrajectoryPDF, \
+    RunningStats
+
+__author__ = 'christopher'
+
+exp = {'qmax': 20., 'rmax': 15.}
+
+
+def setup_frames(n, m):
+    atoms = setup_atoms(n)
+    frames = []
+    for i in range(m):
+        a = atoms.copy()
+        a.rattle(.1, seed=i)
+        frames.append(a)
+    return frames
+
+
+def test_running_stats():
+    x = rs.normal(3., 2., (50, 4))
+    stats = RunningStats(4)
+    for i in range(0, 50, 7):
+        stats.update(x[i:i + 7])
+    assert stats.count == 50
+    assert_allclose(stats.mean, np.mean(x, axis=0))
+    assert_allclose(stats.variance, np.var(x, axis=0, ddof=1))
+
+
+def test_pipeline():
+    d = tempfile.mkdtemp()
+    try:
+        frames = setup_frames(20, 7)
+        pipeline = TrajectoryPDF(d, dict(exp), processes=1, batch_size=3)
+        assert pipeline.run(frames) == 7
+        s = ElasticScatter(dict(exp))
+        pdf = s.get_pdf_batch(frames)
+        stats_check(pipeline.get_rows('pdf'), pdf, rtol=1e-4, atol=1e-5)
+        stats_check(pipeline.get_rows('fq'), s.get_fq_batch(frames),
+                    rtol=1e-4, atol=1e-5)
+        stats_check(pipeline.stats['pdf'].mean, np.mean(pdf, axis=0),
+                    rtol=1e-4, atol=1e-5)
+    finally:
+        shutil.rmtree(d)
+
+
+def test_resume():
+    d = tempfile.mkdtemp()
+    try:
+        frames = setup_frames(20, 7)
+        f_name = os.path.join(d, 'frames.traj')
+        ase.io.write(f_name, frames)
+        out = os.path.join(d, 'out')
+        # stop part way, then carry on in a new pipeline
+        pipeline = TrajectoryPDF(out, dict(exp), processes=1, batch_size=2)
+        assert pipeline.run(f_name, max_frames=3) == 3
+        pipeline = TrajectoryPDF(out, dict(exp), processes=2, batch_size=2)
+        assert pipeline.frames == 3
+        assert pipeline.run(f_name) == 7
+        pdf = ElasticScatter(dict(exp)).get_pdf_batch(frames)
+        stats_check(pipeline.get_rows('pdf'), pdf, rtol=1e-4, atol=1e-5)
+        assert pipeline.stats['pdf'].count == 7
+        stats_check(pipeline.stats['pdf'].variance,
+                    np.var(pdf, axis=0, ddof=1), rtol=1e-3, atol=1e-6)
+        # nor is a different trajectory
+        ase.io.write(f_name, frames[1:])
+        try:
+            pipeline.run(f_name)
+        except ValueError:
+            pass
+        else:
+            assert False
+        try:
+            TrajectoryPDF(out, dict(exp), processes=1).run(frames[::-1])
+        except ValueError:
+            pass
+        else:
+            assert False
+        # a different experiment is not carried on from
+        try:
+            TrajectoryPDF(out, {'qmax': 10.})
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        '-v',
+        # '-x',
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
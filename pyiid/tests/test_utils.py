@@ -1,6 +1,13 @@
+import shutil
+import tempfile
+import warnings
+import ase.io
 from pyiid.tests import *
 from ase.cluster import FaceCenteredCubic
 from pyiid.utils import *
+from pyiid.neighbor_list import NeighborList, attach_neighbor_list, \
+    get_attached_neighbor_list
+from pyiid.calc.spring_calc import Spring
 
 tf = False
 try:
@@ -36,6 +43,65 @@ def test_get_bond_dist_list():
     assert len(bonds) == sum(coord)
 
 
+def test_get_neighbor_list():
+    r = atoms.get_all_distances()
+    n_list = get_neighbor_list(3.6, atoms)
+    for i in range(len(atoms)):
+        assert_allclose(n_list[i], np.where((0 < r[i]) & (r[i] < 3.6))[0])
+
+
+def test_neighbor_list_skin():
+    a = atoms.copy()
+    nl = NeighborList(3.6, skin=.4)
+    nl.update(a)
+    rs = np.random.RandomState(42)
+    for _ in range(5):
+        a.positions += rs.uniform(-.02, .02, a.positions.shape)
+        n_list = nl.get_neighbor_list(a)
+        r = a.get_all_distances()
+        for i in range(len(a)):
+            assert_allclose(n_list[i],
+                            np.where((0 < r[i]) & (r[i] < 3.6))[0])
+    # small moves should not trigger a rebuild
+    assert nl.builds == 1
+    a.positions[0] += .5
+    assert nl.needs_update(a)
+
+
+def test_neighbor_list_pairs():
+    nl = NeighborList(3.6)
+    i, j, d, r = nl.get_pairs(atoms)
+    rr = atoms.get_all_distances()
+    assert np.all(i < j)
+    assert len(i) == np.sum((0 < rr) & (rr < 3.6)) // 2
+    assert_allclose(r, rr[i, j])
+    assert_allclose(d, atoms.positions[j] - atoms.positions[i])
+
+
+
+def test_attached_neighbor_list():
+    a = atoms.copy()
+    nl = attach_neighbor_list(a, 3.6)
+    # copies share the list
+    b = dc(a)
+    assert get_attached_neighbor_list(b, 3.) is nl
+    assert get_attached_neighbor_list(b, 4.) is None
+    b.set_calculator(Spring(k=100, rt=3.))
+    c = atoms.copy()
+    c.set_calculator(Spring(k=100, rt=3.))
+    assert_allclose(b.get_potential_energy(), c.get_potential_energy(),
+                    rtol=1e-4)
+    # the atoms only carry a key, they are written without warnings
+    d = tempfile.mkdtemp()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            for name in ['a.traj', 'a.xyz']:
+                ase.io.write(os.path.join(d, name), a)
+    finally:
+        shutil.rmtree(d)
+
+
 if __name__ == '__main__':
     import nose
 
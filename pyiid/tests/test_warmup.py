@@ -0,0 +1,34 @@
+from __future__ import print_function
+from numba import config
+from numpy.testing import assert_raises
+from pyiid.tests import *
+from pyiid.warmup import warmup
+
+__author__ = 'christopher'
+
+
+@skip_if(config.DISABLE_JIT, 'the JIT is disabled')
+def test_warmup():
+    records = warmup(['pyiid.neighbor_list'], verbose=False)
+    assert all(r['source'] in ['compiled', 'cache'] for r in records)
+    kernels = set(r['kernel'].split('.')[-1] for r in records)
+    assert {'_build_cells', '_neighbor_kernel'}.issubset(kernels)
+
+
+@skip_if(config.DISABLE_JIT, 'the JIT is disabled')
+def test_warmup_unknown_module():
+    assert_raises(ValueError, warmup, ['pyiid.not_a_module'], None, False)
+
+
+if __name__ == '__main__':
+    import nose
+
+    nose.runmodule(argv=[
+        # '-s',
+        '--with-doctest',
+        # '--nocapture',
+        # '-v'
+        # '-x'
+    ],
+        # env={"NOSE_PROCESSES": 1, "NOSE_PROCESS_TIMEOUT": 599},
+        exit=False)
@@ -0,0 +1,266 @@
+from __future__ import print_function
+
+"""
+Compile the numba kernels before the first calculation.
+
+The kernels are compiled the first time they are used, which for a fresh
+worker means seconds of compilation before any work is done.  `warmup`
+compiles every kernel signature into the numba cache, so later processes
+which use the same cache directory (`NUMBA_CACHE_DIR`, eg. a directory baked
+into the worker image or on a shared volume) only load them, and reports how
+long each kernel took.
+
+From the command line:
+
+    pyiid warmup [--cache-dir DIR] [--module MODULE ...]
+"""
+import os
+import sys
+import time
+import math
+import importlib
+from collections import OrderedDict
+import numpy as np
+
+__author__ = 'christopher'
+
+# The kernels which are compiled on first call and their signatures, the
+# kernels with explicit signatures are compiled when their module is imported
+elasticscatter_signatures = OrderedDict([
+    ('pyiid.experiments.elasticscatter.kernels', {}),
+    ('pyiid.experiments.elasticscatter.kernels.cpu_nxn', {}),
+    ('pyiid.experiments.elasticscatter.kernels.cpu_flat', {}),
+    ('pyiid.experiments.elasticscatter.kernels.cpu_threaded', {}),
+    ('pyiid.experiments.elasticscatter.kernels.cpu_experimental', {
+        'experimental_sum_grad_cpu': [
+            'void(f4[:, :, :], f4[:, :, :], i8)',
+            'void(f8[:, :, :], f8[:, :, :], i8)',
+        ]}),
+    ('pyiid.experiments.elasticscatter.kernels.master_kernel', {
+        'spring_force_kernel': [
+            'void(f4[:, :], f4[:, :, :], f4[:, :], f4[:, :])',
+            'void(f8[:, :], f8[:, :, :], f8[:, :], f8[:, :])',
+        ]}),
+])
+
+
+def _get_test_atoms():
+    from ase.atoms import Atoms
+    # the STEM grids cover the unit cell
+    return Atoms('Au4', [[1, 1, 1], [4, 1, 1], [1, 4, 1], [4, 4, 1]],
+                 cell=[6, 6, 3])
+
+
+def _exercise_neighbor_list():
+    from pyiid.neighbor_list import NeighborList
+    NeighborList(4.).get_pairs(_get_test_atoms())
+
+
+def _exercise_asa():
+    from pyiid.asa import calculate_asa
+    calculate_asa(_get_test_atoms(), 1.4)
+
+
+def _exercise_stem():
+    from pyiid.experiments.stem import STEM
+    atoms = _get_test_atoms()
+    stem = STEM()
+    stem.get_density(atoms)
+    stem.get_image(atoms)
+    image = stem.get_fft_image(atoms)
+    stem.get_grad_fft_image(atoms, np.ones(image.shape))
+
+
+def _exercise_saxs():
+    from pyiid.experiments.saxs import SAXS
+    atoms = _get_test_atoms()
+    saxs = SAXS()
+    saxs.get_iq(atoms)
+    saxs.get_grad_iq(atoms)
+
+
+def _exercise_exafs():
+    from pyiid.experiments.exafs import EXAFS
+    atoms = _get_test_atoms()
+    exafs = EXAFS('Au')
+    exafs.get_chi(atoms)
+    exafs.get_grad_chi(atoms)
+
+
+# The kernels which are compiled on first call with the types of their
+# callers, these are compiled by running a small calculation
+exercises = OrderedDict([
+    ('pyiid.neighbor_list', _exercise_neighbor_list),
+    ('pyiid.asa', _exercise_asa),
+    ('pyiid.experiments.stem', _exercise_stem),
+    ('pyiid.experiments.saxs', _exercise_saxs),
+    ('pyiid.experiments.exafs', _exercise_exafs),
+])
+
+
+def get_kernels(module):
+    """
+    Get the numba kernels defined in a module
+
+    Parameters
+    ----------
+    module: module
+        The module
+
+    Returns
+    -------
+    list of (str, Dispatcher):
+        The kernel names and kernels
+    """
+    from numba.core.dispatcher import Dispatcher
+    return sorted((name, obj) for name, obj in vars(module).items()
+                  if isinstance(obj, Dispatcher) and
+                  obj.py_func.__module__ == module.__name__)
+
+
+def get_kernel_records(module):
+    """
+    Describe the compiled signatures of the kernels in a module
+
+    Parameters
+    ----------
+    module: module
+        The module
+
+    Returns
+    -------
+    list of dict:
+        One record per kernel signature, with the 'kernel', the 'signature',
+        the compile 'time' in seconds and the 'source', 'compiled' or
+        'cache' if the kernel was loaded from the numba cache (in which case
+        the time is not known)
+    """
+    records = []
+    for name, kernel in get_kernels(module):
+        for sig, overload in kernel.overloads.items():
+            metadata = getattr(overload, 'metadata', None)
+            if metadata:
+                source = 'compiled'
+                t = metadata.get('timers', {}).get('compiler_lock')
+            else:
+                source = 'cache'
+                t = None
+            records.append({'kernel': '{0}.{1}'.format(module.__name__,
+                                                       name),
+                            'signature': '({0})'.format(
+                                ', '.join(str(ty) for ty in sig)),
+                            'time': t,
+                            'source': source})
+    return records
+
+
+def set_cache_dir(cache_dir):
+    """
+    Set the directory of the numba cache, this must be done before the
+    kernel modules are imported
+
+    Parameters
+    ----------
+    cache_dir: str
+        The cache directory
+    """
+    os.environ['NUMBA_CACHE_DIR'] = cache_dir
+    if 'numba' in sys.modules:
+        from numba.core import config
+        config.CACHE_DIR = cache_dir
+    loaded = [m for m in list(elasticscatter_signatures) + list(exercises)
+              if m in sys.modules]
+    if loaded:
+        print('warning: {0} already imported, their kernels use the '
+              'previous cache directory'.format(', '.join(loaded)))
+
+
+def warmup(modules=None, cache_dir=None, verbose=True):
+    """
+    Compile all the kernels
+
+    Parameters
+    ----------
+    modules: list of str, optional
+        The modules to warm up, defaults to all of them
+    cache_dir: str, optional
+        The numba cache directory, defaults to `NUMBA_CACHE_DIR` or the
+        numba default
+    verbose: bool
+        Print the time taken for each kernel
+
+    Returns
+    -------
+    list of dict:
+        The kernel records, see `get_kernel_records`, with an 'error' entry
+        for each module which could not be compiled
+    """
+    from numba import config
+    # NUMBA_DISABLE_JIT=0 leaves the JIT on, ask numba how it read it
+    if config.DISABLE_JIT:
+        raise RuntimeError('NUMBA_DISABLE_JIT is set, there is nothing to '
+                           'compile')
+    if cache_dir is not None:
+        set_cache_dir(cache_dir)
+    if modules is None:
+        modules = list(elasticscatter_signatures) + list(exercises)
+    records = []
+    for name in modules:
+        if name not in elasticscatter_signatures and name not in exercises:
+            raise ValueError('No kernels known for {0}'.format(name))
+        t0 = time.time()
+        try:
+            module = importlib.import_module(name)
+            if name in elasticscatter_signatures:
+                for kernel, signatures in elasticscatter_signatures[
+                        name].items():
+                    for sig in signatures:
+                        getattr(module, kernel).compile(sig)
+            else:
+                exercises[name]()
+        except Exception as e:
+            # Keep going, a missing optional backend should not stop the
+            # other kernels from being compiled
+            records.append({'kernel': name, 'signature': None, 'time': None,
+                            'source': 'error', 'error': repr(e)})
+            if verbose:
+                print('{0}: failed, {1!r}'.format(name, e))
+            continue
+        module_records = get_kernel_records(module)
+        records.extend(module_records)
+        if verbose:
+            print('{0}: {1:.2f} s'.format(name, time.time() - t0))
+            for r in module_records:
+                t = 'cached' if r['time'] is None else \
+                    '{0:.2f} s'.format(r['time'])
+                print('    {0} {1}: {2}'.format(r['kernel'].split('.')[-1],
+                                                r['signature'], t))
+    return records
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='pyiid warmup',
+        description='Compile the numba kernels into the numba cache')
+    parser.add_argument('--cache-dir', default=None,
+                        help='The numba cache directory, the workers need '
+                             'the same NUMBA_CACHE_DIR')
+    parser.add_argument('--module', action='append', dest='modules',
+                        help='Only warm up this module, may be repeated')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+    records = warmup(args.modules, args.cache_dir, not args.quiet)
+    compiled = [r['time'] for r in records if r['time'] is not None]
+    errors = [r for r in records if r['source'] == 'error']
+    if not args.quiet:
+        print('{0} kernel signatures, {1:.2f} s compiling, {2} from the '
+              'cache, {3} modules failed'.format(
+                len(records) - len(errors), math.fsum(compiled),
+                len([r for r in records if r['source'] == 'cache']),
+                len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,5 +8,6 @@ setup(
     license='',
     author='christopher',
     author_email='',
-    description='', requires=['scipy']
+    description='', requires=['scipy'],
+    entry_points={'console_scripts': ['pyiid = pyiid.__main__:main']},
 )